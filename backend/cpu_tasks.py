@@ -0,0 +1,231 @@
+"""
+CPU-bound parsing, decoding and diffing run in the backend's process pool.
+
+Kept apart from server.py and free of import-time side effects: spawned pool
+workers import this module only, not the app with its database client, caches
+and routes. Everything here is pure and takes picklable arguments.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Identifier field of each catalog kind
+CATALOG_ID_FIELDS = {"live": "stream_id", "vod": "stream_id", "series": "series_id"}
+
+STREAM_URL_ID_RE = re.compile(r'/(\d+)(?:\.[A-Za-z0-9]+)?$')
+XMLTV_TIME_FORMAT = '%Y%m%d%H%M%S'
+
+def parse_m3u_playlist(m3u_content: str) -> List[Dict[str, Any]]:
+    """Parse an m3u_plus playlist into channel dicts"""
+    channels = []
+    current_channel = None
+    
+    for line in m3u_content.split('\n'):
+        line = line.strip()
+        
+        if line.startswith('#EXTINF:'):
+            current_channel = {}
+            
+            tvg_id_match = re.search(r'tvg-id="([^"]*)"', line)
+            tvg_name_match = re.search(r'tvg-name="([^"]*)"', line)
+            tvg_logo_match = re.search(r'tvg-logo="([^"]*)"', line)
+            group_title_match = re.search(r'group-title="([^"]*)"', line)
+            
+            if tvg_id_match:
+                current_channel['stream_id'] = tvg_id_match.group(1)
+            if tvg_name_match:
+                current_channel['name'] = tvg_name_match.group(1)
+            if tvg_logo_match:
+                current_channel['stream_icon'] = tvg_logo_match.group(1)
+            if group_title_match:
+                current_channel['category_id'] = group_title_match.group(1)
+            
+            if 'name' not in current_channel:
+                name_match = re.search(r',(.+)$', line)
+                if name_match:
+                    current_channel['name'] = name_match.group(1).strip()
+        
+        elif line and not line.startswith('#') and current_channel:
+            current_channel['stream_url'] = line
+            
+            if 'stream_id' not in current_channel:
+                id_match = re.search(r'/(\d+)\.', line)
+                if id_match:
+                    current_channel['stream_id'] = int(id_match.group(1))
+            
+            if 'stream_id' not in current_channel:
+                current_channel['stream_id'] = len(channels) + 1
+            if 'category_id' not in current_channel:
+                current_channel['category_id'] = ''
+            
+            channels.append(current_channel)
+            current_channel = None
+    
+    return channels
+
+def catalog_item_id(kind: str, item: Dict[str, Any]) -> Optional[str]:
+    """Stable identifier of a catalog entry within its kind"""
+    if kind == "live":
+        # tvg-id is often empty or shared between HD/FHD variants, the stream URL is not
+        stream_url = item.get("stream_url") or ""
+        id_match = STREAM_URL_ID_RE.search(stream_url)
+        if id_match:
+            return id_match.group(1)
+        return stream_url or None
+    
+    value = item.get(CATALOG_ID_FIELDS[kind])
+    if value is None or value == "":
+        return None
+    return str(value)
+
+def catalog_content_hash(item: Dict[str, Any]) -> str:
+    """Hash of an entry's content, independent of key order"""
+    payload = json.dumps(item, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def decode_catalog(kind: str, payload: Any) -> List[Dict[str, Any]]:
+    if kind == "live":
+        return parse_m3u_playlist(payload)
+    items = json.loads(payload)
+    if not isinstance(items, list):
+        raise ValueError(f"Unexpected {kind} catalog payload: {type(items).__name__}")
+    return items
+
+def diff_catalog(kind: str, payload: Any, previous: Dict[str, tuple]) -> Dict[str, Any]:
+    """Decode a fresh catalog and compare it against the stored snapshot.
+
+    Pure CPU work, run in the process pool: only the changed entries travel
+    back to the event loop.
+    """
+    items = decode_catalog(kind, payload)
+    changed = []
+    moved = []
+    seen = set()
+    for position, item in enumerate(items):
+        item_id = catalog_item_id(kind, item)
+        if item_id is None or item_id in seen:
+            continue
+        seen.add(item_id)
+        
+        digest = catalog_content_hash(item)
+        old = previous.get(item_id)
+        if old is None:
+            changed.append((item_id, digest, item, position, True))
+        elif old[0] != digest:
+            changed.append((item_id, digest, item, position, False))
+        elif old[1] != position:
+            moved.append((item_id, position))
+    
+    removed = [item_id for item_id in previous if item_id not in seen]
+    
+    return {
+        "changed": changed,
+        "moved": moved,
+        "removed": removed,
+        "previous_count": len(previous),
+        "count": len(seen)
+    }
+
+def find_epg_now_next(content: bytes, stream_id: str, now: datetime) -> Dict[str, Any]:
+    """Find the current and next programmes of a stream in an XMLTV document"""
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(content)
+    
+    # Find channel by stream_id
+    channel_id = None
+    for channel in root.findall('.//channel'):
+        if stream_id in channel.get('id', ''):
+            channel_id = channel.get('id')
+            break
+    
+    if not channel_id:
+        return {"current": None, "next": None}
+    
+    # Find current and next programs
+    current_program = None
+    next_program = None
+    
+    for programme in root.findall('.//programme'):
+        if programme.get('channel') != channel_id:
+            continue
+    
+        # Parse start and stop times (format: YYYYMMDDHHmmss +0000)
+        start_str = programme.get('start', '').split()[0]
+        stop_str = programme.get('stop', '').split()[0]
+    
+        try:
+            start_time = datetime.strptime(start_str, '%Y%m%d%H%M%S')
+            stop_time = datetime.strptime(stop_str, '%Y%m%d%H%M%S')
+        
+            # Check if program is current
+            if start_time <= now < stop_time:
+                title_elem = programme.find('title')
+                desc_elem = programme.find('desc')
+            
+                current_program = {
+                    "title": title_elem.text if title_elem is not None else "Programme en cours",
+                    "description": desc_elem.text if desc_elem is not None else "",
+                    "start": start_time.strftime('%H:%M'),
+                    "end": stop_time.strftime('%H:%M'),
+                    "progress": int(((now - start_time).total_seconds() / (stop_time - start_time).total_seconds()) * 100)
+                }
+        
+            # Check if program is next
+            elif start_time > now and next_program is None:
+                title_elem = programme.find('title')
+                desc_elem = programme.find('desc')
+            
+                next_program = {
+                    "title": title_elem.text if title_elem is not None else "Programme suivant",
+                    "description": desc_elem.text if desc_elem is not None else "",
+                    "start": start_time.strftime('%H:%M'),
+                    "end": stop_time.strftime('%H:%M')
+                }
+            
+            # Stop if we found both
+            if current_program and next_program:
+                break
+            
+        except (ValueError, AttributeError) as e:
+            logger.error(f"Error parsing EPG time: {e}")
+            continue
+    
+    return {
+        "current": current_program,
+        "next": next_program
+    }
+
+def build_epg_index(content: bytes, start: datetime, horizon: timedelta) -> Dict[str, Any]:
+    """Channel ids in guide order and programmes per channel overlapping [start, start + horizon]"""
+    import xml.etree.ElementTree as ET
+    
+    end = start + horizon
+    channels = []
+    programmes: Dict[str, list] = {}
+    for _, element in ET.iterparse(io.BytesIO(content)):
+        if element.tag == "channel":
+            channels.append(element.get("id", ""))
+            element.clear()
+        elif element.tag == "programme":
+            try:
+                start_time = datetime.strptime(element.get("start", "").split()[0], XMLTV_TIME_FORMAT)
+                stop_time = datetime.strptime(element.get("stop", "").split()[0], XMLTV_TIME_FORMAT)
+            except (ValueError, IndexError):
+                element.clear()
+                continue
+            if stop_time > start and start_time < end:
+                programmes.setdefault(element.get("channel"), []).append(
+                    (start_time, stop_time, element.findtext("title"), element.findtext("desc") or "")
+                )
+            element.clear()
+    
+    for channel_programmes in programmes.values():
+        channel_programmes.sort(key=lambda programme: programme[0])
+    return {"channels": channels, "programmes": programmes, "horizon_end": end}
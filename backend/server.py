@@ -1,15 +1,43 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, UpdateMany, DeleteOne, ReplaceOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import re
+import json
+import asyncio
+import hashlib
+import hmac
 import logging
+import zlib
+import io
+import csv
+import multiprocessing
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+import contextvars
+import traceback
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import Sequence
 from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pydantic import BaseModel, Field
+from cpu_tasks import build_epg_index, catalog_item_id, diff_catalog, find_epg_now_next, parse_m3u_playlist
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import httpx
 import secrets
 import string
@@ -17,15 +45,6 @@ import string
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
-# Create the main app
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -33,6 +52,462 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== METRICS ====================
+
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+def format_metric_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+class MetricCounter:
+    """Prometheus counter with labels"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+    
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield self.name, dict(zip(self.label_names, key)), value
+
+class MetricHistogram:
+    """Prometheus histogram with labels"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = METRIC_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values: Dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def samples(self):
+        for key, series in list(self._values.items()):
+            labels = dict(zip(self.label_names, key))
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket", {**labels, "le": bound}, count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, series[-1]
+            yield f"{self.name}_sum", labels, series[-2]
+            yield f"{self.name}_count", labels, series[-1]
+
+class MetricsRegistry:
+    """Minimal Prometheus text exposition registry"""
+    
+    def __init__(self):
+        self.metrics = []
+        # Callables returning (name, kind, help, [(labels, value), ...]) computed at scrape time
+        self.collectors = []
+    
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> MetricCounter:
+        metric = MetricCounter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = METRIC_LATENCY_BUCKETS) -> MetricHistogram:
+        metric = MetricHistogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.error(f"Metrics collector error: {str(e)}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    "iptv_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+HTTP_REQUEST_DURATION = metrics.histogram(
+    "iptv_http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_RESPONSE_SIZE = metrics.histogram(
+    "iptv_http_response_size_bytes", "HTTP response body size by route", ("route",), METRIC_SIZE_BUCKETS)
+UPSTREAM_DURATION = metrics.histogram(
+    "iptv_upstream_request_duration_seconds", "Xtream upstream call latency by action", ("action",))
+UPSTREAM_ERRORS = metrics.counter(
+    "iptv_upstream_errors_total", "Failed Xtream upstream calls by action", ("action", "error"))
+UPSTREAM_RESPONSE_SIZE = metrics.histogram(
+    "iptv_upstream_response_size_bytes", "Xtream upstream payload size by action", ("action",), METRIC_SIZE_BUCKETS)
+MONGO_DURATION = metrics.histogram(
+    "iptv_mongo_operation_duration_seconds", "MongoDB command latency by collection", ("collection", "command"))
+MONGO_FAILURES = metrics.counter(
+    "iptv_mongo_operation_failures_total", "Failed MongoDB commands by collection", ("collection", "command"))
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command per collection (runs on the driver's threads)"""
+    
+    def __init__(self):
+        self._collections: Dict[int, str] = {}
+    
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+    
+    def succeeded(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_DURATION.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+        record_phase("db", event.duration_micros / 1e6)
+    
+    def failed(self, event):
+        collection = self._collections.pop(event.request_id, "")
+        MONGO_DURATION.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+        MONGO_FAILURES.inc(collection=collection, command=event.command_name)
+        record_phase("db", event.duration_micros / 1e6)
+
+@asynccontextmanager
+async def track_upstream(action: str):
+    """Record latency and errors of one upstream call"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(action=action, error=type(e).__name__)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        UPSTREAM_DURATION.observe(duration, action=action)
+        record_phase("upstream", duration)
+
+# Long-lived streams: their duration and size are the connection lifetime, not a response
+METRICS_EXCLUDED_PATHS = {"/api/notification/stream"}
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and response size per route template"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start = time.perf_counter()
+        status = {"code": 500, "size": 0}
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body":
+                status["size"] += len(message.get("body", b""))
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            HTTP_REQUESTS.inc(method=scope["method"], route=route_path, status=status["code"])
+            if scope["path"] not in METRICS_EXCLUDED_PATHS:
+                HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, method=scope["method"], route=route_path)
+                HTTP_RESPONSE_SIZE.observe(status["size"], route=route_path)
+
+def collect_cache_metrics():
+    caches = [cache.stats() for cache in (title_info_cache, catalog_cache, category_cache, epg_cache,
+                                          upstream_stale_cache, image_cache, playlist_cache)]
+    families = []
+    for field, kind, help_text in [
+        ("hits", "counter", "Cache hits"),
+        ("misses", "counter", "Cache misses"),
+        ("evictions", "counter", "Cache evictions"),
+        ("bytes", "gauge", "Cache size in bytes"),
+    ]:
+        samples = [({"cache": stats["name"]}, stats[field]) for stats in caches if stats.get(field) is not None]
+        families.append((f"iptv_cache_{field}" + ("_total" if kind == "counter" else ""), kind, help_text, samples))
+    return families
+
+def collect_upstream_metrics():
+    states = [CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN]
+    guards = list(upstream_guards.values())
+    user_guards = [guard for guard in guards if not guard.background]
+    
+    def labels(guard):
+        return {"host": guard.host, "traffic": "background" if guard.background else "user"}
+    
+    return [
+        ("iptv_upstream_circuit_state", "gauge", "Circuit breaker state per host (0 closed, 1 half open, 2 open)",
+         [({"host": guard.host}, states.index(guard.breaker.state)) for guard in user_guards]),
+        ("iptv_upstream_in_flight", "gauge", "In-flight upstream requests per host and traffic (user or background)",
+         [(labels(guard), guard.in_flight) for guard in guards]),
+        ("iptv_upstream_rejected_total", "counter", "Upstream requests rejected without being sent",
+         [(labels(guard), guard.rejected) for guard in guards]),
+    ]
+
+metrics.collectors.extend([collect_cache_metrics, collect_upstream_metrics])
+
+# ==================== REQUEST PROFILING ====================
+
+# Fraction of requests to profile (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+# Sampled requests slower than this (seconds) are kept
+PROFILE_SLOW_THRESHOLD = float(os.environ.get('PROFILE_SLOW_THRESHOLD', '1.0'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '20'))
+# Requests carrying this value in X-Profile-Token are always profiled and kept
+ADMIN_PROFILE_TOKEN = os.environ.get('ADMIN_PROFILE_TOKEN', '')
+# Long-lived streams would hold the profiler for their whole lifetime
+PROFILE_EXCLUDED_PATHS = {"/api/notification/stream"}
+
+class RequestProfile:
+    """Per-phase timings (upstream, parse, db, encode) of one profiled request"""
+    
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, phase: str, seconds: float) -> None:
+        # DB timings arrive from the driver's threads
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+current_profile: contextvars.ContextVar = contextvars.ContextVar("current_profile", default=None)
+slow_profiles: deque = deque(maxlen=PROFILE_KEEP)
+# cProfile can only trace one request at a time
+profiler_lock = threading.Lock()
+
+def record_phase(phase: str, seconds: float) -> None:
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add(phase, seconds)
+
+@contextmanager
+def profile_phase(phase: str):
+    """Time a block into the current request profile, if any"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(phase, time.perf_counter() - start)
+
+class ProfiledJSONResponse(JSONResponse):
+    """JSONResponse whose serialization is timed as the encode phase"""
+    
+    def render(self, content: Any) -> bytes:
+        with profile_phase("encode"):
+            return super().render(content)
+
+class ProfilingMiddleware:
+    """Profiles a sample of requests, or those with a valid X-Profile-Token header.
+
+    The call stack is captured with cProfile, which traces everything running
+    on the event loop thread meanwhile, so concurrent requests show up too.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    def _forced(self, scope) -> bool:
+        if not ADMIN_PROFILE_TOKEN:
+            return False
+        for name, value in scope.get("headers", []):
+            if name == b"x-profile-token":
+                return secrets.compare_digest(value.decode("latin-1"), ADMIN_PROFILE_TOKEN)
+        return False
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        forced = self._forced(scope)
+        if scope["path"] in PROFILE_EXCLUDED_PATHS or (
+                not forced and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE)):
+            await self.app(scope, receive, send)
+            return
+        
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+        status = {"code": 500}
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+        
+        profiler = cProfile.Profile() if profiler_lock.acquire(blocking=False) else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            if profiler:
+                profiler.disable()
+                profiler_lock.release()
+            current_profile.reset(token)
+            
+            if forced or duration >= PROFILE_SLOW_THRESHOLD:
+                stack = None
+                if profiler:
+                    output = io.StringIO()
+                    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(40)
+                    stack = output.getvalue()
+                
+                route = scope.get("route")
+                phases = {phase: round(seconds, 6) for phase, seconds in profile.phases.items()}
+                slow_profiles.append({
+                    "id": profile.id,
+                    "method": profile.method,
+                    "path": profile.path,
+                    "route": getattr(route, "path", None),
+                    "status": status["code"],
+                    "started_at": profile.started_at,
+                    "duration": round(duration, 6),
+                    "phases": phases,
+                    # Time not covered by an instrumented phase (routing, validation, handler code)
+                    "other": round(max(0.0, duration - sum(profile.phases.values())), 6),
+                    "forced": forced,
+                    "profile": stack
+                })
+
+# ==================== EVENT LOOP MONITOR ====================
+
+# Seconds between two lag samples
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.1'))
+# A callback holding the loop longer than this (seconds) is reported with its stack
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', '0.25'))
+
+LOOP_BLOCKED = metrics.counter(
+    "iptv_event_loop_blocked_total", "Callbacks that blocked the event loop longer than the threshold")
+
+class EventLoopMonitor:
+    """Measures event loop scheduling lag and reports callbacks that block it.
+
+    A coroutine sleeps LOOP_LAG_INTERVAL and records how late it wakes up. A
+    watchdog thread checks its heartbeat and, when the loop stalls longer than
+    LOOP_BLOCK_THRESHOLD, captures the loop thread's current stack so the
+    blocking call is visible while it is still running.
+    """
+    
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: deque = deque(maxlen=1000)
+        self.stalls: deque = deque(maxlen=20)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+        self._watchdog.start()
+        
+        try:
+            while True:
+                start = loop.time()
+                self._heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.samples.append(max(0.0, loop.time() - start - self.interval))
+        finally:
+            self._stop.set()
+    
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            
+            # Report each stall once, with the stack of whatever is running on the loop
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            LOOP_BLOCKED.inc()
+            self.stalls.append({
+                "detected_at": datetime.utcnow(),
+                "blocked_for": round(stalled, 3),
+                "stack": stack
+            })
+            logger.warning(f"Event loop blocked for {stalled:.3f}s:\n{stack}")
+    
+    def percentiles(self) -> Dict[str, float]:
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+        return {
+            quantile: samples[min(len(samples) - 1, int(len(samples) * float(quantile)))]
+            for quantile in ("0.5", "0.9", "0.99", "1.0")
+        }
+
+loop_monitor = EventLoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD)
+
+def collect_loop_metrics():
+    return [
+        ("iptv_event_loop_lag_seconds", "summary", "Event loop scheduling lag over the last samples",
+         [({"quantile": quantile}, value) for quantile, value in loop_monitor.percentiles().items()]),
+    ]
+
+metrics.collectors.append(collect_loop_metrics)
+
+# Create the main app
+app = FastAPI(default_response_class=ProfiledJSONResponse)
+api_router = APIRouter(prefix="/api")
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
+db = client[os.environ['DB_NAME']]
+
 # ==================== MODELS ====================
 
 class XtreamConfig(BaseModel):
@@ -137,6 +612,169 @@ async def get_xtream_config() -> Dict[str, Any]:
         raise HTTPException(status_code=404, detail="Xtream configuration not found")
     return config
 
+async def fetch_player_api(config: Dict[str, Any], action: Optional[str] = None, timeout: float = 30.0,
+                           stale_fallback: bool = False, raw: bool = False, **extra) -> Any:
+    """Call player_api.php with the config credentials and return the decoded JSON.
+
+    With ``stale_fallback`` the last good answer is returned when upstream is
+    failing or its circuit is open. With ``raw`` the undecoded body is returned.
+    """
+    url = f"{config['dns_url']}/player_api.php"
+    params = {
+        "username": config["username"],
+        "password": config["password"]
+    }
+    if action:
+        params["action"] = action
+    extra = {key: value for key, value in extra.items() if value is not None}
+    params.update(extra)
+    stale_key = (config.get("id"), action, tuple(sorted(extra.items())))
+    
+    try:
+        async with upstream_guard(url).slot(), track_upstream(action or "account_info"):
+            response = await get_upstream_client().get(url, params=params, timeout=timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+        UPSTREAM_RESPONSE_SIZE.observe(len(response.content), action=action or "account_info")
+        if raw:
+            return response.content
+        # Decoded inline: unpickling a decoded list from a worker costs as much as json.loads, plus the IPC.
+        # Large catalogs go through raw and diff_catalog, which only sends the changes back
+        with profile_phase("parse"):
+            data = json.loads(response.content)
+    except (UpstreamUnavailable, httpx.HTTPError) as e:
+        stale = upstream_stale_cache.get(stale_key, allow_stale=True) if stale_fallback else None
+        if stale is None:
+            raise
+        logger.warning(f"Serving stale {action or 'account info'} response: {str(e)}")
+        return stale
+    
+    if stale_fallback:
+        upstream_stale_cache.set(stale_key, data, size=len(response.content))
+    return data
+
+def fetch_xmltv(config: Dict[str, Any]) -> bytes:
+    """Download the XMLTV guide with a pooled cloudscraper session (blocking)"""
+    # EPG endpoint from Xtream
+    url = f"{config['dns_url']}/xmltv.php"
+    params = {
+        "username": config["username"],
+        "password": config["password"],
+    }
+    
+    response = scraper_pool(url).get(url, params=params, timeout=30)
+    response.raise_for_status()
+    UPSTREAM_RESPONSE_SIZE.observe(len(response.content), action="xmltv")
+    return response.content
+
+async def fetch_live_channels(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Fetch live channels from the M3U playlist off the event loop, through the upstream guard"""
+    async with upstream_guard(config['dns_url']).slot(), track_upstream("m3u"):
+        m3u_content = await run_scraper(download_m3u, config)
+    
+    with profile_phase("parse"):
+        channels = await run_cpu(parse_m3u_playlist, m3u_content)
+    logger.info(f"Successfully parsed {len(channels)} channels from M3U")
+    return channels
+
+def download_m3u(config: Dict[str, Any]) -> str:
+    """Download the M3U playlist with a pooled cloudscraper session (Cloudflare bypass).
+
+    Blocking: run it with run_scraper when on the event loop.
+    """
+    url = f"{config['dns_url']}/get.php"
+    params = {
+        "username": config["username"],
+        "password": config["password"],
+        "type": "m3u_plus",
+        "output": "mpegts"
+    }
+    
+    response = scraper_pool(url).get(url, params=params, timeout=60)
+    response.raise_for_status()
+    UPSTREAM_RESPONSE_SIZE.observe(len(response.content), action="m3u")
+    return response.text
+
+USER_CODE_INSERT_ATTEMPTS = 10
+DUPLICATE_KEY_ERROR = 11000
+
+user_code_index_ready = False
+
+async def ensure_user_code_index() -> None:
+    """Create the unique index on user_codes.code, which code generation relies on"""
+    global user_code_index_ready
+    await db.user_codes.create_index("code", unique=True)
+    user_code_index_ready = True
+
+async def has_user_code_index() -> bool:
+    """Whether the unique index on user_codes.code exists (checked until it is found)"""
+    global user_code_index_ready
+    if not user_code_index_ready:
+        indexes = await db.user_codes.index_information()
+        user_code_index_ready = any(
+            index.get("unique") and list(index["key"]) == [("code", 1)] for index in indexes.values()
+        )
+    return user_code_index_ready
+
+async def generate_free_user_codes(count: int) -> List[str]:
+    """``count`` distinct codes not used yet, checked against the collection"""
+    codes = set()
+    for _ in range(USER_CODE_INSERT_ATTEMPTS):
+        while len(codes) < count:
+            codes.add(generate_user_code())
+        taken = await db.user_codes.find({"code": {"$in": list(codes)}}, {"_id": 0, "code": 1}).to_list(None)
+        if not taken:
+            return list(codes)
+        codes.difference_update(doc["code"] for doc in taken)
+    raise HTTPException(status_code=500, detail="Could not generate unique codes")
+
+async def insert_unique_user_codes(template: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+    """Insert ``count`` user codes built from ``template``, each with a fresh code.
+
+    Relies on the unique index on ``user_codes.code``: everything is inserted in
+    one unordered insert_many and only the codes that collided are regenerated.
+    Without the index, codes are checked against the collection before the
+    insert, like the single code routes used to do.
+    """
+    now = datetime.utcnow()
+    if not await has_user_code_index():
+        logger.warning("Unique index on user_codes.code is missing, checking generated codes against the collection")
+        inserted = [{**template, "code": code, "created_at": now} for code in await generate_free_user_codes(count)]
+        await db.user_codes.insert_many(inserted)
+        for doc in inserted:
+            doc.pop("_id", None)
+        return inserted
+    
+    codes = set()
+    while len(codes) < count:
+        codes.add(generate_user_code())
+    pending = [{**template, "code": code, "created_at": now} for code in codes]
+    inserted = []
+    
+    for _ in range(USER_CODE_INSERT_ATTEMPTS):
+        try:
+            await db.user_codes.insert_many(pending, ordered=False)
+            inserted.extend(pending)
+            pending = []
+            break
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in write_errors):
+                raise
+            collided = {error["index"] for error in write_errors}
+            inserted.extend(doc for index, doc in enumerate(pending) if index not in collided)
+            pending = [
+                {**{key: value for key, value in doc.items() if key != "_id"}, "code": generate_user_code()}
+                for index, doc in enumerate(pending) if index in collided
+            ]
+    
+    if pending:
+        raise HTTPException(status_code=500, detail=f"Could not generate {len(pending)} unique code(s)")
+    
+    for doc in inserted:
+        doc.pop("_id", None)
+    return inserted
+
 # ==================== ADMIN ROUTES ====================
 
 @api_router.post("/admin/xtream-config")
@@ -235,21 +873,13 @@ async def create_user_with_xtream(config: XtreamConfig, max_profiles: int = 5):
     await db.xtream_config.insert_one(config_dict)
     
     # Step 3: Generate unique user code
-    while True:
-        code = generate_user_code()
-        existing = await db.user_codes.find_one({"code": code})
-        if not existing:
-            break
-    
     user_code_dict = {
-        "code": code,
-        "created_at": datetime.utcnow(),
         "is_active": True,
         "max_profiles": max_profiles,
         "xtream_config_id": config_dict["id"]
     }
     
-    await db.user_codes.insert_one(user_code_dict)
+    code = (await insert_unique_user_codes(user_code_dict, 1))[0]["code"]
     
     # Format expiration date for display
     expiration_date_str = None
@@ -277,16 +907,7 @@ async def create_user_with_xtream(config: XtreamConfig, max_profiles: int = 5):
 @api_router.post("/admin/user-codes")
 async def create_user_code_admin(input: UserCodeCreate):
     """Admin: Generate a new user code with Xtream credentials"""
-    # Generate unique code
-    while True:
-        code = generate_user_code()
-        existing = await db.user_codes.find_one({"code": code})
-        if not existing:
-            break
-    
     user_code_dict = {
-        "code": code,
-        "created_at": datetime.utcnow(),
         "is_active": True,
         "max_profiles": input.max_profiles,
         "user_note": input.user_note or "",
@@ -295,7 +916,7 @@ async def create_user_code_admin(input: UserCodeCreate):
         "xtream_password": input.xtream_password
     }
     
-    await db.user_codes.insert_one(user_code_dict)
+    code = (await insert_unique_user_codes(user_code_dict, 1))[0]["code"]
     
     return {
         "message": "User code generated successfully",
@@ -303,6 +924,53 @@ async def create_user_code_admin(input: UserCodeCreate):
         "max_profiles": input.max_profiles
     }
 
+class BulkUserCodeCreate(BaseModel):
+    count: int = Field(gt=0, le=10000)
+    max_profiles: int = 5
+    user_note: Optional[str] = None
+    dns_url: str
+    xtream_username: str
+    xtream_password: str
+
+@api_router.post("/admin/user-codes/bulk")
+async def create_user_codes_bulk(input: BulkUserCodeCreate, format: str = "json"):
+    """Admin: Generate a batch of user codes sharing the same Xtream credentials"""
+    if format not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="Invalid format, use json or csv")
+    
+    template = {
+        "is_active": True,
+        "max_profiles": input.max_profiles,
+        "user_note": input.user_note or "",
+        "dns_url": input.dns_url,
+        "xtream_username": input.xtream_username,
+        "xtream_password": input.xtream_password
+    }
+    
+    inserted = await insert_unique_user_codes(template, input.count)
+    logger.info(f"Provisioned {len(inserted)} user codes")
+    
+    if format == "csv":
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["code", "max_profiles", "user_note", "dns_url", "created_at"])
+        for doc in inserted:
+            writer.writerow([doc["code"], doc["max_profiles"], doc["user_note"], doc["dns_url"], doc["created_at"].isoformat()])
+        return Response(
+            content=output.getvalue(),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="user-codes-{datetime.utcnow():%Y%m%d-%H%M%S}.csv"'}
+        )
+    
+    return {
+        "message": f"{len(inserted)} user codes generated successfully",
+        "count": len(inserted),
+        "codes": [
+            {"code": doc["code"], "max_profiles": doc["max_profiles"], "created_at": doc["created_at"]}
+            for doc in inserted
+        ]
+    }
+
 @api_router.get("/admin/user-codes")
 async def get_all_user_codes():
     """Admin: Get all user codes"""
@@ -353,7 +1021,7 @@ class BulkDNSUpdate(BaseModel):
 
 @api_router.post("/admin/bulk-update-dns")
 async def bulk_update_dns(input: BulkDNSUpdate):
-    """Admin: Update DNS for multiple users at once"""
+    """Admin: Update DNS for multiple users at once, without validation (see /admin/dns-migrations)"""
     if not input.user_codes or len(input.user_codes) == 0:
         raise HTTPException(status_code=400, detail="No user codes provided")
     
@@ -556,7 +1224,7 @@ async def update_watch_progress(progress: WatchProgressUpdate):
     percentage = (progress.current_time / progress.duration * 100) if progress.duration > 0 else 0
     
     # Update or insert progress
-    await db.watch_progress.update_one(
+    result = await db.watch_progress.update_one(
         {
             "user_code": progress.user_code,
             "profile_name": progress.profile_name,
@@ -573,22 +1241,34 @@ async def update_watch_progress(progress: WatchProgressUpdate):
         },
         upsert=True
     )
+    if result.upserted_id is not None:
+        # Resuming an archived title: the hot entry is now the only position to keep
+        await db.watch_progress_archive.delete_one({
+            "user_code": progress.user_code,
+            "profile_name": progress.profile_name,
+            "stream_id": progress.stream_id
+        })
     
     return {"message": "Progress updated successfully", "percentage": percentage}
 
 @api_router.get("/progress/{user_code}/{profile_name}/{stream_id}")
 async def get_watch_progress(user_code: str, profile_name: str, stream_id: str):
     """Get watch progress for a specific movie/series"""
-    progress = await db.watch_progress.find_one({
+    query = {
         "user_code": user_code,
         "profile_name": profile_name,
         "stream_id": stream_id
-    })
+    }
+    # Archived entries still resume where the user stopped
+    progress = await db.watch_progress.find_one(query) \
+        or await db.watch_progress_archive.find_one(query, sort=[("last_watched", -1)])
     
     if not progress:
         return {"has_progress": False}
     
     progress.pop("_id", None)
+    progress.pop("archived_at", None)
+    progress.pop("archive_reason", None)
     progress["has_progress"] = True
     
     return progress
@@ -609,6 +1289,68 @@ async def get_all_watch_progress(user_code: str, profile_name: str):
 
 # ==================== ADMIN NOTIFICATIONS ====================
 
+# Seconds between two reloads of the active notification, picks up changes made by other workers
+NOTIFICATION_REFRESH_INTERVAL = int(os.environ.get('NOTIFICATION_REFRESH_INTERVAL', '30'))
+# Idle event streams get a comment line this often so proxies keep them open
+NOTIFICATION_KEEPALIVE = 25
+
+def public_notification(notification: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not notification:
+        return {"has_notification": False, "message": ""}
+    return {"has_notification": True, "message": notification["message"]}
+
+class NotificationHub:
+    """Active notification held in memory and pushed to every open event stream.
+
+    Streams wait on a shared event that is replaced on each change, so one
+    update wakes every connection without a queue per client.
+    """
+    
+    def __init__(self):
+        self.payload = public_notification(None)
+        self.version = 0
+        self.loaded = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+    
+    def publish(self, payload: Dict[str, Any]) -> None:
+        if self.loaded and payload == self.payload:
+            return
+        self.payload = payload
+        self.version += 1
+        self.loaded = True
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+    
+    async def refresh(self) -> None:
+        self.publish(public_notification(await db.notifications.find_one({"is_active": True})))
+    
+    async def current(self) -> Dict[str, Any]:
+        if not self.loaded:
+            await self.refresh()
+        return self.payload
+    
+    async def wait_for_change(self, version: int, timeout: float) -> bool:
+        changed = self._changed
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+notification_hub = NotificationHub()
+
+async def notification_refresh_loop():
+    """Background reload of the active notification"""
+    while True:
+        await asyncio.sleep(NOTIFICATION_REFRESH_INTERVAL)
+        try:
+            await notification_hub.refresh()
+        except Exception as e:
+            logger.error(f"Notification refresh error: {str(e)}")
+
 @api_router.post("/admin/notification")
 async def create_notification(notification: AdminNotificationCreate):
     """Admin: Create or update the notification message"""
@@ -624,6 +1366,7 @@ async def create_notification(notification: AdminNotificationCreate):
     }
     
     result = await db.notifications.insert_one(notification_dict)
+    notification_hub.publish(public_notification(notification_dict))
     
     return {
         "message": "Notification créée avec succès",
@@ -641,319 +1384,2758 @@ async def get_admin_notification():
     return {
         "has_notification": True,
         "message": notification["message"],
-        "created_at": notification.get("created_at")
+        "created_at": notification.get("created_at"),
+        "subscribers": notification_hub.subscribers
     }
 
 @api_router.get("/notification")
 async def get_notification():
     """Public: Get active notification for users"""
-    notification = await db.notifications.find_one({"is_active": True})
+    return await notification_hub.current()
+
+@api_router.get("/notification/stream")
+async def stream_notification(request: Request):
+    """Public: Server-sent events stream of the active notification, sent on connect and on every change"""
+    await notification_hub.current()
     
-    if not notification:
-        return {"has_notification": False, "message": ""}
+    async def events():
+        notification_hub.subscribers += 1
+        try:
+            version = None
+            while not await request.is_disconnected():
+                if notification_hub.version != version:
+                    version = notification_hub.version
+                    data = json.dumps(notification_hub.payload, ensure_ascii=False)
+                    yield f"id: {version}\nevent: notification\ndata: {data}\n\n"
+                elif not await notification_hub.wait_for_change(version, NOTIFICATION_KEEPALIVE):
+                    yield ": keepalive\n\n"
+        finally:
+            notification_hub.subscribers -= 1
     
-    return {
-        "has_notification": True,
-        "message": notification["message"]
-    }
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @api_router.delete("/admin/notification")
 async def delete_notification():
     """Admin: Deactivate current notification"""
     await db.notifications.update_many({}, {"$set": {"is_active": False}})
+    notification_hub.publish(public_notification(None))
     
     return {"message": "Notification désactivée"}
 
-# ==================== XTREAM CODES PROXY ROUTES ====================
+# ==================== UPSTREAM GUARD ====================
 
-@api_router.get("/xtream/info")
-async def get_xtream_info():
-    """Get Xtream Codes account info"""
-    config = await get_xtream_config()
+# Per upstream host limits
+UPSTREAM_RATE = float(os.environ.get('UPSTREAM_RATE', '20'))  # requests per second
+UPSTREAM_BURST = int(os.environ.get('UPSTREAM_BURST', '40'))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '10'))
+# Longest a request may wait for a token or a concurrency slot before failing fast
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', '10'))
+# Circuit breaker: consecutive failures before opening, seconds before probing again
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', '5'))
+UPSTREAM_RESET_TIMEOUT = float(os.environ.get('UPSTREAM_RESET_TIMEOUT', '30'))
+UPSTREAM_HALF_OPEN_PROBES = 1
+# Separate, lower per host budget for background traffic (account scans), so it never eats into user requests
+UPSTREAM_BACKGROUND_RATE = float(os.environ.get('UPSTREAM_BACKGROUND_RATE', '5'))
+UPSTREAM_BACKGROUND_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_BACKGROUND_MAX_CONCURRENCY', '3'))
+# Background work can wait longer for its turn than a user request
+UPSTREAM_BACKGROUND_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_BACKGROUND_QUEUE_TIMEOUT', '120'))
+
+XTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1',
+    'Accept': 'application/json',
+}
+
+class UpstreamUnavailable(Exception):
+    """Raised without contacting upstream when its circuit is open or its limits are exhausted"""
+
+class TokenBucket:
+    """Token bucket where waiting callers reserve future tokens, so they are served in order"""
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"]
-    }
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching Xtream info: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    async def acquire(self, max_wait: float) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        if wait > max_wait:
+            return False
+        
+        self.tokens -= 1
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
 
-@api_router.get("/xtream/live-categories")
-async def get_live_categories():
-    """Get live TV categories"""
-    config = await get_xtream_config()
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a few probe requests through once reset_timeout elapsed"""
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_live_categories"
-    }
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1',
-        'Accept': 'application/json',
-    }
+    def __init__(self, failure_threshold: int, reset_timeout: float, half_open_probes: int):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_count = 0
+        self._probes = 0
     
-    async with httpx.AsyncClient(timeout=30.0, headers=headers, follow_redirects=True) as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching live categories: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probes = 0
+        
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                return False
+            self._probes += 1
+        return True
+    
+    def release(self) -> None:
+        """Give back a probe slot for a request that never reached upstream"""
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+    
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = self.CLOSED
+    
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.open_count += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
 
-@api_router.get("/xtream/live-streams")
-async def get_live_streams(category_id: Optional[str] = None):
-    """Get live TV streams from M3U playlist with Cloudflare bypass"""
-    config = await get_xtream_config()
+class UpstreamGuard:
+    """Rate limit, concurrency limit and circuit breaker for one upstream host.
+
+    Background guards get their own limits but share the host's circuit breaker.
+    """
     
-    try:
-        import cloudscraper
+    def __init__(self, host: str, background: bool = False, breaker: Optional[CircuitBreaker] = None):
+        self.host = host
+        self.background = background
+        if background:
+            self.bucket = TokenBucket(UPSTREAM_BACKGROUND_RATE, max(1, int(UPSTREAM_BACKGROUND_RATE)))
+            self.semaphore = asyncio.Semaphore(UPSTREAM_BACKGROUND_MAX_CONCURRENCY)
+            self.queue_timeout = UPSTREAM_BACKGROUND_QUEUE_TIMEOUT
+        else:
+            self.bucket = TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST)
+            self.semaphore = asyncio.Semaphore(UPSTREAM_MAX_CONCURRENCY)
+            self.queue_timeout = UPSTREAM_QUEUE_TIMEOUT
+        self.breaker = breaker or CircuitBreaker(UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_RESET_TIMEOUT,
+                                                 UPSTREAM_HALF_OPEN_PROBES)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+    
+    @asynccontextmanager
+    async def slot(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise UpstreamUnavailable(f"Circuit open for {self.host}")
         
-        # Use M3U endpoint with cloudscraper to bypass Cloudflare
-        url = f"{config['dns_url']}/get.php"
-        params = {
-            "username": config["username"],
-            "password": config["password"],
-            "type": "m3u_plus",
-            "output": "mpegts"
-        }
+        try:
+            if not await self.bucket.acquire(self.queue_timeout):
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.breaker.release()
+            self.rejected += 1
+            raise UpstreamUnavailable(f"Too many pending requests for {self.host}")
+        except BaseException:
+            self.breaker.release()
+            raise
         
-        scraper = cloudscraper.create_scraper(
-            browser={
-                'browser': 'chrome',
-                'platform': 'windows',
-                'mobile': False
-            }
+        self.in_flight += 1
+        self.requests += 1
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "background": self.background,
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "open_count": self.breaker.open_count,
+            "tokens": round(self.bucket.tokens, 2),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected
+        }
+
+upstream_guards: Dict[tuple, UpstreamGuard] = {}
+upstream_client: Optional[httpx.AsyncClient] = None
+
+def upstream_guard(url: str, background: bool = False) -> UpstreamGuard:
+    host = urlsplit(url).netloc
+    if (host, False) not in upstream_guards:
+        upstream_guards[(host, False)] = UpstreamGuard(host)
+    if background and (host, True) not in upstream_guards:
+        upstream_guards[(host, True)] = UpstreamGuard(host, background=True, breaker=upstream_guards[(host, False)].breaker)
+    return upstream_guards[(host, background)]
+
+def get_upstream_client() -> httpx.AsyncClient:
+    """Shared HTTP client for Xtream calls, so connections are pooled and bounded"""
+    global upstream_client
+    if upstream_client is None:
+        upstream_client = httpx.AsyncClient(
+            headers=XTREAM_HEADERS,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
         )
+    return upstream_client
+
+@api_router.get("/admin/upstream/status")
+async def get_upstream_status():
+    """Admin: Get rate limiter and circuit breaker state per upstream host"""
+    return {
+        "hosts": [guard.stats() for guard in upstream_guards.values()],
+        "scrapers": [pool.stats() for pool in scraper_pools.values()]
+    }
+
+# ==================== SCRAPER SESSIONS ====================
+
+# Cloudflare-cleared cloudscraper sessions kept per upstream host
+SCRAPER_SESSIONS_PER_HOST = int(os.environ.get('SCRAPER_SESSIONS_PER_HOST', '2'))
+SCRAPER_THREADS = int(os.environ.get('SCRAPER_THREADS', '8'))
+# Healthy sessions are still rebuilt after this many seconds
+SCRAPER_SESSION_MAX_AGE = int(os.environ.get('SCRAPER_SESSION_MAX_AGE', '3600'))
+# Longest a download may take end to end, queueing for a session included
+SCRAPER_TOTAL_TIMEOUT = float(os.environ.get('SCRAPER_TOTAL_TIMEOUT', '300'))
+SCRAPER_BROWSER = {'browser': 'chrome', 'platform': 'windows', 'mobile': False}
+# Answers of a Cloudflare challenge the session could not clear
+SCRAPER_CHALLENGE_STATUSES = {403, 429, 503}
+
+scraper_executor = ThreadPoolExecutor(max_workers=SCRAPER_THREADS, thread_name_prefix="scraper")
+
+class ScraperPool:
+    """Long-lived cloudscraper sessions of one upstream host.
+
+    Sessions keep their clearance cookies from one request to the next; a
+    session that errors, gets a challenge answer or is too old is closed and
+    replaced. Blocking: only call it from scraper_executor.
+    """
+    
+    def __init__(self, host: str):
+        self.host = host
+        self._idle: List[Any] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(SCRAPER_SESSIONS_PER_HOST)
+        self.created = 0
+        self.recycled = 0
+        self.requests = 0
+    
+    def _take_session(self) -> Any:
+        import cloudscraper
         
-        response = scraper.get(url, params=params, timeout=60)
-        response.raise_for_status()
-        
-        # Parse M3U playlist
-        m3u_content = response.text
-        channels = []
-        current_channel = None
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+        if session is not None and time.monotonic() - session.created_at <= SCRAPER_SESSION_MAX_AGE:
+            return session
+        if session is not None:
+            self._discard(session)
         
-        for line in m3u_content.split('\n'):
-            line = line.strip()
+        session = cloudscraper.create_scraper(browser=SCRAPER_BROWSER)
+        session.created_at = time.monotonic()
+        with self._lock:
+            self.created += 1
+        return session
+    
+    def _discard(self, session: Any) -> None:
+        session.close()
+        with self._lock:
+            self.recycled += 1
+    
+    def get(self, url: str, params: Dict[str, Any], timeout: float) -> Any:
+        if not self._slots.acquire(timeout=SCRAPER_TOTAL_TIMEOUT):
+            raise UpstreamUnavailable(f"No scraper session available for {self.host}")
+        try:
+            session = self._take_session()
+            try:
+                response = session.get(url, params=params, timeout=timeout)
+            except Exception:
+                self._discard(session)
+                raise
             
-            if line.startswith('#EXTINF:'):
-                current_channel = {}
-                
-                import re
-                tvg_id_match = re.search(r'tvg-id="([^"]*)"', line)
-                tvg_name_match = re.search(r'tvg-name="([^"]*)"', line)
-                tvg_logo_match = re.search(r'tvg-logo="([^"]*)"', line)
-                group_title_match = re.search(r'group-title="([^"]*)"', line)
-                
-                if tvg_id_match:
-                    current_channel['stream_id'] = tvg_id_match.group(1)
-                if tvg_name_match:
-                    current_channel['name'] = tvg_name_match.group(1)
-                if tvg_logo_match:
-                    current_channel['stream_icon'] = tvg_logo_match.group(1)
-                if group_title_match:
-                    current_channel['category_id'] = group_title_match.group(1)
-                
-                if 'name' not in current_channel:
-                    name_match = re.search(r',(.+)$', line)
-                    if name_match:
-                        current_channel['name'] = name_match.group(1).strip()
+            if response.status_code in SCRAPER_CHALLENGE_STATUSES:
+                self._discard(session)
+            else:
+                with self._lock:
+                    self._idle.append(session)
+            with self._lock:
+                self.requests += 1
+            return response
+        finally:
+            self._slots.release()
+    
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            session.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "idle_sessions": len(self._idle),
+            "created": self.created,
+            "recycled": self.recycled,
+            "requests": self.requests
+        }
+
+scraper_pools: Dict[str, ScraperPool] = {}
+scraper_pools_lock = threading.Lock()
+
+def scraper_pool(url: str) -> ScraperPool:
+    host = urlsplit(url).netloc
+    with scraper_pools_lock:
+        if host not in scraper_pools:
+            scraper_pools[host] = ScraperPool(host)
+        return scraper_pools[host]
+
+async def run_scraper(function, *args) -> Any:
+    """Run a blocking scraper download on the dedicated thread pool"""
+    context = contextvars.copy_context()
+    future = asyncio.get_running_loop().run_in_executor(scraper_executor, lambda: context.run(function, *args))
+    return await asyncio.wait_for(future, SCRAPER_TOTAL_TIMEOUT)
+
+# ==================== CPU OFFLOAD ====================
+
+# Worker processes per app worker for CPU-bound decoding and indexing (0 runs them in a thread instead)
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', str(min(2, os.cpu_count() or 1))))
+
+cpu_executor: Optional[ProcessPoolExecutor] = None
+
+def get_cpu_executor() -> Optional[ProcessPoolExecutor]:
+    """Process pool started on first use; spawned, so workers never inherit the loop or client threads.
+
+    Pool functions live in cpu_tasks, which is all a worker imports.
+    """
+    global cpu_executor
+    if cpu_executor is None and CPU_POOL_WORKERS > 0:
+        cpu_executor = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return cpu_executor
+
+async def run_cpu(function, *args) -> Any:
+    """Run a module-level function with picklable arguments in the process pool.
+
+    Only worth it when the result is much cheaper to unpickle than the work
+    itself (a diff, an index, parsed M3U lines). Falls back to a thread when
+    the pool is disabled or a worker died.
+    """
+    global cpu_executor
+    executor = get_cpu_executor()
+    if executor is not None:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        except BrokenProcessPool as e:
+            logger.error(f"CPU pool broken, restarting it on next use: {str(e)}")
+            cpu_executor = None
+    return await asyncio.to_thread(function, *args)
+
+# ==================== COMPACT CATALOG ====================
+
+# Largest integer kept in a numeric column, bigger ones stay Python objects
+COMPACT_INT_MAX = 2 ** 63 - 1
+
+def canonical_int_string(value: str) -> bool:
+    """True for strings that round-trip through int() unchanged ("42", not "042" or "+4")"""
+    return value.isascii() and value.isdigit() and len(value) <= 18 and (value == "0" or value[0] != "0")
+
+class CompactCatalog(Sequence):
+    """Read-only list of catalog entries stored column by column.
+
+    Integers, floats and decimal strings (ids, ``added`` timestamps, ratings)
+    live in typed arrays, other values in lists with repeated strings shared.
+    Each row keeps the index of its key tuple, so rows come back as dicts with
+    their original keys, order and types, built only when read.
+    """
+    
+    def __init__(self, items: Any = None):
+        self.keys: List[str] = []
+        self._key_index: Dict[str, int] = {}
+        self.columns: List[Any] = []
+        self.kinds: List[str] = []  # int, float, intstr or object
+        self.shapes: List[tuple] = []
+        self._shape_index: Dict[tuple, int] = {}
+        self.row_shapes = array('I')
+        self._shape_fields: List[tuple] = []  # per shape: (key, column, stored as int string)
+        self._strings: Optional[Dict[str, str]] = {}
+        self.nbytes = 0
+        if items is not None:
+            for item in items:
+                self.append(item)
+            self.freeze()
+    
+    def __len__(self) -> int:
+        return len(self.row_shapes)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._row(position) for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("catalog index out of range")
+        return self._row(index)
+    
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self._row(position)
+    
+    def _row(self, position: int) -> Dict[str, Any]:
+        columns = self.columns
+        row = {}
+        for key, column, as_string in self._shape_fields[self.row_shapes[position]]:
+            value = columns[column][position]
+            row[key] = str(value) if as_string else value
+        return row
+    
+    def _column(self, key: str, value: Any) -> int:
+        if type(value) is int and -COMPACT_INT_MAX <= value <= COMPACT_INT_MAX:
+            kind, values = "int", array('q', bytes(8 * len(self)))
+        elif type(value) is float:
+            kind, values = "float", array('d', bytes(8 * len(self)))
+        elif type(value) is str and canonical_int_string(value):
+            kind, values = "intstr", array('q', bytes(8 * len(self)))
+        else:
+            kind, values = "object", [None] * len(self)
+        
+        column = len(self.keys)
+        self._key_index[key] = column
+        self.keys.append(key)
+        self.kinds.append(kind)
+        self.columns.append(values)
+        return column
+    
+    def _to_objects(self, column: int) -> None:
+        """Fall back to a plain list when a value does not fit the column type"""
+        kind = self.kinds[column]
+        self.columns[column] = [str(value) if kind == "intstr" else value for value in self.columns[column]]
+        self.kinds[column] = "object"
+    
+    def append(self, item: Dict[str, Any]) -> None:
+        """Add a row; only valid while building, before freeze()"""
+        columns, kinds, strings = self.columns, self.kinds, self._strings
+        shape = []
+        for key, value in item.items():
+            column = self._key_index.get(key)
+            if column is None:
+                column = self._column(key, value)
+            kind = kinds[column]
+            value_type = type(value)
+            if kind == "object":
+                pass
+            elif kind == "intstr" and value_type is str and canonical_int_string(value):
+                value = int(value)
+            elif kind == "int" and value_type is int and -COMPACT_INT_MAX <= value <= COMPACT_INT_MAX:
+                pass
+            elif kind == "float" and value_type is float:
+                pass
+            else:
+                self._to_objects(column)
+            if value_type is str and kinds[column] == "object":
+                value = strings.setdefault(value, value)
+            columns[column].append(value)
+            shape.append(column)
+        
+        # Columns the row does not have keep a placeholder so positions stay aligned
+        if len(shape) != len(columns):
+            filled = set(shape)
+            for column, values in enumerate(columns):
+                if column not in filled:
+                    values.append(None if kinds[column] == "object" else 0)
+        
+        shape = tuple(shape)
+        shape_id = self._shape_index.get(shape)
+        if shape_id is None:
+            shape_id = self._shape_index[shape] = len(self.shapes)
+            self.shapes.append(shape)
+        self.row_shapes.append(shape_id)
+    
+    def extend(self, items) -> None:
+        for item in items:
+            self.append(item)
+    
+    def freeze(self) -> None:
+        """Drop the build-time lookup tables and measure the footprint"""
+        self._strings = None
+        self._shape_fields = [
+            tuple((self.keys[column], column, self.kinds[column] == "intstr") for column in shape)
+            for shape in self.shapes
+        ]
+        size = self.row_shapes.itemsize * len(self.row_shapes)
+        seen = set()
+        for values in self.columns:
+            if isinstance(values, array):
+                size += values.itemsize * len(values)
+                continue
+            size += sys.getsizeof(values)
+            for value in values:
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+        self.nbytes = size
+    
+    def to_json(self, rewrite=None) -> bytes:
+        """Encode as a JSON array one row at a time, like JSONResponse does for a list.
+
+        ``rewrite`` maps each row before encoding (e.g. rewrite_image_fields).
+        """
+        encode = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode
+        rows = map(rewrite, self) if rewrite else self
+        return ("[" + ",".join(encode(row) for row in rows) + "]").encode('utf-8')
+
+async def catalog_response(items: Any) -> Any:
+    """Response for a catalog list with proxied image URLs.
+
+    Compact catalogs skip the list-of-dicts encoding path and are encoded in a
+    thread, so a large catalog does not hold the event loop.
+    """
+    if isinstance(items, CompactCatalog):
+        rewrite = rewrite_image_fields if IMAGE_PROXY_BASE_URL else None
+        return Response(content=await asyncio.to_thread(items.to_json, rewrite), media_type="application/json")
+    return rewrite_catalog_images(items)
+
+# ==================== CACHES ====================
+
+class ByteLRUCache:
+    """LRU cache bounded by the approximate JSON size of its values, with a TTL per entry"""
+    
+    def __init__(self, name: str, max_bytes: int, ttl: float):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()  # key -> (value, size, expires_at)
+    
+    def get(self, key: Any, allow_stale: bool = False) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        value, size, expires_at = entry
+        if expires_at <= time.monotonic() and not allow_stale:
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: Any, value: Any, size: Optional[int] = None, ttl: Optional[float] = None) -> None:
+        if size is None:
+            size = value.nbytes if isinstance(value, CompactCatalog) else len(json.dumps(value, separators=(',', ':'), default=str))
+        if size > self.max_bytes:
+            return
+        
+        self.pop(key)
+        self._entries[key] = (value, size, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.current_bytes += size
+        
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+    
+    def pop(self, key: Any) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+    
+    def peek(self, key: Any) -> Any:
+        """Get an entry even if expired, without touching LRU order or stats"""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+    
+    def is_fresh(self, key: Any) -> bool:
+        """Check for a non-expired entry without touching LRU order or stats"""
+        entry = self._entries.get(key)
+        return entry is not None and entry[2] > time.monotonic()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# Second tier shared by every worker: the cache_entries collection, expired by a TTL index
+SHARED_CACHE_ENABLED = os.environ.get('SHARED_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Bump when the format of cached payloads changes, older shared entries are then ignored
+SHARED_CACHE_KEY_VERSION = 1
+# Compressed values above this stay in L1 only (BSON documents are capped at 16MB)
+SHARED_CACHE_MAX_BYTES = 12 * 1024 * 1024
+SHARED_CACHE_COMPRESSION_LEVEL = 6
+
+CACHE_LOOKUPS = metrics.counter(
+    "iptv_cache_lookups_total", "Tiered cache lookups by cache, tier (l1 in-process, l2 shared) and result",
+    ("cache", "tier", "result"))
+
+def encode_shared_value(value: Any) -> tuple:
+    """JSON encode and compress a value, returns (compressed, uncompressed size)"""
+    if isinstance(value, CompactCatalog):
+        payload = value.to_json()
+    else:
+        payload = json.dumps(value, separators=(',', ':'), default=str).encode('utf-8')
+    return zlib.compress(payload, SHARED_CACHE_COMPRESSION_LEVEL), len(payload)
+
+def decode_shared_value(compressed: bytes) -> Any:
+    return json.loads(zlib.decompress(compressed))
+
+class TieredCache:
+    """In-process ByteLRUCache (L1) in front of the shared cache_entries collection (L2).
+
+    With ``compact``, lists read from L2 are kept in L1 as CompactCatalog.
+    """
+    
+    def __init__(self, l1: ByteLRUCache, compact: bool = False):
+        self.l1 = l1
+        self.compact = compact
+        self.name = l1.name
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+    
+    def shared_key(self, key: Any) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return f"v{SHARED_CACHE_KEY_VERSION}:{self.name}:" + ":".join(str(part) for part in parts)
+    
+    async def get(self, key: Any) -> Any:
+        value = self.l1.get(key)
+        if value is not None:
+            CACHE_LOOKUPS.inc(cache=self.name, tier="l1", result="hit")
+            return value
+        CACHE_LOOKUPS.inc(cache=self.name, tier="l1", result="miss")
+        if not SHARED_CACHE_ENABLED:
+            return None
+        
+        now = datetime.utcnow()
+        try:
+            # The TTL monitor only runs every minute, so expired entries may still be there
+            doc = await db.cache_entries.find_one({"_id": self.shared_key(key), "expires_at": {"$gt": now}})
+            value = await asyncio.to_thread(decode_shared_value, doc["value"]) if doc else None
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Shared cache read failed for {self.name}: {str(e)}")
+            return None
+        
+        if value is None:
+            self.l2_misses += 1
+            CACHE_LOOKUPS.inc(cache=self.name, tier="l2", result="miss")
+            return None
+        
+        self.l2_hits += 1
+        CACHE_LOOKUPS.inc(cache=self.name, tier="l2", result="hit")
+        size = doc["size"]
+        if self.compact and isinstance(value, list):
+            value = await asyncio.to_thread(CompactCatalog, value)
+            size = None
+        self.l1.set(key, value, size=size, ttl=(doc["expires_at"] - now).total_seconds())
+        return value
+    
+    async def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.l1.ttl if ttl is None else ttl
+        if not SHARED_CACHE_ENABLED:
+            self.l1.set(key, value, ttl=ttl)
+            return
+        
+        compressed, size = await asyncio.to_thread(encode_shared_value, value)
+        self.l1.set(key, value, size=None if isinstance(value, CompactCatalog) else size, ttl=ttl)
+        if len(compressed) > SHARED_CACHE_MAX_BYTES:
+            return
+        
+        shared_key = self.shared_key(key)
+        try:
+            await db.cache_entries.replace_one(
+                {"_id": shared_key},
+                {
+                    "_id": shared_key,
+                    "cache": self.name,
+                    "value": compressed,
+                    "size": size,
+                    "expires_at": datetime.utcnow() + timedelta(seconds=ttl)
+                },
+                upsert=True
+            )
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Shared cache write failed for {self.name}: {str(e)}")
+    
+    def is_fresh(self, key: Any) -> bool:
+        return self.l1.is_fresh(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.l1.stats(),
+            "l2_enabled": SHARED_CACHE_ENABLED,
+            "l2_hits": self.l2_hits,
+            "l2_misses": self.l2_misses,
+            "l2_errors": self.l2_errors
+        }
+
+# Last good player_api answers, only read when upstream fails
+UPSTREAM_STALE_CACHE_BYTES = int(os.environ.get('UPSTREAM_STALE_CACHE_BYTES', str(128 * 1024 * 1024)))
+upstream_stale_cache = ByteLRUCache("upstream_stale", UPSTREAM_STALE_CACHE_BYTES, 24 * 3600)
+
+# Per-title responses (get_vod_info / get_series_info)
+TITLE_INFO_CACHE_BYTES = int(os.environ.get('TITLE_INFO_CACHE_BYTES', str(64 * 1024 * 1024)))
+TITLE_INFO_CACHE_TTL = int(os.environ.get('TITLE_INFO_CACHE_TTL', '21600'))
+title_info_cache = TieredCache(ByteLRUCache("title_info", TITLE_INFO_CACHE_BYTES, TITLE_INFO_CACHE_TTL))
+
+# Catalog lists read from the local store, keyed by catalog version so a sync never serves stale lists
+CATALOG_CACHE_BYTES = int(os.environ.get('CATALOG_CACHE_BYTES', str(256 * 1024 * 1024)))
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', '3600'))
+catalog_cache = TieredCache(ByteLRUCache("catalog", CATALOG_CACHE_BYTES, CATALOG_CACHE_TTL), compact=True)
+
+# Live / VOD / series category lists
+CATEGORY_CACHE_TTL = int(os.environ.get('CATEGORY_CACHE_TTL', '600'))
+category_cache = TieredCache(ByteLRUCache("categories", 16 * 1024 * 1024, CATEGORY_CACHE_TTL))
+
+# Short EPG and now / next snapshots per stream
+EPG_CACHE_BYTES = int(os.environ.get('EPG_CACHE_BYTES', str(32 * 1024 * 1024)))
+EPG_CACHE_TTL = int(os.environ.get('EPG_CACHE_TTL', '300'))
+EPG_NOW_NEXT_TTL = 60  # the progress percentage goes stale quickly
+epg_cache = TieredCache(ByteLRUCache("epg", EPG_CACHE_BYTES, EPG_CACHE_TTL))
+
+# Upstream action and id parameter for each kind of per-title info
+TITLE_INFO_ACTIONS = {
+    "vod": ("get_vod_info", "vod_id"),
+    "series": ("get_series_info", "series_id"),
+}
+
+# Detail page opens since the last prefetch cycle, keyed by (kind, title_id)
+title_opens: Counter = Counter()
+
+def record_title_open(kind: str, title_id: str, info: Any) -> None:
+    """Count a detail page open, only for ids upstream knows so unknown ids never get prefetched"""
+    if isinstance(info, dict) and info:
+        title_opens[(kind, str(title_id))] += 1
+
+async def get_title_info(config: Dict[str, Any], kind: str, title_id: str) -> Any:
+    """Get per-title info through the in-process and shared caches"""
+    key = (config["id"], kind, str(title_id))
+    cached = await title_info_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    action, id_param = TITLE_INFO_ACTIONS[kind]
+    try:
+        info = await fetch_player_api(config, action, **{id_param: title_id})
+    except (UpstreamUnavailable, httpx.HTTPError):
+        # The lookup above already counted the miss
+        stale = title_info_cache.l1.peek(key)
+        if stale is None:
+            raise
+        return stale
+    
+    # Unknown ids come back as an empty list or dict, don't keep those
+    if isinstance(info, dict) and info:
+        await title_info_cache.set(key, info)
+    return info
+
+async def get_categories(config: Dict[str, Any], action: str) -> Any:
+    """Get a category list through the in-process and shared caches"""
+    key = (config["id"], action)
+    cached = await category_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    categories = await fetch_player_api(config, action, stale_fallback=True)
+    if isinstance(categories, list) and categories:
+        await category_cache.set(key, categories)
+    return categories
+
+# ==================== TITLE INFO PREFETCH ====================
+
+# Interval between prefetch cycles in seconds (0 disables the prefetcher)
+TITLE_PREFETCH_INTERVAL = int(os.environ.get('TITLE_PREFETCH_INTERVAL', '900'))
+TITLE_PREFETCH_LIMIT = int(os.environ.get('TITLE_PREFETCH_LIMIT', '200'))
+TITLE_PREFETCH_WINDOW_DAYS = int(os.environ.get('TITLE_PREFETCH_WINDOW_DAYS', '7'))
+TITLE_PREFETCH_CONCURRENCY = 4
+
+# watch_progress / watchlist stream_type -> title info kind
+STREAM_TYPE_KINDS = {"movie": "vod", "series": "series"}
+
+async def popular_titles(limit: int) -> List[tuple]:
+    """Rank titles by recent detail opens, recent watch progress and watchlist adds"""
+    scores = Counter(title_opens)
+    
+    since = datetime.utcnow() - timedelta(days=TITLE_PREFETCH_WINDOW_DAYS)
+    sources = [
+        (db.watch_progress, {"last_watched": {"$gte": since}}),
+        (db.watchlist, {}),
+    ]
+    for collection, match in sources:
+        pipeline = [
+            {"$match": {**match, "stream_type": {"$in": list(STREAM_TYPE_KINDS)}}},
+            {"$group": {"_id": {"stream_type": "$stream_type", "stream_id": "$stream_id"}, "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": limit}
+        ]
+        async for doc in collection.aggregate(pipeline):
+            kind = STREAM_TYPE_KINDS[doc["_id"]["stream_type"]]
+            scores[(kind, str(doc["_id"]["stream_id"]))] += doc["count"]
+    
+    return [title for title, _ in scores.most_common(limit)]
+
+async def prefetch_popular_titles() -> int:
+    """Warm the title info cache for the most popular titles, returns the number fetched"""
+    config = await db.xtream_config.find_one({"is_active": True})
+    if not config:
+        return 0
+    
+    titles = await popular_titles(TITLE_PREFETCH_LIMIT)
+    missing = [(kind, title_id) for kind, title_id in titles
+               if not title_info_cache.is_fresh((config["id"], kind, title_id))]
+    
+    semaphore = asyncio.Semaphore(TITLE_PREFETCH_CONCURRENCY)
+    
+    async def prefetch(kind: str, title_id: str) -> bool:
+        async with semaphore:
+            try:
+                await get_title_info(config, kind, title_id)
+                return True
+            except Exception as e:
+                logger.error(f"Error prefetching {kind} info {title_id}: {str(e)}")
+                return False
+    
+    results = await asyncio.gather(*(prefetch(kind, title_id) for kind, title_id in missing))
+    
+    # Halve open counts so popularity follows recent demand
+    for title, count in list(title_opens.items()):
+        if count // 2:
+            title_opens[title] = count // 2
+        else:
+            del title_opens[title]
+    
+    fetched = sum(results)
+    if fetched:
+        logger.info(f"Prefetched info for {fetched}/{len(titles)} popular titles")
+    return fetched
+
+async def title_prefetch_loop():
+    """Background scheduler for the popular titles prefetcher"""
+    while True:
+        await asyncio.sleep(TITLE_PREFETCH_INTERVAL)
+        try:
+            await prefetch_popular_titles()
+        except Exception as e:
+            logger.error(f"Title prefetch loop error: {str(e)}")
+
+@api_router.get("/admin/cache/stats")
+async def get_cache_stats():
+    """Admin: Get in-process cache statistics"""
+    return {
+        "caches": [cache.stats() for cache in (title_info_cache, catalog_cache, category_cache, epg_cache,
+                                               upstream_stale_cache, image_cache, playlist_cache)],
+        "epg_index": epg_index.stats()
+    }
+
+# ==================== IMAGE PROXY ====================
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, variants are then served at original size
+    Image = None
+
+IMAGE_CACHE_DIR = Path(os.environ.get('IMAGE_CACHE_DIR', str(ROOT_DIR / 'image_cache')))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+IMAGE_MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+IMAGE_CACHE_MAX_AGE = 30 * 24 * 3600
+# Public URL of the image endpoint (e.g. https://host/api/images); catalog image URLs are rewritten when set
+IMAGE_PROXY_BASE_URL = os.environ.get('IMAGE_PROXY_BASE_URL', '').rstrip('/')
+# Key signing proxied image URLs, so the endpoint only fetches URLs we handed out.
+# Read from app_settings at startup when unset, so every worker shares it
+IMAGE_PROXY_SECRET = os.environ.get('IMAGE_PROXY_SECRET', '')
+
+# Bounding box of each resized variant
+IMAGE_VARIANTS = {
+    "thumb": (342, 513),
+    "backdrop": (1280, 720),
+}
+
+# Catalog fields holding image URLs and the variant they are displayed at
+CATALOG_IMAGE_FIELDS = {"stream_icon": "thumb", "cover": "thumb", "movie_image": "thumb", "cover_big": "backdrop"}
+IMAGE_READ_CHUNK = 64 * 1024
+ENTITY_TAG_RE = re.compile(r'(?:W/)?"[^"]*"|\*')
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check: comma separated entity tags, weak comparison, ``*`` matches any"""
+    for tag in ENTITY_TAG_RE.findall(if_none_match or ""):
+        if tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
+class ImageDiskCache:
+    """Content-addressed image store with size-based eviction of least recently used files.
+
+    ``urls/<sha1(url)>`` holds the sha256 of the downloaded image, stored once
+    in ``blobs/<sha256>``; resized variants sit next to it as ``<sha256>.<variant>``.
+    """
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._total_bytes: Optional[int] = None
+        # store() and variant() run in worker threads
+        self._size_lock = threading.Lock()
+        self._locks: Dict[str, list] = {}  # url -> [lock, holders and waiters]
+        (root / "urls").mkdir(parents=True, exist_ok=True)
+        (root / "blobs").mkdir(parents=True, exist_ok=True)
+    
+    def _url_path(self, url: str) -> Path:
+        return self.root / "urls" / hashlib.sha1(url.encode('utf-8')).hexdigest()
+    
+    def blob_path(self, digest: str, variant: str = "original") -> Path:
+        name = digest if variant == "original" else f"{digest}.{variant}"
+        return self.root / "blobs" / name
+    
+    def lookup(self, url: str) -> Optional[str]:
+        url_path = self._url_path(url)
+        try:
+            digest = url_path.read_text().strip()
+        except FileNotFoundError:
+            return None
+        if self.blob_path(digest).exists():
+            return digest
+        # The blob was evicted, drop the index entry with it
+        url_path.unlink(missing_ok=True)
+        return None
+    
+    def _write(self, path: Path, data: bytes) -> None:
+        tmp_path = path.with_name(path.name + f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        with self._size_lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(data)
+    
+    def store(self, url: str, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.blob_path(digest).exists():
+            self._write(self.blob_path(digest), data)
+        self._write(self._url_path(url), digest.encode('ascii'))
+        self._evict(keep=self.blob_path(digest))
+        return digest
+    
+    def variant(self, digest: str, variant: str) -> Path:
+        """Path of a resized variant, building it on first use (blocking)"""
+        path = self.blob_path(digest, variant)
+        if path.exists() or Image is None:
+            return path if path.exists() else self.blob_path(digest)
+        
+        with Image.open(self.blob_path(digest)) as image:
+            image.thumbnail(IMAGE_VARIANTS[variant])
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(output, format="PNG", optimize=True)
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=80, optimize=True)
+        self._write(path, output.getvalue())
+        self._evict(keep=path)
+        return path
+    
+    def touch(self, path: Path) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    
+    def open_image(self, digest: str, variant: str) -> Optional[tuple]:
+        """(open file, size, media type) of an image to serve, or None once evicted (blocking).
+
+        The open file stays readable if eviction removes its path afterwards.
+        """
+        path = self.blob_path(digest)
+        if variant != "original":
+            try:
+                path = self.variant(digest, variant)
+            except FileNotFoundError:
+                return None
+            except Exception as e:
+                logger.error(f"Error resizing image {digest} to {variant}: {str(e)}")
+        try:
+            image = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        self.touch(path)
+        media_type = image_media_type(image.read(12))
+        image.seek(0)
+        return image, os.fstat(image.fileno()).st_size, media_type
+    
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        """Drop least recently served blobs, never ``keep`` (the file about to be served)"""
+        with self._size_lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(f.stat().st_size for f in (self.root / "blobs").iterdir())
+            if self._total_bytes <= self.max_bytes:
+                return
             
-            elif line and not line.startswith('#') and current_channel:
-                current_channel['stream_url'] = line
-                
-                if 'stream_id' not in current_channel:
-                    import re
-                    id_match = re.search(r'/(\d+)\.', line)
-                    if id_match:
-                        current_channel['stream_id'] = int(id_match.group(1))
-                
-                if 'stream_id' not in current_channel:
-                    current_channel['stream_id'] = len(channels) + 1
-                if 'category_id' not in current_channel:
-                    current_channel['category_id'] = ''
-                
-                channels.append(current_channel)
-                current_channel = None
+            files = sorted((self.root / "blobs").iterdir(), key=lambda f: f.stat().st_mtime)
+            target = self.max_bytes * 0.9
+            for path in files:
+                if self._total_bytes <= target:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    size = path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                self._total_bytes -= size
+                self.evictions += 1
         
-        logger.info(f"Successfully parsed {len(channels)} channels from M3U")
+        self._prune_urls()
+    
+    def _prune_urls(self) -> None:
+        """Remove url index entries whose blob was evicted"""
+        for url_path in (self.root / "urls").iterdir():
+            try:
+                digest = url_path.read_text().strip()
+            except (FileNotFoundError, UnicodeDecodeError):
+                continue
+            if not self.blob_path(digest).exists():
+                url_path.unlink(missing_ok=True)
+    
+    @asynccontextmanager
+    async def download_lock(self, url: str):
+        """One download per URL; the lock is dropped once nobody holds or waits for it"""
+        entry = self._locks.setdefault(url, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(url, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": "images",
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+image_cache = ImageDiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+def image_url_signature(url: str) -> str:
+    return hmac.new(IMAGE_PROXY_SECRET.encode('utf-8'), url.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+async def load_image_proxy_secret() -> None:
+    """Share one signing key between workers through app_settings when none is configured"""
+    global IMAGE_PROXY_SECRET
+    if IMAGE_PROXY_SECRET:
+        return
+    doc = await db.app_settings.find_one_and_update(
+        {"_id": "image_proxy"},
+        {"$setOnInsert": {"secret": secrets.token_hex(32)}},
+        upsert=True,
+        return_document=True
+    )
+    IMAGE_PROXY_SECRET = doc["secret"]
+
+async def download_image(url: str) -> bytes:
+    """Download an upstream image, refusing non-images and oversized files"""
+    async with httpx.AsyncClient(timeout=20.0, follow_redirects=True) as client:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            if not response.headers.get("content-type", "").startswith("image/"):
+                raise ValueError(f"Not an image: {response.headers.get('content-type')}")
+            
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > IMAGE_MAX_DOWNLOAD_BYTES:
+                    raise ValueError("Image too large")
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+def image_media_type(header: bytes) -> str:
+    """Media type of a cached image, sniffed from its first 12 bytes"""
+    if header.startswith(b"\x89PNG"):
+        return "image/png"
+    if header.startswith(b"GIF8"):
+        return "image/gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+def proxy_image_url(url: Any, variant: str) -> Any:
+    """Point an upstream image URL at the image proxy"""
+    if not IMAGE_PROXY_BASE_URL or not IMAGE_PROXY_SECRET or not isinstance(url, str) \
+            or not url.startswith(("http://", "https://")):
+        return url
+    return f"{IMAGE_PROXY_BASE_URL}?{urlencode({'url': url, 'variant': variant, 'sig': image_url_signature(url)})}"
+
+def rewrite_image_fields(item: Any) -> Any:
+    """Copy of a catalog entry (or info payload) with its image URLs proxied"""
+    if not IMAGE_PROXY_BASE_URL or not isinstance(item, dict):
+        return item
+    
+    rewritten = dict(item)
+    for field, variant in CATALOG_IMAGE_FIELDS.items():
+        if field in rewritten:
+            rewritten[field] = proxy_image_url(rewritten[field], variant)
+    if isinstance(rewritten.get("backdrop_path"), list):
+        rewritten["backdrop_path"] = [proxy_image_url(url, "backdrop") for url in rewritten["backdrop_path"]]
+    if isinstance(rewritten.get("info"), dict):
+        rewritten["info"] = rewrite_image_fields(rewritten["info"])
+    return rewritten
+
+def rewrite_catalog_images(items: Any) -> Any:
+    if not IMAGE_PROXY_BASE_URL or not isinstance(items, (list, CompactCatalog)):
+        return items
+    return [rewrite_image_fields(item) for item in items]
+
+async def cached_image(url: str) -> str:
+    """Digest of a cached image, downloaded once per URL on a miss"""
+    digest = await asyncio.to_thread(image_cache.lookup, url)
+    if digest:
+        image_cache.hits += 1
+        return digest
+    
+    async with image_cache.download_lock(url):
+        digest = await asyncio.to_thread(image_cache.lookup, url)
+        if digest:
+            return digest
+        image_cache.misses += 1
+        try:
+            data = await download_image(url)
+        except Exception as e:
+            logger.error(f"Error fetching image {url}: {str(e)}")
+            raise HTTPException(status_code=502, detail="Image unavailable")
+        return await asyncio.to_thread(image_cache.store, url, data)
+
+def read_image(image):
+    """Yield an open image file in chunks and close it; iterated in Starlette's thread pool"""
+    with image:
+        while chunk := image.read(IMAGE_READ_CHUNK):
+            yield chunk
+
+@api_router.get("/images")
+async def get_image(request: Request, url: str, variant: str = "original", sig: str = ""):
+    """Serve an upstream poster or logo from the disk cache, optionally resized.
+
+    Only URLs signed by proxy_image_url are fetched, so the endpoint cannot be
+    used to reach arbitrary hosts.
+    """
+    if variant != "original" and variant not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=400, detail="Invalid image variant")
+    if not url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="Invalid image URL")
+    if not IMAGE_PROXY_SECRET or not hmac.compare_digest(sig, image_url_signature(url)):
+        raise HTTPException(status_code=403, detail="Invalid image signature")
+    
+    digest = await cached_image(url)
+    headers = {
+        "ETag": f'"{digest}-{variant}"',
+        "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    opened = await asyncio.to_thread(image_cache.open_image, digest, variant)
+    if opened is None:
+        # Evicted since the lookup: the next lookup misses and downloads it again
+        digest = await cached_image(url)
+        opened = await asyncio.to_thread(image_cache.open_image, digest, variant)
+        if opened is None:
+            raise HTTPException(status_code=503, detail="Image cache is full, try again")
+    
+    image, size, media_type = opened
+    return StreamingResponse(read_image(image), media_type=media_type,
+                             headers={**headers, "Content-Length": str(size)})
+
+# ==================== LEASES ====================
+
+# Seconds a lease survives without renewal; holders renew it every third of that
+LEASE_TTL = int(os.environ.get('LEASE_TTL', '60'))
+
+# Identifies this process among the uvicorn workers sharing the database
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def acquire_lease(name: str, owner: str = WORKER_ID, ttl: int = LEASE_TTL) -> bool:
+    """Take or renew the named lease, unless another owner holds an unexpired one"""
+    now = datetime.utcnow()
+    try:
+        lease = await db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl), "renewed_at": now}},
+            upsert=True,
+            return_document=True
+        )
+    except DuplicateKeyError:
+        # The lease exists and is held: the filter missed, the upsert collided
+        return False
+    return lease is not None and lease.get("owner") == owner
+
+async def release_lease(name: str, owner: str = WORKER_ID) -> None:
+    await db.leases.delete_one({"_id": name, "owner": owner})
+
+async def lease_owner(name: str) -> Optional[str]:
+    """Current holder of an unexpired lease, if any"""
+    lease = await db.leases.find_one({"_id": name, "expires_at": {"$gt": datetime.utcnow()}})
+    return lease["owner"] if lease else None
+
+async def renew_lease(name: str, owner: str, on_renew=None) -> None:
+    """Keep a lease alive until cancelled"""
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        try:
+            if not await acquire_lease(name, owner):
+                logger.warning(f"Lease {name} was lost by {owner}")
+            elif on_renew:
+                await on_renew()
+        except Exception as e:
+            logger.error(f"Lease {name} renewal error: {str(e)}")
+
+async def claim_schedule(name: str, interval: int) -> bool:
+    """Claim the current run of a periodic task, so each interval runs in one worker only"""
+    now = datetime.utcnow()
+    try:
+        await db.leases.find_one_and_update(
+            {"_id": f"schedule:{name}", "next_run_at": {"$lte": now}},
+            {"$set": {"next_run_at": now + timedelta(seconds=interval), "owner": WORKER_ID}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Already claimed for this interval
+        return False
+    return True
+
+@asynccontextmanager
+async def hold_lease(name: str, owner: str = WORKER_ID):
+    """Yield whether the lease was taken; it is renewed while held and released on exit"""
+    if not await acquire_lease(name, owner):
+        yield False
+        return
+    renewal = asyncio.create_task(renew_lease(name, owner))
+    try:
+        yield True
+    finally:
+        renewal.cancel()
+        await asyncio.shield(release_lease(name, owner))
+
+# ==================== CATALOG SYNC ====================
+
+# Interval between two background syncs, in seconds (0 disables the scheduler)
+CATALOG_SYNC_INTERVAL = int(os.environ.get('CATALOG_SYNC_INTERVAL', '3600'))
+CATALOG_BULK_BATCH_SIZE = 1000
+# Removed entries are kept as tombstones for this many versions so clients can sync deltas
+CATALOG_TOMBSTONE_VERSIONS = int(os.environ.get('CATALOG_TOMBSTONE_VERSIONS', '50'))
+
+# Upstream action for each catalog kind, identifiers are in cpu_tasks.CATALOG_ID_FIELDS
+CATALOG_KINDS = {
+    "live": {"action": None},
+    "vod": {"action": "get_vod_streams"},
+    "series": {"action": "get_series"},
+}
+
+catalog_sync_lock = asyncio.Lock()
+
+async def fetch_catalog(config: Dict[str, Any], kind: str) -> Any:
+    """Fetch a full catalog from upstream, undecoded: M3U text for live, JSON bytes otherwise"""
+    if kind == "live":
+        async with upstream_guard(config['dns_url']).slot(), track_upstream("m3u"):
+            return await run_scraper(download_m3u, config)
+    return await fetch_player_api(config, CATALOG_KINDS[kind]["action"], timeout=60.0, raw=True)
+
+async def reserve_catalog_version(account_id: str) -> int:
+    """Atomically allocate the next catalog version for an account.
+
+    Only ``reserved_version`` moves: ``version``, which clients see, is set once
+    every entry of the new version is written.
+    """
+    state = await db.catalog_state.find_one({"account_id": account_id}, {"_id": 0, "version": 1})
+    # States written before reservations existed only have a version
+    await db.catalog_state.update_one(
+        {"account_id": account_id},
+        {"$max": {"reserved_version": (state or {}).get("version", 0)}},
+        upsert=True
+    )
+    state = await db.catalog_state.find_one_and_update(
+        {"account_id": account_id},
+        {"$inc": {"reserved_version": 1}},
+        return_document=True
+    )
+    return state["reserved_version"]
+
+async def load_catalog_snapshot(account_id: str, kind: str) -> Dict[str, tuple]:
+    """item_id -> (hash, position) of the stored entries of a kind"""
+    previous = {}
+    cursor = db.catalog_items.find(
+        {"account_id": account_id, "kind": kind, "removed": False},
+        {"_id": 0, "item_id": 1, "hash": 1, "position": 1}
+    )
+    async for doc in cursor:
+        previous[doc["item_id"]] = (doc["hash"], doc.get("position"))
+    return previous
+
+async def apply_catalog_diff(account_id: str, kind: str, diff: Dict[str, Any], version: Optional[int],
+                             category_names: Dict[str, str]) -> None:
+    """Write a catalog diff with unordered bulk upserts"""
+    now = datetime.utcnow()
+    base_filter = {"account_id": account_id, "kind": kind}
+    operations = []
+    
+    for item_id, digest, item, position, is_new in diff["changed"]:
+        update = {
+            "hash": digest,
+            "data": item,
+            "category_id": str(item.get("category_id") or ""),
+            "child_safe": is_child_safe(item, category_names),
+            "position": position,
+            "version": version,
+            "removed": False,
+            "updated_at": now
+        }
+        if is_new:
+            # Also covers entries coming back after a removal
+            update["added_version"] = version
+        operations.append(UpdateOne({**base_filter, "item_id": item_id}, {"$set": update}, upsert=True))
+    
+    # Reordered entries get the new version too, so deltas carry their new position
+    for item_id, position in diff["moved"]:
+        operations.append(UpdateOne(
+            {**base_filter, "item_id": item_id},
+            {"$set": {"position": position, "version": version, "updated_at": now}}
+        ))
+    
+    removed = diff["removed"]
+    for start in range(0, len(removed), CATALOG_BULK_BATCH_SIZE):
+        operations.append(UpdateMany(
+            {**base_filter, "item_id": {"$in": removed[start:start + CATALOG_BULK_BATCH_SIZE]}},
+            {"$set": {"removed": True, "version": version, "updated_at": now}, "$unset": {"data": "", "hash": ""}}
+        ))
+    
+    for start in range(0, len(operations), CATALOG_BULK_BATCH_SIZE):
+        await db.catalog_items.bulk_write(operations[start:start + CATALOG_BULK_BATCH_SIZE], ordered=False)
+
+async def sync_account_catalog(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Sync live, VOD and series catalogs of one account into the local store"""
+    account_id = config["id"]
+    now = datetime.utcnow()
+    diffs = {}
+    summary = {"account_id": account_id, "kinds": {}}
+    
+    async def fetch_and_diff(kind: str) -> Dict[str, Any]:
+        payload, previous = await asyncio.gather(fetch_catalog(config, kind), load_catalog_snapshot(account_id, kind))
+        return await run_cpu(diff_catalog, kind, payload, previous)
+    
+    # Each kind is decoded and diffed in its own worker process
+    results, names = await asyncio.gather(
+        asyncio.gather(*(fetch_and_diff(kind) for kind in CATALOG_KINDS), return_exceptions=True),
+        asyncio.gather(*(get_category_names(config, kind) for kind in CATALOG_KINDS))
+    )
+    category_names = dict(zip(CATALOG_KINDS, names))
+    
+    for kind, diff in zip(CATALOG_KINDS, results):
+        if isinstance(diff, Exception):
+            logger.error(f"Catalog sync: failed to fetch {kind} for account {account_id}: {diff}")
+            summary["kinds"][kind] = {"error": str(diff)}
+            continue
+        
+        if diff["count"] == 0 and diff["previous_count"] > 0:
+            # An empty answer from a panel that had content is an outage, not a purge
+            logger.warning(f"Catalog sync: empty {kind} catalog for account {account_id}, keeping previous snapshot")
+            summary["kinds"][kind] = {"error": "empty catalog returned by upstream"}
+            continue
+        diffs[kind] = diff
+    
+    # New and changed entries get their flag while written; a rule or category rename needs a full pass
+    child_rules = child_rules_signature(category_names)
+    state = await db.catalog_state.find_one({"account_id": account_id}, {"_id": 0, "child_rules": 1})
+    rules_changed = not state or state.get("child_rules") != child_rules
+    
+    has_changes = any(diff["changed"] or diff["removed"] or diff["moved"] for diff in diffs.values())
+    if has_changes or rules_changed:
+        version = await reserve_catalog_version(account_id)
+    else:
+        state = await db.catalog_state.find_one({"account_id": account_id}) or {}
+        # A sync that died after writing leaves a reserved version behind, its entries are in the store
+        version = max(state.get("version", 0), state.get("reserved_version", 0))
+    
+    # Published last, in the same update as synced_at, so a version is never visible half-written
+    state_update = {"synced_at": now, "version": version}
+    for kind, diff in diffs.items():
+        await apply_catalog_diff(account_id, kind, diff, version, category_names[kind])
+        kind_summary = {
+            "count": diff["count"],
+            "added": sum(1 for change in diff["changed"] if change[4]),
+            "updated": sum(1 for change in diff["changed"] if not change[4]),
+            "moved": len(diff["moved"]),
+            "removed": len(diff["removed"]),
+            "synced_at": now
+        }
+        summary["kinds"][kind] = kind_summary
+        state_update[f"kinds.{kind}"] = {"count": diff["count"], "synced_at": now, "error": None}
+    
+    for kind, kind_summary in summary["kinds"].items():
+        if "error" in kind_summary:
+            state_update[f"kinds.{kind}.error"] = kind_summary["error"]
+    
+    if rules_changed:
+        flips = {kind: await recompute_child_safe(account_id, kind, category_names[kind], version)
+                 for kind in CATALOG_KINDS}
+        logger.info(f"Catalog sync: child-safe flags recomputed for account {account_id}: {flips}")
+        state_update["child_rules"] = child_rules
+    
+    if has_changes and version > CATALOG_TOMBSTONE_VERSIONS:
+        # Clients older than min_version can no longer see every removal and get a full snapshot
+        min_version = version - CATALOG_TOMBSTONE_VERSIONS
+        await db.catalog_items.delete_many({
+            "account_id": account_id,
+            "removed": True,
+            "version": {"$lte": min_version}
+        })
+        state_update["min_version"] = min_version
+    
+    await db.catalog_state.update_one({"account_id": account_id}, {"$set": state_update}, upsert=True)
+    
+    summary["version"] = version
+    logger.info(f"Catalog sync for account {account_id} done at version {version}: {summary['kinds']}")
+    return summary
+
+async def sync_all_catalogs() -> Optional[List[Dict[str, Any]]]:
+    """Sync every active Xtream account, one sync at a time.
+
+    Returns None when another worker holds the catalog sync lease.
+    """
+    async with catalog_sync_lock, hold_lease("catalog_sync") as held:
+        if not held:
+            return None
+        summaries = []
+        async for config in db.xtream_config.find({"is_active": True}):
+            try:
+                summaries.append(await sync_account_catalog(config))
+            except Exception as e:
+                logger.error(f"Catalog sync failed for account {config.get('id')}: {str(e)}")
+                summaries.append({"account_id": config.get("id"), "error": str(e)})
+        return summaries
+
+async def catalog_sync_loop():
+    """Background scheduler for catalog syncs"""
+    while True:
+        try:
+            if await claim_schedule("catalog_sync", CATALOG_SYNC_INTERVAL) and await sync_all_catalogs() is None:
+                logger.info("Catalog sync skipped, another worker is running it")
+        except Exception as e:
+            logger.error(f"Catalog sync loop error: {str(e)}")
+        await asyncio.sleep(CATALOG_SYNC_INTERVAL)
+
+async def load_catalog_from_store(config: Dict[str, Any], kind: str, category_id: Optional[str] = None,
+                                  child_safe: bool = False) -> Optional[List[Dict[str, Any]]]:
+    """Serve a catalog from the local store, or None when it was never synced.
+
+    ``child_safe`` serves the view precomputed at sync for child profiles.
+    """
+    state = await db.catalog_state.find_one(
+        {"account_id": config.get("id")},
+        {"_id": 0, "version": 1, f"kinds.{kind}": 1}
+    )
+    synced_at = state.get("kinds", {}).get(kind, {}).get("synced_at") if state else None
+    if not synced_at:
+        return None
+    
+    # synced_at changes once a sync has applied every kind, so lists read mid-sync are never reused
+    cache_key = (config["id"], kind, category_id or "", child_safe, state.get("version", 0), synced_at.timestamp())
+    cached = await catalog_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    query = {"account_id": config["id"], "kind": kind, "removed": False}
+    if child_safe:
+        query["child_safe"] = True
+    if category_id:
+        query["category_id"] = category_id
+    
+    # Built one cursor batch at a time in a thread: the full list of dicts never sits in memory
+    # and packing a large catalog does not hold the event loop
+    items = CompactCatalog()
+    cursor = db.catalog_items.find(query, {"_id": 0, "data": 1}).sort("position", 1).batch_size(CATALOG_BULK_BATCH_SIZE)
+    while True:
+        batch = await cursor.to_list(CATALOG_BULK_BATCH_SIZE)
+        if not batch:
+            break
+        await asyncio.to_thread(items.extend, [doc["data"] for doc in batch])
+    await asyncio.to_thread(items.freeze)
+    await catalog_cache.set(cache_key, items)
+    return items
+
+async def stream_catalog_snapshot(account_id: str, kinds: List[str], header: Dict[str, Any], child_safe: bool):
+    """Yield a full catalog snapshot as JSON, straight from the store in position order"""
+    yield json.dumps(header)[:-1] + ', "kinds": {'
+    for index, kind in enumerate(kinds):
+        query = {"account_id": account_id, "kind": kind, "removed": False}
+        if child_safe:
+            query["child_safe"] = True
+        cursor = db.catalog_items.find(query, {"_id": 0, "data": 1}).sort("position", 1).batch_size(CATALOG_BULK_BATCH_SIZE)
+        chunk = [("," if index else "") + json.dumps(kind) + ': {"items": [']
+        rows = 0
+        async for doc in cursor:
+            chunk.append(("," if rows else "") + json.dumps(rewrite_image_fields(doc["data"]), ensure_ascii=False))
+            rows += 1
+            if rows % CATALOG_BULK_BATCH_SIZE == 0:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append("]}")
+        yield "".join(chunk)
+    yield "}}"
+
+@api_router.get("/xtream/catalog/changes")
+async def get_catalog_changes(since: int = 0, kinds: Optional[str] = None, user_code: Optional[str] = None,
+                              profile_name: Optional[str] = None):
+    """Get catalog entries added, updated or removed since a catalog version.
+
+    Falls back to a full snapshot (``full: true``) when ``since`` is unknown or
+    older than the retained tombstones. Child profiles get the child-safe view:
+    entries that stopped being child-safe are reported as removed.
+    """
+    config = await get_xtream_config()
+    account_id = config["id"]
+    
+    requested = [kind.strip() for kind in kinds.split(',')] if kinds else list(CATALOG_KINDS)
+    unknown = [kind for kind in requested if kind not in CATALOG_KINDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Invalid catalog kind: {', '.join(unknown)}")
+    
+    state = await db.catalog_state.find_one({"account_id": account_id})
+    if not state or not state.get("version"):
+        raise HTTPException(status_code=404, detail="Catalog not synced yet")
+    
+    child = await is_child_profile(user_code, profile_name)
+    version = state["version"]
+    full = since <= 0 or since < state.get("min_version", 0) or since > version
+    
+    if full:
+        header = {"version": version, "since": since, "full": True}
+        return StreamingResponse(stream_catalog_snapshot(account_id, requested, header, child),
+                                 media_type="application/json")
+    
+    result = {"version": version, "since": since, "full": False, "kinds": {}}
+    for kind in requested:
+        result["kinds"][kind] = {"added": [], "updated": [], "removed": [], "positions": {}}
+    
+    if since == version:
+        return result
+    
+    # Entries of a version still being written (above the published one) wait for the next call
+    cursor = db.catalog_items.find(
+        {"account_id": account_id, "kind": {"$in": requested}, "version": {"$gt": since, "$lte": version}},
+        {"_id": 0, "kind": 1, "item_id": 1, "data": 1, "removed": 1, "added_version": 1, "position": 1,
+         "child_safe": 1}
+    ).sort("position", 1)
+    
+    async for doc in cursor:
+        changes = result["kinds"][doc["kind"]]
+        if doc.get("removed") or (child and not doc.get("child_safe")):
+            changes["removed"].append(doc["item_id"])
+            continue
+        # Also set for reordered entries, whose content did not change
+        changes["positions"][doc["item_id"]] = doc.get("position")
+        if doc.get("added_version", 0) > since:
+            changes["added"].append(rewrite_image_fields(doc["data"]))
+        else:
+            changes["updated"].append(rewrite_image_fields(doc["data"]))
+    
+    return result
+
+@api_router.post("/admin/catalog/sync")
+async def trigger_catalog_sync():
+    """Admin: Run a catalog sync now"""
+    summaries = await sync_all_catalogs()
+    if summaries is None:
+        raise HTTPException(status_code=409, detail="A catalog sync is already running")
+    return {"message": "Catalog sync completed", "accounts": summaries}
+
+@api_router.get("/admin/catalog/status")
+async def get_catalog_status():
+    """Admin: Get catalog versions and last sync per account"""
+    states = await db.catalog_state.find({}, {"_id": 0}).to_list(100)
+    return {"sync_interval": CATALOG_SYNC_INTERVAL, "accounts": states}
+
+# ==================== CHILD-SAFE CATALOG ====================
+
+# Categories or titles hidden from child profiles
+CHILD_BLOCKED_PATTERN = re.compile(
+    os.environ.get('CHILD_BLOCKED_PATTERN', r'adult|adulte|xxx|porn|erotic|\+18|18\+'), re.IGNORECASE
+)
+# Comma separated category ids or names; when set, child profiles only see these
+CHILD_ALLOWED_CATEGORIES = {name.strip() for name in os.environ.get('CHILD_ALLOWED_CATEGORIES', '').split(',') if name.strip()}
+CHILD_BLOCKED_CATEGORIES = {name.strip() for name in os.environ.get('CHILD_BLOCKED_CATEGORIES', '').split(',') if name.strip()}
+# Highest age rating (e.g. "12+", "PG-13", "-16") a child profile may see
+CHILD_MAX_AGE = int(os.environ.get('CHILD_MAX_AGE', '12'))
+CHILD_AGE_FIELDS = ("age", "age_rating", "mpaa_rating", "certification")
+AGE_RATING_RE = re.compile(r'(\d{1,2})')
+MPAA_AGES = {"G": 0, "PG": 10, "PG-13": 13, "R": 17, "NC-17": 18, "TV-Y": 0, "TV-Y7": 7, "TV-G": 0,
+             "TV-PG": 10, "TV-14": 14, "TV-MA": 17}
+CATEGORY_ACTIONS = {"live": "get_live_categories", "vod": "get_vod_categories", "series": "get_series_categories"}
+
+def item_min_age(item: Dict[str, Any]) -> Optional[int]:
+    """Minimum viewer age from the rating metadata of a catalog entry, if any"""
+    for field in CHILD_AGE_FIELDS:
+        value = item.get(field)
+        if value is None or value == "":
+            continue
+        text = str(value).strip().upper()
+        if text in MPAA_AGES:
+            return MPAA_AGES[text]
+        age_match = AGE_RATING_RE.search(text)
+        if age_match:
+            return int(age_match.group(1))
+    return None
+
+def child_category_allowed(category_id: Any, category_name: str) -> bool:
+    keys = {str(category_id or ""), category_name or ""} - {""}
+    if keys & CHILD_BLOCKED_CATEGORIES:
+        return False
+    if CHILD_ALLOWED_CATEGORIES and not keys & CHILD_ALLOWED_CATEGORIES:
+        return False
+    return not (category_name and CHILD_BLOCKED_PATTERN.search(category_name))
+
+def is_child_safe(item: Dict[str, Any], category_names: Dict[str, str]) -> bool:
+    category_id = str(item.get("category_id") or "")
+    # Live channels carry their group title as category id
+    category_name = category_names.get(category_id, category_id)
+    if not child_category_allowed(category_id, category_name):
+        return False
+    if CHILD_BLOCKED_PATTERN.search(str(item.get("name") or "")):
+        return False
+    min_age = item_min_age(item)
+    return min_age is None or min_age <= CHILD_MAX_AGE
+
+def filter_child_categories(categories: Any) -> Any:
+    if not isinstance(categories, list):
+        return categories
+    return [
+        category for category in categories
+        if not isinstance(category, dict)
+        or child_category_allowed(category.get("category_id"), category.get("category_name") or "")
+    ]
+
+async def get_category_names(config: Dict[str, Any], kind: str) -> Dict[str, str]:
+    """category_id -> name for VOD and series; live entries already carry the name"""
+    if kind == "live":
+        return {}
+    try:
+        categories = await get_categories(config, CATEGORY_ACTIONS[kind])
+    except Exception as e:
+        logger.warning(f"Child filter: no {kind} category names for account {config.get('id')}: {str(e)}")
+        return {}
+    if not isinstance(categories, list):
+        return {}
+    return {str(category.get("category_id")): category.get("category_name") or ""
+            for category in categories if isinstance(category, dict)}
+
+def child_rules_signature(category_names: Dict[str, Dict[str, str]]) -> str:
+    """Changes whenever the rules or a category name change, so stored flags get recomputed"""
+    payload = json.dumps([
+        CHILD_BLOCKED_PATTERN.pattern, sorted(CHILD_ALLOWED_CATEGORIES), sorted(CHILD_BLOCKED_CATEGORIES),
+        CHILD_MAX_AGE, category_names
+    ], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+async def recompute_child_safe(account_id: str, kind: str, category_names: Dict[str, str], version: int) -> int:
+    """Rewrite the child_safe flag of every stored entry of a kind; returns the number of flips.
+
+    Flipped entries get ``version`` so child deltas pick them up.
+    """
+    flips = {True: [], False: []}
+    cursor = db.catalog_items.find(
+        {"account_id": account_id, "kind": kind, "removed": False},
+        {"_id": 0, "item_id": 1, "child_safe": 1, "data": 1}
+    )
+    async for doc in cursor:
+        safe = is_child_safe(doc.get("data") or {}, category_names)
+        if doc.get("child_safe") is not safe:
+            flips[safe].append(doc["item_id"])
+    
+    base_filter = {"account_id": account_id, "kind": kind}
+    operations = [
+        UpdateMany({**base_filter, "item_id": {"$in": item_ids[start:start + CATALOG_BULK_BATCH_SIZE]}},
+                   {"$set": {"child_safe": safe, "version": version}})
+        for safe, item_ids in flips.items()
+        for start in range(0, len(item_ids), CATALOG_BULK_BATCH_SIZE)
+    ]
+    if operations:
+        await db.catalog_items.bulk_write(operations, ordered=False)
+    return len(flips[True]) + len(flips[False])
+
+async def is_child_profile(user_code: Optional[str], profile_name: Optional[str]) -> bool:
+    if not user_code or not profile_name:
+        return False
+    profile = await db.profiles.find_one({"user_code": user_code, "name": profile_name}, {"_id": 0, "is_child": 1})
+    return bool(profile and profile.get("is_child"))
+
+async def ensure_child_can_open(config: Dict[str, Any], kind: str, item_id: str, user_code: Optional[str],
+                                profile_name: Optional[str], info: Any = None) -> None:
+    """Refuse (403) a title or stream hidden from a child profile.
+
+    Uses the flag stored at sync; titles missing from the store are judged on
+    their info payload when there is one.
+    """
+    if not await is_child_profile(user_code, profile_name):
+        return
+    stored = await db.catalog_items.find_one(
+        {"account_id": config["id"], "kind": kind, "item_id": str(item_id), "removed": False},
+        {"_id": 0, "child_safe": 1}
+    )
+    if stored is not None:
+        safe = bool(stored.get("child_safe"))
+    elif isinstance(info, dict):
+        details = {**(info.get("movie_data") or {}), **(info.get("info") or {})}
+        safe = is_child_safe(details, await get_category_names(config, kind))
+    else:
+        # Not synced and nothing to judge on: the listings this id came from are already filtered
+        safe = True
+    if not safe:
+        raise HTTPException(status_code=403, detail="Not available for this profile")
+
+# ==================== ADMIN JOBS ====================
+
+# Seconds between two progress writes of a running job
+ADMIN_JOB_PROGRESS_INTERVAL = 2.0
+
+admin_job_tasks: Dict[str, asyncio.Task] = {}
+
+class AdminJob:
+    """Progress of a long running admin operation, persisted in admin_jobs"""
+    
+    def __init__(self, job_type: str, params: Dict[str, Any]):
+        self.id = str(uuid.uuid4())
+        self.type = job_type
+        self.params = params
+        self.status = "running"
+        self.total = 0
+        self.done = 0
+        self.counts: Counter = Counter()
+        self.error: Optional[str] = None
+        self.result: Dict[str, Any] = {}
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self._saved_at = 0.0
+    
+    def document(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": self.type,
+            "params": self.params,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "counts": dict(self.counts),
+            "error": self.error,
+            "result": self.result,
+            "created_at": self.created_at,
+            "updated_at": datetime.utcnow(),
+            "finished_at": self.finished_at
+        }
+    
+    async def save(self) -> None:
+        self._saved_at = time.monotonic()
+        await db.admin_jobs.update_one({"id": self.id}, {"$set": self.document()}, upsert=True)
+    
+    async def progress(self) -> None:
+        """Persist progress, at most once per ADMIN_JOB_PROGRESS_INTERVAL"""
+        if time.monotonic() - self._saved_at >= ADMIN_JOB_PROGRESS_INTERVAL:
+            await self.save()
+
+async def running_admin_job(lock: str) -> Optional[str]:
+    """Id of the job holding this lock in any worker, if any"""
+    return await lease_owner(f"admin_job:{lock}")
+
+async def start_admin_job(job_type: str, params: Dict[str, Any], runner, lock: Optional[str] = None) -> AdminJob:
+    """Record a job and run ``runner(job)`` in the background.
+
+    The job holds the ``admin_job:<lock>`` lease (``lock`` defaults to the job
+    type) while it runs, so only one such job runs across workers; raises 409
+    when another one holds it.
+    """
+    job = AdminJob(job_type, params)
+    lease = f"admin_job:{lock or job_type}"
+    if not await acquire_lease(lease, job.id):
+        raise HTTPException(status_code=409, detail=f"A {job_type} job is already running")
+    await job.save()
+    await heartbeat_admin_job(job)
+    
+    async def run():
+        try:
+            await runner(job)
+            job.status = "completed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.error(f"Admin job {job.type} {job.id} failed: {str(e)}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            renewal.cancel()
+            job.finished_at = datetime.utcnow()
+            admin_job_tasks.pop(job.id, None)
+            await job.save()
+            await release_lease(lease, job.id)
+        logger.info(f"Admin job {job.type} {job.id} {job.status}: {job.done}/{job.total} {dict(job.counts)}")
+    
+    task = asyncio.create_task(run(), name=job_type)
+    admin_job_tasks[job.id] = task
+    renewal = asyncio.create_task(renew_lease(lease, job.id, on_renew=lambda: heartbeat_admin_job(job, task)))
+    return job
+
+async def heartbeat_admin_job(job: AdminJob, task: Optional[asyncio.Task] = None) -> None:
+    """Extend the job's lease in the store and honour cancellations requested from another worker"""
+    await db.admin_jobs.update_one(
+        {"id": job.id},
+        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=LEASE_TTL)}}
+    )
+    if not task:
+        return
+    doc = await db.admin_jobs.find_one({"id": job.id}, {"_id": 0, "cancel_requested": 1})
+    if doc and doc.get("cancel_requested"):
+        task.cancel()
+
+async def mark_interrupted_admin_jobs() -> None:
+    """Running jobs whose lease expired were lost with their worker"""
+    await db.admin_jobs.update_many(
+        {"status": "running", "$or": [
+            {"lease_expires_at": {"$lte": datetime.utcnow()}},
+            {"lease_expires_at": {"$exists": False}}
+        ]},
+        {"$set": {"status": "interrupted", "finished_at": datetime.utcnow()}}
+    )
+
+@api_router.get("/admin/jobs")
+async def list_admin_jobs(type: Optional[str] = None, limit: int = 20):
+    """Admin: List recent background jobs"""
+    query = {"type": type} if type else {}
+    jobs = await db.admin_jobs.find(query, {"_id": 0}).sort("created_at", -1).to_list(min(limit, 100))
+    return {"jobs": jobs}
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_admin_job(job_id: str):
+    """Admin: Get the progress of a background job"""
+    job = await db.admin_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.post("/admin/jobs/{job_id}/cancel")
+async def cancel_admin_job(job_id: str):
+    """Admin: Cancel a running background job"""
+    task = admin_job_tasks.get(job_id)
+    if task:
+        task.cancel()
+        return {"message": "Job cancellation requested", "id": job_id}
+    # Running in another worker: picked up at its next heartbeat
+    result = await db.admin_jobs.update_one({"id": job_id, "status": "running"}, {"$set": {"cancel_requested": True}})
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="No running job with this id")
+    return {"message": "Job cancellation requested", "id": job_id}
+
+# ==================== ACCOUNT HEALTH SCAN ====================
+
+# Accounts probed at the same time, across all hosts (per host limits come from the upstream guard)
+ACCOUNT_SCAN_CONCURRENCY = int(os.environ.get('ACCOUNT_SCAN_CONCURRENCY', '50'))
+ACCOUNT_SCAN_TIMEOUT = float(os.environ.get('ACCOUNT_SCAN_TIMEOUT', '15'))
+# Interval between scheduled scans in seconds (0 disables the scheduler)
+ACCOUNT_SCAN_INTERVAL = int(os.environ.get('ACCOUNT_SCAN_INTERVAL', '0'))
+ACCOUNT_SCAN_WRITE_BATCH = 500
+
+def optional_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def list_scan_accounts() -> List[Dict[str, Any]]:
+    """Distinct Xtream accounts referenced by user codes, with the filter selecting their codes"""
+    accounts: Dict[tuple, Dict[str, Any]] = {}
+    
+    pipeline = [
+        {"$match": {"dns_url": {"$nin": [None, ""]}, "xtream_username": {"$nin": [None, ""]}}},
+        {"$group": {
+            "_id": {"dns_url": "$dns_url", "xtream_username": "$xtream_username"},
+            "xtream_password": {"$first": "$xtream_password"}
+        }}
+    ]
+    async for doc in db.user_codes.aggregate(pipeline):
+        key = (doc["_id"]["dns_url"], doc["_id"]["xtream_username"])
+        accounts[key] = {
+            "dns_url": key[0],
+            "username": key[1],
+            "password": doc.get("xtream_password") or "",
+            "filters": [dict(doc["_id"])]
+        }
+    
+    # Codes created with create-user-with-xtream point to a saved config instead
+    config_ids = await db.user_codes.distinct(
+        "xtream_config_id", {"dns_url": {"$in": [None, ""]}, "xtream_config_id": {"$ne": None}}
+    )
+    async for config in db.xtream_config.find({"id": {"$in": config_ids}}):
+        key = (config["dns_url"], config["username"])
+        account = accounts.setdefault(key, {
+            "dns_url": key[0],
+            "username": key[1],
+            "password": config["password"],
+            "filters": []
+        })
+        account["filters"].append({"xtream_config_id": config["id"]})
+    
+    return list(accounts.values())
+
+def account_health_status(user_info: Dict[str, Any], exp_date: Optional[int]) -> str:
+    if str(user_info.get("auth", 1)) == "0":
+        return "invalid_credentials"
+    if exp_date and exp_date < time.time():
+        return "expired"
+    panel_status = str(user_info.get("status") or "active").lower()
+    return "active" if panel_status == "active" else panel_status
+
+async def probe_account(account: Dict[str, Any]) -> Dict[str, Any]:
+    """Check one Xtream account against player_api.php"""
+    url = f"{account['dns_url'].rstrip('/')}/player_api.php"
+    params = {"username": account["username"], "password": account["password"]}
+    health = {
+        "status": None,
+        "exp_date": None,
+        "max_connections": None,
+        "active_cons": None,
+        "error": None,
+        "checked_at": datetime.utcnow()
+    }
+    
+    try:
+        async with upstream_guard(url, background=True).slot(), track_upstream("account_scan"):
+            response = await get_upstream_client().get(url, params=params, timeout=ACCOUNT_SCAN_TIMEOUT)
+            if response.status_code >= 500:
+                response.raise_for_status()
+    except (UpstreamUnavailable, httpx.HTTPError) as e:
+        health.update(status="unreachable", error=str(e) or type(e).__name__)
+        return health
+    
+    if response.status_code in (401, 403):
+        health["status"] = "invalid_credentials"
+        return health
+    if response.status_code >= 400:
+        health.update(status="error", error=f"HTTP {response.status_code}")
+        return health
+    
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = None
+    user_info = payload.get("user_info") if isinstance(payload, dict) else None
+    if not isinstance(user_info, dict) or not user_info:
+        # Most panels answer an empty body or a bare auth flag to bad credentials
+        health["status"] = "invalid_credentials"
+        return health
+    
+    exp_date = optional_int(user_info.get("exp_date"))
+    health.update(
+        status=account_health_status(user_info, exp_date),
+        exp_date=exp_date,
+        max_connections=optional_int(user_info.get("max_connections")),
+        active_cons=optional_int(user_info.get("active_cons"))
+    )
+    return health
+
+async def run_account_scan(job: AdminJob) -> None:
+    """Probe every account and store the result on its user codes"""
+    accounts = await list_scan_accounts()
+    job.total = len(accounts)
+    await job.save()
+    
+    remaining = iter(accounts)
+    pending: List[UpdateMany] = []
+    
+    async def flush():
+        if not pending:
+            return
+        batch = pending[:]
+        pending.clear()
+        result = await db.user_codes.bulk_write(batch, ordered=False)
+        job.counts["codes_updated"] += result.modified_count
+    
+    async def worker():
+        for account in remaining:
+            health = await probe_account(account)
+            filters = account["filters"]
+            pending.append(UpdateMany(
+                filters[0] if len(filters) == 1 else {"$or": filters},
+                {"$set": {"account_health": health}}
+            ))
+            job.done += 1
+            job.counts[health["status"]] += 1
+            if len(pending) >= ACCOUNT_SCAN_WRITE_BATCH:
+                await flush()
+            await job.progress()
+    
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(ACCOUNT_SCAN_CONCURRENCY, len(accounts))))))
+    finally:
+        # Keep the results already collected when the job is cancelled
+        await asyncio.shield(flush())
+
+async def start_account_scan() -> AdminJob:
+    if await running_admin_job("account_scan"):
+        raise HTTPException(status_code=409, detail="An account scan is already running")
+    return await start_admin_job("account_scan", {}, run_account_scan)
+
+async def account_scan_loop():
+    """Background scheduler for account health scans"""
+    while True:
+        await asyncio.sleep(ACCOUNT_SCAN_INTERVAL)
+        try:
+            if await claim_schedule("account_scan", ACCOUNT_SCAN_INTERVAL) and not await running_admin_job("account_scan"):
+                job = await start_account_scan()
+                task = admin_job_tasks.get(job.id)
+                if task:
+                    await asyncio.wait([task])
+        except Exception as e:
+            logger.error(f"Account scan loop error: {str(e)}")
+
+@api_router.post("/admin/account-scan")
+async def trigger_account_scan():
+    """Admin: Start an account health and expiry scan of all user codes"""
+    job = await start_account_scan()
+    return {"message": "Account scan started", "job": job.document()}
+
+@api_router.get("/admin/account-scan/results")
+async def get_account_scan_results(status: Optional[str] = None, expiring_within_days: Optional[int] = None,
+                                   limit: int = 500):
+    """Admin: Get the last known account health of user codes, with a summary per status"""
+    query: Dict[str, Any] = {"account_health": {"$exists": True}}
+    if status:
+        query["account_health.status"] = status
+    if expiring_within_days is not None:
+        deadline = int(time.time()) + expiring_within_days * 86400
+        query["account_health.exp_date"] = {"$ne": None, "$lte": deadline}
+    
+    codes = await db.user_codes.find(
+        query,
+        {"_id": 0, "code": 1, "user_note": 1, "dns_url": 1, "xtream_username": 1,
+         "xtream_config_id": 1, "account_health": 1}
+    ).sort("account_health.exp_date", 1).limit(min(limit, 5000)).to_list(None)
+    
+    summary = {}
+    async for doc in db.user_codes.aggregate([
+        {"$match": {"account_health": {"$exists": True}}},
+        {"$group": {"_id": "$account_health.status", "count": {"$sum": 1}}}
+    ]):
+        summary[doc["_id"]] = doc["count"]
+    
+    return {"summary": summary, "count": len(codes), "codes": codes}
+
+# ==================== DNS MIGRATION ====================
+
+DNS_MIGRATION_SAMPLE_FAILURES_KEPT = 20
+
+# Account statuses proving the new host knows the account
+DNS_MIGRATION_OK_STATUSES = {"active", "expired", "banned", "disabled"}
+
+class DNSMigrationCreate(BaseModel):
+    user_codes: Optional[List[str]] = None
+    from_dns_url: Optional[str] = None
+    new_dns_url: str
+    sample_size: int = Field(default=20, ge=0, le=500)
+    min_success_rate: float = Field(default=0.8, ge=0, le=1)
+    batch_size: int = Field(default=1000, gt=0, le=10000)
+    dry_run: bool = False
+
+async def validate_dns_sample(job: AdminJob, codes: List[Dict[str, Any]], new_dns_url: str,
+                              sample_size: int) -> float:
+    """Probe a random sample of the accounts on the new host, returns the success rate"""
+    accounts = {}
+    for doc in codes:
+        accounts.setdefault((doc["xtream_username"], doc.get("xtream_password") or ""), doc["code"])
+    sample = random.sample(list(accounts), min(sample_size, len(accounts)))
+    if not sample:
+        return 1.0
+    
+    semaphore = asyncio.Semaphore(ACCOUNT_SCAN_CONCURRENCY)
+    
+    async def probe(username: str, password: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await probe_account({"dns_url": new_dns_url, "username": username, "password": password})
+    
+    results = await asyncio.gather(*(probe(username, password) for username, password in sample))
+    failures = []
+    for (username, password), health in zip(sample, results):
+        if health["status"] in DNS_MIGRATION_OK_STATUSES:
+            job.counts["sample_ok"] += 1
+        else:
+            job.counts["sample_failed"] += 1
+            failures.append({"code": accounts[(username, password)], "xtream_username": username,
+                             "status": health["status"], "error": health["error"]})
+    
+    job.result["sample_failures"] = failures[:DNS_MIGRATION_SAMPLE_FAILURES_KEPT]
+    return job.counts["sample_ok"] / len(sample)
+
+async def apply_dns_batch(job: AdminJob, batch: List[Dict[str, Any]], new_dns_url: str) -> None:
+    """Record then apply the new DNS for one batch of codes"""
+    now = datetime.utcnow()
+    await db.dns_migration_results.insert_many([
+        {
+            "job_id": job.id,
+            "code": doc["code"],
+            "old_dns_url": doc["dns_url"],
+            "new_dns_url": new_dns_url,
+            "status": "migrated",
+            "updated_at": now
+        }
+        for doc in batch
+    ], ordered=False)
+    
+    # One update per code, matched on the DNS it had when the job started: codes edited since then are left alone
+    result = await db.user_codes.bulk_write([
+        UpdateOne({"code": doc["code"], "dns_url": doc["dns_url"]}, {"$set": {"dns_url": new_dns_url}})
+        for doc in batch
+    ], ordered=False)
+    
+    skipped = []
+    if result.modified_count < len(batch):
+        # Every matched update wrote the new DNS, codes without it were skipped and must not be rolled back
+        batch_codes = [doc["code"] for doc in batch]
+        migrated = {doc["code"] async for doc in db.user_codes.find(
+            {"code": {"$in": batch_codes}, "dns_url": new_dns_url}, {"_id": 0, "code": 1}
+        )}
+        skipped = [code for code in batch_codes if code not in migrated]
+        await db.dns_migration_results.update_many(
+            {"job_id": job.id, "code": {"$in": skipped}},
+            {"$set": {"status": "skipped", "updated_at": now}}
+        )
+    
+    job.counts["migrated"] += result.modified_count
+    job.counts["skipped"] += len(skipped)
+    job.done += len(batch)
+
+async def run_dns_migration(job: AdminJob) -> None:
+    params = job.params
+    query: Dict[str, Any] = {"dns_url": {"$ne": params["new_dns_url"]}}
+    if params.get("user_codes"):
+        query["code"] = {"$in": params["user_codes"]}
+    if params.get("from_dns_url"):
+        query["dns_url"] = params["from_dns_url"]
+    
+    codes = await db.user_codes.find(
+        query, {"_id": 0, "code": 1, "dns_url": 1, "xtream_username": 1, "xtream_password": 1}
+    ).to_list(None)
+    # Codes without their own credentials use a saved Xtream config, their DNS is not per code
+    migratable = [doc for doc in codes if doc.get("dns_url") and doc.get("xtream_username")]
+    job.counts["skipped"] = len(codes) - len(migratable)
+    job.total = len(migratable)
+    await job.save()
+    
+    success_rate = await validate_dns_sample(job, migratable, params["new_dns_url"], params["sample_size"])
+    job.result["sample_success_rate"] = round(success_rate, 3)
+    await job.save()
+    if success_rate < params["min_success_rate"]:
+        raise ValueError(
+            f"Validation failed: {success_rate:.0%} of sampled accounts answered on {params['new_dns_url']}, "
+            f"{params['min_success_rate']:.0%} required"
+        )
+    if params["dry_run"]:
+        return
+    
+    batch_size = params["batch_size"]
+    for start in range(0, len(migratable), batch_size):
+        await apply_dns_batch(job, migratable[start:start + batch_size], params["new_dns_url"])
+        await job.progress()
+
+async def run_dns_rollback(job: AdminJob) -> None:
+    migration_id = job.params["migration_id"]
+    job.total = await db.dns_migration_results.count_documents({"job_id": migration_id, "status": "migrated"})
+    await job.save()
+    
+    batch_size = job.params["batch_size"]
+    while True:
+        batch = await db.dns_migration_results.find(
+            {"job_id": migration_id, "status": "migrated"},
+            {"_id": 0, "code": 1, "old_dns_url": 1, "new_dns_url": 1}
+        ).limit(batch_size).to_list(None)
+        if not batch:
+            break
+        
+        by_dns: Dict[tuple, List[str]] = {}
+        for doc in batch:
+            by_dns.setdefault((doc["old_dns_url"], doc["new_dns_url"]), []).append(doc["code"])
+        # Codes moved again since the migration keep their current DNS
+        result = await db.user_codes.bulk_write([
+            UpdateMany({"code": {"$in": batch_codes}, "dns_url": new_dns_url}, {"$set": {"dns_url": old_dns_url}})
+            for (old_dns_url, new_dns_url), batch_codes in by_dns.items()
+        ], ordered=False)
+        await db.dns_migration_results.update_many(
+            {"job_id": migration_id, "code": {"$in": [doc["code"] for doc in batch]}},
+            {"$set": {"status": "rolled_back", "updated_at": datetime.utcnow()}}
+        )
+        
+        job.counts["rolled_back"] += result.modified_count
+        job.done += len(batch)
+        await job.progress()
+
+async def ensure_no_dns_job_running() -> None:
+    # Migrations and rollbacks share the "dns" lock
+    if await running_admin_job("dns"):
+        raise HTTPException(status_code=409, detail="A DNS migration is already running")
+
+@api_router.post("/admin/dns-migrations")
+async def create_dns_migration(input: DNSMigrationCreate):
+    """Admin: Validate a new DNS on a sample of accounts, then move the selected codes to it in batches"""
+    if not input.user_codes and not input.from_dns_url:
+        raise HTTPException(status_code=400, detail="Provide user_codes or from_dns_url")
+    await ensure_no_dns_job_running()
+    
+    job = await start_admin_job("dns_migration", input.dict(), run_dns_migration, lock="dns")
+    return {"message": "DNS migration started", "job": job.document()}
+
+@api_router.get("/admin/dns-migrations/{job_id}")
+async def get_dns_migration(job_id: str):
+    """Admin: Get a DNS migration job with a count of its codes per result"""
+    job = await db.admin_jobs.find_one({"id": job_id, "type": "dns_migration"}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="DNS migration not found")
+    
+    results = {}
+    async for doc in db.dns_migration_results.aggregate([
+        {"$match": {"job_id": job_id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]):
+        results[doc["_id"]] = doc["count"]
+    
+    job["results"] = results
+    return job
+
+@api_router.get("/admin/dns-migrations/{job_id}/results")
+async def get_dns_migration_results(job_id: str, status: Optional[str] = None, skip: int = 0, limit: int = 500):
+    """Admin: Get the per-code results of a DNS migration"""
+    query = {"job_id": job_id}
+    if status:
+        query["status"] = status
+    results = await db.dns_migration_results.find(query, {"_id": 0}).sort("code", 1).skip(skip).limit(min(limit, 5000)).to_list(None)
+    return {"count": len(results), "results": results}
+
+@api_router.post("/admin/dns-migrations/{job_id}/rollback")
+async def rollback_dns_migration(job_id: str, batch_size: int = 1000):
+    """Admin: Put the codes of a DNS migration back on their previous DNS"""
+    migration = await db.admin_jobs.find_one({"id": job_id, "type": "dns_migration"})
+    if not migration:
+        raise HTTPException(status_code=404, detail="DNS migration not found")
+    await ensure_no_dns_job_running()
+    
+    job = await start_admin_job("dns_rollback", {"migration_id": job_id, "batch_size": max(1, min(batch_size, 10000))},
+                                run_dns_rollback, lock="dns")
+    return {"message": "DNS rollback started", "job": job.document()}
+
+# ==================== WATCH PROGRESS RETENTION ====================
+
+# Entries kept per profile in watch_progress, older ones move to the archive
+WATCH_PROGRESS_MAX_PER_PROFILE = int(os.environ.get('WATCH_PROGRESS_MAX_PER_PROFILE', '500'))
+# Finished titles leave the hot collection after this many days
+WATCH_PROGRESS_COMPLETED_DAYS = int(os.environ.get('WATCH_PROGRESS_COMPLETED_DAYS', '30'))
+# Unfinished titles not touched for this many days are archived too
+WATCH_PROGRESS_STALE_DAYS = int(os.environ.get('WATCH_PROGRESS_STALE_DAYS', '180'))
+# Archived entries are deleted by a TTL index after this many days
+WATCH_PROGRESS_ARCHIVE_TTL_DAYS = int(os.environ.get('WATCH_PROGRESS_ARCHIVE_TTL_DAYS', '365'))
+# Interval between two compactions in seconds (0 disables the scheduler)
+WATCH_PROGRESS_COMPACTION_INTERVAL = int(os.environ.get('WATCH_PROGRESS_COMPACTION_INTERVAL', '86400'))
+WATCH_PROGRESS_ARCHIVE_BATCH = 1000
+WATCH_PROGRESS_ARCHIVE_KEY = ("user_code", "profile_name", "stream_id")
+
+async def ensure_progress_archive_index() -> None:
+    """Unique index on the archived title, replacing the non-unique one of older deployments"""
+    key = [(field, 1) for field in WATCH_PROGRESS_ARCHIVE_KEY]
+    indexes = await db.watch_progress_archive.index_information()
+    existing = next((name for name, index in indexes.items() if list(index["key"]) == key), None)
+    if existing and indexes[existing].get("unique"):
+        return
+    
+    # Keep the most recent copy of titles archived more than once
+    duplicates = db.watch_progress_archive.aggregate([
+        {"$sort": {"last_watched": -1}},
+        {"$group": {"_id": {field: f"${field}" for field in WATCH_PROGRESS_ARCHIVE_KEY},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    async for group in duplicates:
+        await db.watch_progress_archive.delete_many({"_id": {"$in": group["ids"][1:]}})
+    
+    if existing:
+        await db.watch_progress_archive.drop_index(existing)
+    await db.watch_progress_archive.create_index(key, unique=True)
+
+async def archive_watch_progress(query: Dict[str, Any], reason: str) -> int:
+    """Move matching watch_progress entries to watch_progress_archive, returns how many moved"""
+    moved = 0
+    while True:
+        docs = await db.watch_progress.find(query).limit(WATCH_PROGRESS_ARCHIVE_BATCH).to_list(None)
+        if not docs:
+            return moved
+        
+        now = datetime.utcnow()
+        # One archived copy per title: archiving a title again replaces the older position
+        operations = []
+        for doc in docs:
+            archived = {key: value for key, value in doc.items() if key != "_id"}
+            archived["archived_at"] = now
+            archived["archive_reason"] = reason
+            operations.append(ReplaceOne(
+                {key: doc.get(key) for key in WATCH_PROGRESS_ARCHIVE_KEY}, archived, upsert=True
+            ))
+        try:
+            await db.watch_progress_archive.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Two upserts of the same title racing on the unique index, one of them wrote it
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+        
+        # Matching last_watched keeps an entry the user updated meanwhile
+        result = await db.watch_progress.bulk_write([
+            DeleteOne({"_id": doc["_id"], "last_watched": doc.get("last_watched")}) for doc in docs
+        ], ordered=False)
+        moved += result.deleted_count
+        if result.deleted_count == 0:
+            return moved
+
+async def run_watch_progress_compaction(job: AdminJob) -> None:
+    now = datetime.utcnow()
+    
+    job.counts["completed"] = await archive_watch_progress({
+        "percentage": {"$gte": CONTINUE_WATCHING_MAX_PERCENTAGE},
+        "last_watched": {"$lt": now - timedelta(days=WATCH_PROGRESS_COMPLETED_DAYS)}
+    }, "completed")
+    await job.progress()
+    
+    job.counts["stale"] = await archive_watch_progress({
+        "last_watched": {"$lt": now - timedelta(days=WATCH_PROGRESS_STALE_DAYS)}
+    }, "stale")
+    await job.progress()
+    
+    oversized = await db.watch_progress.aggregate([
+        {"$group": {"_id": {"user_code": "$user_code", "profile_name": "$profile_name"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": WATCH_PROGRESS_MAX_PER_PROFILE}}}
+    ]).to_list(None)
+    job.total = len(oversized)
+    for profile in oversized:
+        excess = await db.watch_progress.find(
+            {"user_code": profile["_id"]["user_code"], "profile_name": profile["_id"]["profile_name"]},
+            {"_id": 1, "last_watched": 1}
+        ).sort("last_watched", -1).skip(WATCH_PROGRESS_MAX_PER_PROFILE).to_list(None)
+        if excess:
+            # Like the other passes, an entry watched again since it was picked no longer matches
+            job.counts["over_cap"] += await archive_watch_progress({"$or": [
+                {"_id": doc["_id"], "last_watched": doc.get("last_watched")} for doc in excess
+            ]}, "over_cap")
+        job.done += 1
+        await job.progress()
+
+async def start_watch_progress_compaction() -> AdminJob:
+    if await running_admin_job("progress_compaction"):
+        raise HTTPException(status_code=409, detail="A watch progress compaction is already running")
+    return await start_admin_job("progress_compaction", {}, run_watch_progress_compaction)
+
+async def watch_progress_compaction_loop():
+    """Background scheduler for watch progress compactions"""
+    while True:
+        await asyncio.sleep(WATCH_PROGRESS_COMPACTION_INTERVAL)
+        try:
+            if await claim_schedule("progress_compaction", WATCH_PROGRESS_COMPACTION_INTERVAL) \
+                    and not await running_admin_job("progress_compaction"):
+                job = await start_watch_progress_compaction()
+                task = admin_job_tasks.get(job.id)
+                if task:
+                    await asyncio.wait([task])
+        except Exception as e:
+            logger.error(f"Watch progress compaction loop error: {str(e)}")
+
+@api_router.post("/admin/progress/compact")
+async def trigger_watch_progress_compaction():
+    """Admin: Archive finished, stale and over-cap watch progress entries now"""
+    job = await start_watch_progress_compaction()
+    return {"message": "Watch progress compaction started", "job": job.document()}
+
+@api_router.get("/admin/progress/stats")
+async def get_watch_progress_stats():
+    """Admin: Get hot and archived watch progress sizes and the retention settings"""
+    hot, archived = await asyncio.gather(
+        db.watch_progress.estimated_document_count(),
+        db.watch_progress_archive.estimated_document_count()
+    )
+    return {
+        "hot": hot,
+        "archived": archived,
+        "max_per_profile": WATCH_PROGRESS_MAX_PER_PROFILE,
+        "completed_days": WATCH_PROGRESS_COMPLETED_DAYS,
+        "stale_days": WATCH_PROGRESS_STALE_DAYS,
+        "archive_ttl_days": WATCH_PROGRESS_ARCHIVE_TTL_DAYS
+    }
+
+# ==================== EXPORTS ====================
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {"ndjson": ("application/x-ndjson", "ndjson"), "csv": ("text/csv", "csv")}
+
+USER_CODE_EXPORT_FIELDS = ["code", "is_active", "max_profiles", "user_note", "dns_url", "xtream_username",
+                           "xtream_config_id", "created_at", "account_health.status", "account_health.exp_date"]
+PROFILE_EXPORT_FIELDS = ["id", "user_code", "name", "is_child", "avatar", "created_at"]
+PROGRESS_EXPORT_FIELDS = ["user_code", "profile_name", "stream_id", "stream_type", "current_time", "duration",
+                          "percentage", "last_watched"]
+
+def export_field(doc: Dict[str, Any], field: str) -> Any:
+    value = doc
+    for part in field.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value.isoformat() if isinstance(value, datetime) else value
+
+async def export_documents(collection, query: Dict[str, Any], fields: List[str], format: str):
+    """Yield a cursor as NDJSON or CSV chunks of EXPORT_BATCH_SIZE rows, in _id order"""
+    cursor = collection.find(query, {"_id": 0, **{field: 1 for field in fields}}).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+    output = io.StringIO()
+    writer = csv.writer(output)
+    if format == "csv":
+        writer.writerow(fields)
+    
+    rows = 0
+    async for doc in cursor:
+        values = [export_field(doc, field) for field in fields]
+        if format == "csv":
+            writer.writerow(values)
+        else:
+            output.write(json.dumps(dict(zip(fields, values)), ensure_ascii=False, default=str))
+            output.write("\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    
+    if output.tell():
+        yield output.getvalue()
+
+def export_response(name: str, collection, query: Dict[str, Any], fields: List[str], format: str) -> StreamingResponse:
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format, use ndjson or csv")
+    media_type, extension = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export_documents(collection, query, fields, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{extension}"'}
+    )
+
+def date_range(field: str, after: Optional[datetime], before: Optional[datetime]) -> Dict[str, Any]:
+    bounds = {}
+    if after:
+        bounds["$gte"] = after
+    if before:
+        bounds["$lt"] = before
+    return {field: bounds} if bounds else {}
+
+@api_router.get("/admin/export/user-codes")
+async def export_user_codes(format: str = "ndjson", is_active: Optional[bool] = None, dns_url: Optional[str] = None,
+                            account_status: Optional[str] = None, created_after: Optional[datetime] = None,
+                            created_before: Optional[datetime] = None, include_credentials: bool = False):
+    """Admin: Stream every user code as NDJSON or CSV"""
+    query: Dict[str, Any] = date_range("created_at", created_after, created_before)
+    if is_active is not None:
+        query["is_active"] = is_active
+    if dns_url:
+        query["dns_url"] = dns_url
+    if account_status:
+        query["account_health.status"] = account_status
+    
+    fields = USER_CODE_EXPORT_FIELDS + (["xtream_password"] if include_credentials else [])
+    return export_response("user-codes", db.user_codes, query, fields, format)
+
+@api_router.get("/admin/export/profiles")
+async def export_profiles(format: str = "ndjson", user_code: Optional[str] = None, is_child: Optional[bool] = None):
+    """Admin: Stream every profile as NDJSON or CSV (parental PINs are never exported)"""
+    query: Dict[str, Any] = {}
+    if user_code:
+        query["user_code"] = user_code
+    if is_child is not None:
+        query["is_child"] = is_child
+    return export_response("profiles", db.profiles, query, PROFILE_EXPORT_FIELDS, format)
+
+@api_router.get("/admin/export/progress")
+async def export_watch_progress(format: str = "ndjson", user_code: Optional[str] = None,
+                                profile_name: Optional[str] = None, stream_type: Optional[str] = None,
+                                watched_after: Optional[datetime] = None, watched_before: Optional[datetime] = None):
+    """Admin: Stream watch progress as NDJSON or CSV"""
+    query: Dict[str, Any] = date_range("last_watched", watched_after, watched_before)
+    if user_code:
+        query["user_code"] = user_code
+    if profile_name:
+        query["profile_name"] = profile_name
+    if stream_type:
+        query["stream_type"] = stream_type
+    return export_response("watch-progress", db.watch_progress, query, PROGRESS_EXPORT_FIELDS, format)
+
+# ==================== MONITORING ROUTES ====================
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@api_router.get("/admin/profiles")
+async def list_request_profiles():
+    """Admin: List the last slow request profiles"""
+    summaries = [{key: value for key, value in entry.items() if key != "profile"} for entry in slow_profiles]
+    return {
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "slow_threshold": PROFILE_SLOW_THRESHOLD,
+        "profiles": list(reversed(summaries))
+    }
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: str):
+    """Admin: Get one request profile with its call stack statistics"""
+    for entry in slow_profiles:
+        if entry["id"] == profile_id:
+            return entry
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+@api_router.get("/admin/event-loop")
+async def get_event_loop_status():
+    """Admin: Get event loop lag percentiles and the last blocking stacks"""
+    return {
+        "interval": loop_monitor.interval,
+        "threshold": loop_monitor.threshold,
+        "lag_percentiles": loop_monitor.percentiles(),
+        "stalls": list(reversed(loop_monitor.stalls))
+    }
+
+# ==================== XTREAM CODES PROXY ROUTES ====================
+
+@api_router.get("/xtream/info")
+async def get_xtream_info():
+    """Get Xtream Codes account info"""
+    config = await get_xtream_config()
+    
+    try:
+        return await fetch_player_api(config, None, stale_fallback=True)
+    except Exception as e:
+        logger.error(f"Error fetching Xtream info: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+
+@api_router.get("/xtream/live-categories")
+async def get_live_categories(user_code: Optional[str] = None, profile_name: Optional[str] = None):
+    """Get live TV categories"""
+    config = await get_xtream_config()
+    
+    try:
+        categories = await get_categories(config, "get_live_categories")
+        return filter_child_categories(categories) if await is_child_profile(user_code, profile_name) else categories
+    except Exception as e:
+        logger.error(f"Error fetching live categories: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+
+@api_router.get("/xtream/live-streams")
+async def get_live_streams(category_id: Optional[str] = None, user_code: Optional[str] = None,
+                           profile_name: Optional[str] = None):
+    """Get live TV streams from M3U playlist with Cloudflare bypass"""
+    config = await get_xtream_config()
+    child = await is_child_profile(user_code, profile_name)
+    
+    stored = await load_catalog_from_store(config, "live", category_id, child_safe=child)
+    if stored is not None:
+        return await catalog_response(stored)
+    
+    try:
+        # Use M3U endpoint with cloudscraper to bypass Cloudflare
+        channels = await fetch_live_channels(config)
         
         # Filter by category if specified
         if category_id:
             channels = [ch for ch in channels if ch.get('category_id') == category_id]
+        if child:
+            channels = [ch for ch in channels if is_child_safe(ch, {})]
         
-        return channels
+        return rewrite_catalog_images(channels)
         
     except Exception as e:
         logger.error(f"Error fetching live streams from M3U: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/vod-categories")
-async def get_vod_categories():
+async def get_vod_categories(user_code: Optional[str] = None, profile_name: Optional[str] = None):
     """Get VOD (movies) categories"""
     config = await get_xtream_config()
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_vod_categories"
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching VOD categories: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        categories = await get_categories(config, "get_vod_categories")
+        return filter_child_categories(categories) if await is_child_profile(user_code, profile_name) else categories
+    except Exception as e:
+        logger.error(f"Error fetching VOD categories: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/vod-streams")
-async def get_vod_streams(category_id: Optional[str] = None):
+async def get_vod_streams(category_id: Optional[str] = None, user_code: Optional[str] = None,
+                          profile_name: Optional[str] = None):
     """Get VOD streams (movies)"""
     config = await get_xtream_config()
+    child = await is_child_profile(user_code, profile_name)
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_vod_streams"
-    }
-    
-    if category_id:
-        params["category_id"] = category_id
+    stored = await load_catalog_from_store(config, "vod", category_id, child_safe=child)
+    if stored is not None:
+        return await catalog_response(stored)
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching VOD streams: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        items = await fetch_player_api(config, "get_vod_streams", stale_fallback=True, category_id=category_id)
+        if child and isinstance(items, list):
+            category_names = await get_category_names(config, "vod")
+            items = [item for item in items if isinstance(item, dict) and is_child_safe(item, category_names)]
+        return rewrite_catalog_images(items)
+    except Exception as e:
+        logger.error(f"Error fetching VOD streams: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/series-categories")
-async def get_series_categories():
+async def get_series_categories(user_code: Optional[str] = None, profile_name: Optional[str] = None):
     """Get series categories"""
     config = await get_xtream_config()
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_series_categories"
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching series categories: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        categories = await get_categories(config, "get_series_categories")
+        return filter_child_categories(categories) if await is_child_profile(user_code, profile_name) else categories
+    except Exception as e:
+        logger.error(f"Error fetching series categories: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/series-streams")
-async def get_series_streams(category_id: Optional[str] = None):
+async def get_series_streams(category_id: Optional[str] = None, user_code: Optional[str] = None,
+                             profile_name: Optional[str] = None):
     """Get series streams"""
     config = await get_xtream_config()
+    child = await is_child_profile(user_code, profile_name)
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_series"
-    }
-    
-    if category_id:
-        params["category_id"] = category_id
+    stored = await load_catalog_from_store(config, "series", category_id, child_safe=child)
+    if stored is not None:
+        return await catalog_response(stored)
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching series: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        items = await fetch_player_api(config, "get_series", stale_fallback=True, category_id=category_id)
+        if child and isinstance(items, list):
+            category_names = await get_category_names(config, "series")
+            items = [item for item in items if isinstance(item, dict) and is_child_safe(item, category_names)]
+        return rewrite_catalog_images(items)
+    except Exception as e:
+        logger.error(f"Error fetching series: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/series-info/{series_id}")
-async def get_series_info(series_id: str):
+async def get_series_info(series_id: str, user_code: Optional[str] = None, profile_name: Optional[str] = None):
     """Get detailed series information"""
     config = await get_xtream_config()
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_series_info",
-        "series_id": series_id
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching series info: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        info = await get_title_info(config, "series", series_id)
+        record_title_open("series", series_id, info)
+        await ensure_child_can_open(config, "series", series_id, user_code, profile_name, info)
+        return rewrite_image_fields(info)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching series info: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/vod-info/{vod_id}")
-async def get_vod_info(vod_id: str):
+async def get_vod_info(vod_id: str, user_code: Optional[str] = None, profile_name: Optional[str] = None):
     """Get detailed VOD information"""
     config = await get_xtream_config()
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_vod_info",
-        "vod_id": vod_id
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching VOD info: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        info = await get_title_info(config, "vod", vod_id)
+        record_title_open("vod", vod_id, info)
+        await ensure_child_can_open(config, "vod", vod_id, user_code, profile_name, info)
+        return rewrite_image_fields(info)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching VOD info: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
 @api_router.get("/xtream/epg/{stream_id}")
 async def get_epg(stream_id: str):
-    """Get EPG data for a stream"""
+    """Get EPG data for a stream.
+
+    Like the now / next route, no child filter: it only describes programmes of
+    a channel id, which child profiles can only get from filtered listings.
+    """
     config = await get_xtream_config()
     
-    url = f"{config['dns_url']}/player_api.php"
-    params = {
-        "username": config["username"],
-        "password": config["password"],
-        "action": "get_short_epg",
-        "stream_id": stream_id
-    }
+    key = (config["id"], "short", stream_id)
+    cached = await epg_cache.get(key)
+    if cached is not None:
+        return cached
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, params=params)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error fetching EPG: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    try:
+        epg = await fetch_player_api(config, "get_short_epg", stale_fallback=True, stream_id=stream_id)
+        await epg_cache.set(key, epg)
+        return epg
+    except Exception as e:
+        logger.error(f"Error fetching EPG: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
 
-# ==================== STREAM URL GENERATION ====================
+# Catalog kind of each playback stream type; series ids here are episode ids, whose series-info is filtered
+STREAM_URL_KINDS = {"live": "live", "movie": "vod"}
 
 @api_router.get("/xtream/stream-url/{stream_type}/{stream_id}")
-async def get_stream_url(stream_type: str, stream_id: str, extension: str = "m3u8"):
+async def get_stream_url(stream_type: str, stream_id: str, extension: str = "m3u8", user_code: Optional[str] = None,
+                         profile_name: Optional[str] = None):
     """Generate stream URL for playback"""
     config = await get_xtream_config()
+    if stream_type in STREAM_URL_KINDS:
+        await ensure_child_can_open(config, STREAM_URL_KINDS[stream_type], stream_id, user_code, profile_name)
     
     if stream_type == "live":
         url = f"{config['dns_url']}/live/{config['username']}/{config['password']}/{stream_id}.{extension}"
@@ -966,108 +4148,515 @@ async def get_stream_url(stream_type: str, stream_id: str, extension: str = "m3u
     
     return {"url": url}
 
-@api_router.get("/xtream/epg/{stream_id}")
+@api_router.get("/xtream/epg-now/{stream_id}")
 async def get_epg_for_stream(stream_id: str):
-    """Get EPG (Electronic Program Guide) for a specific stream"""
+    """Get the current and next programme of a stream from the XMLTV guide"""
     config = await get_xtream_config()
     
+    if epg_index.covers(config["id"], datetime.utcnow()):
+        return epg_index.now_next(stream_id, datetime.utcnow())
+    
+    key = (config["id"], "now_next", stream_id)
+    cached = await epg_cache.get(key)
+    if cached is not None:
+        return cached
+    
     try:
-        import cloudscraper
-        from datetime import datetime, timedelta
-        
-        # EPG endpoint from Xtream
-        url = f"{config['dns_url']}/xmltv.php"
-        params = {
-            "username": config["username"],
-            "password": config["password"],
-        }
-        
-        scraper = cloudscraper.create_scraper(
-            browser={
-                'browser': 'chrome',
-                'platform': 'windows',
-                'mobile': False
-            }
-        )
-        
         # Get EPG XML
-        response = scraper.get(url, params=params, timeout=30)
-        response.raise_for_status()
+        async with upstream_guard(config['dns_url']).slot(), track_upstream("xmltv"):
+            content = await run_scraper(fetch_xmltv, config)
         
         # Parse XML to find programs for this stream
-        import xml.etree.ElementTree as ET
-        root = ET.fromstring(response.content)
+        with profile_phase("parse"):
+            now_next = await run_cpu(find_epg_now_next, content, stream_id, datetime.utcnow())
+        await epg_cache.set(key, now_next, ttl=EPG_NOW_NEXT_TTL)
+        return now_next
         
-        # Find channel by stream_id
-        channel_id = None
-        for channel in root.findall('.//channel'):
-            if stream_id in channel.get('id', ''):
-                channel_id = channel.get('id')
-                break
-        
-        if not channel_id:
-            return {"current": None, "next": None}
-        
-        # Get current time
-        now = datetime.utcnow()
-        
-        # Find current and next programs
+    except Exception as e:
+        logger.error(f"Error fetching EPG: {e}")
+        return {"current": None, "next": None}
+
+# ==================== EPG INDEX ====================
+
+# Interval between two rebuilds of the in-memory guide in seconds (0 disables the refresher)
+EPG_INDEX_REFRESH = int(os.environ.get('EPG_INDEX_REFRESH', '3600'))
+# Programmes kept per channel, from the build time
+EPG_INDEX_HORIZON_HOURS = int(os.environ.get('EPG_INDEX_HORIZON_HOURS', '24'))
+
+class EpgIndex:
+    """Parsed guide of the active account, so now / next lookups skip the XMLTV download"""
+    
+    def __init__(self):
+        self.account_id: Optional[str] = None
+        self.built_at: Optional[datetime] = None
+        self.horizon_end: Optional[datetime] = None
+        self.channels: List[str] = []
+        self.programmes: Dict[str, list] = {}
+        self._stream_channels: Dict[str, Optional[str]] = {}
+    
+    def load(self, account_id: str, index: Dict[str, Any]) -> None:
+        self.account_id = account_id
+        self.built_at = datetime.utcnow()
+        self.horizon_end = index["horizon_end"]
+        self.channels = index["channels"]
+        self.programmes = index["programmes"]
+        self._stream_channels = {}
+    
+    def covers(self, account_id: str, now: datetime) -> bool:
+        """Whether lookups for the account can be answered from the index at ``now``"""
+        if self.account_id != account_id or self.built_at is None:
+            return False
+        # Programmes past the horizon were dropped at build time
+        if now >= self.horizon_end:
+            return False
+        # Two missed refreshes: the guide may have changed upstream
+        return EPG_INDEX_REFRESH <= 0 or now - self.built_at <= timedelta(seconds=2 * EPG_INDEX_REFRESH)
+    
+    def channel_for(self, stream_id: str) -> Optional[str]:
+        # Same matching as find_epg_now_next: first channel whose id contains the stream id
+        if stream_id not in self._stream_channels:
+            self._stream_channels[stream_id] = next((channel for channel in self.channels if stream_id in channel), None)
+        return self._stream_channels[stream_id]
+    
+    def now_next(self, stream_id: str, now: datetime) -> Dict[str, Any]:
+        channel_id = self.channel_for(stream_id)
         current_program = None
         next_program = None
         
-        for programme in root.findall('.//programme'):
-            if programme.get('channel') != channel_id:
-                continue
-            
-            # Parse start and stop times (format: YYYYMMDDHHmmss +0000)
-            start_str = programme.get('start', '').split()[0]
-            stop_str = programme.get('stop', '').split()[0]
-            
-            try:
-                start_time = datetime.strptime(start_str, '%Y%m%d%H%M%S')
-                stop_time = datetime.strptime(stop_str, '%Y%m%d%H%M%S')
-                
-                # Check if program is current
-                if start_time <= now < stop_time:
-                    title_elem = programme.find('title')
-                    desc_elem = programme.find('desc')
-                    
-                    current_program = {
-                        "title": title_elem.text if title_elem is not None else "Programme en cours",
-                        "description": desc_elem.text if desc_elem is not None else "",
-                        "start": start_time.strftime('%H:%M'),
-                        "end": stop_time.strftime('%H:%M'),
-                        "progress": int(((now - start_time).total_seconds() / (stop_time - start_time).total_seconds()) * 100)
-                    }
-                
-                # Check if program is next
-                elif start_time > now and next_program is None:
-                    title_elem = programme.find('title')
-                    desc_elem = programme.find('desc')
-                    
-                    next_program = {
-                        "title": title_elem.text if title_elem is not None else "Programme suivant",
-                        "description": desc_elem.text if desc_elem is not None else "",
-                        "start": start_time.strftime('%H:%M'),
-                        "end": stop_time.strftime('%H:%M')
-                    }
-                    
-                # Stop if we found both
-                if current_program and next_program:
-                    break
-                    
-            except (ValueError, AttributeError) as e:
-                logger.error(f"Error parsing EPG time: {e}")
-                continue
+        for start_time, stop_time, title, description in self.programmes.get(channel_id, []):
+            if start_time <= now < stop_time:
+                current_program = {
+                    "title": title if title is not None else "Programme en cours",
+                    "description": description,
+                    "start": start_time.strftime('%H:%M'),
+                    "end": stop_time.strftime('%H:%M'),
+                    "progress": int(((now - start_time).total_seconds() / (stop_time - start_time).total_seconds()) * 100)
+                }
+            elif start_time > now:
+                next_program = {
+                    "title": title if title is not None else "Programme suivant",
+                    "description": description,
+                    "start": start_time.strftime('%H:%M'),
+                    "end": stop_time.strftime('%H:%M')
+                }
+                break
         
+        return {"current": current_program, "next": next_program}
+    
+    def stats(self) -> Dict[str, Any]:
         return {
-            "current": current_program,
-            "next": next_program
+            "account_id": self.account_id,
+            "built_at": self.built_at,
+            "horizon_end": self.horizon_end,
+            "channels": len(self.channels),
+            "programmes": sum(len(channel_programmes) for channel_programmes in self.programmes.values())
         }
-        
+
+epg_index = EpgIndex()
+
+async def refresh_epg_index(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Download the XMLTV guide and rebuild the in-memory index"""
+    async with upstream_guard(config['dns_url']).slot(), track_upstream("xmltv"):
+        content = await run_scraper(fetch_xmltv, config)
+    
+    index = await run_cpu(build_epg_index, content, datetime.utcnow(), timedelta(hours=EPG_INDEX_HORIZON_HOURS))
+    epg_index.load(config["id"], index)
+    stats = epg_index.stats()
+    logger.info(f"EPG index built: {stats['channels']} channels, {stats['programmes']} programmes")
+    return stats
+
+async def epg_index_loop():
+    """Background refresher of the EPG index"""
+    while True:
+        await asyncio.sleep(EPG_INDEX_REFRESH)
+        try:
+            config = await db.xtream_config.find_one({"is_active": True})
+            if config:
+                await refresh_epg_index(config)
+        except Exception as e:
+            logger.error(f"EPG index refresh error: {str(e)}")
+
+# ==================== WARM-UP ====================
+
+# Prefetch caches before reporting ready (false: ready as soon as the app starts)
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Longest the warm-up may hold readiness back, a slow upstream must not keep a worker out forever
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '120'))
+
+warmup_state: Dict[str, Any] = {"status": "pending", "started_at": None, "finished_at": None, "steps": {}}
+
+async def warm_categories(config: Dict[str, Any]) -> Dict[str, Any]:
+    actions = ["get_live_categories", "get_vod_categories", "get_series_categories"]
+    results = await asyncio.gather(*(get_categories(config, action) for action in actions))
+    return {action: len(categories) if isinstance(categories, list) else 0 for action, categories in zip(actions, results)}
+
+async def warm_catalogs(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Load every catalog (including the live channel index) into the catalog cache.
+
+    A catalog never synced is only synced here when this worker claims the
+    scheduler's current run, so restarting workers do not each start a full
+    sync; with the scheduler disabled, warm-up loads what the store has.
+    """
+    state = await db.catalog_state.find_one({"account_id": config["id"]})
+    kinds = (state or {}).get("kinds", {})
+    if any(not kinds.get(kind, {}).get("synced_at") for kind in CATALOG_KINDS) and CATALOG_SYNC_INTERVAL > 0 \
+            and await claim_schedule("catalog_sync", CATALOG_SYNC_INTERVAL):
+        # Its own task, shielded: the warm-up timeout must not cancel a sync halfway through writing
+        sync = asyncio.create_task(sync_all_catalogs())
+        background_tasks.append(sync)
+        sync.add_done_callback(background_tasks.remove)
+        await asyncio.shield(sync)
+    
+    # A sync running here or in another worker is waited for, instead of caching the catalogs it replaces
+    while catalog_sync_lock.locked() or await lease_owner("catalog_sync"):
+        await asyncio.sleep(1)
+    
+    results = await asyncio.gather(*(load_catalog_from_store(config, kind) for kind in CATALOG_KINDS))
+    return {kind: len(items) if items is not None else None for kind, items in zip(CATALOG_KINDS, results)}
+
+async def run_warmup_step(name: str, step) -> None:
+    start = time.perf_counter()
+    warmup_state["steps"][name] = {"status": "running"}
+    try:
+        result = await step
+        warmup_state["steps"][name] = {"status": "done", "result": result}
     except Exception as e:
-        logger.error(f"Error fetching EPG: {e}")
-        return {"current": None, "next": None}
+        logger.error(f"Warm-up step {name} failed: {str(e)}")
+        warmup_state["steps"][name] = {"status": "failed", "error": str(e)}
+    finally:
+        warmup_state["steps"][name]["duration"] = round(time.perf_counter() - start, 3)
+
+async def warm_up():
+    """Prefetch categories, catalogs and the EPG index of the active account in parallel"""
+    warmup_state.update(status="running", started_at=datetime.utcnow())
+    try:
+        config = await db.xtream_config.find_one({"is_active": True})
+        if config:
+            await asyncio.wait_for(asyncio.gather(
+                run_warmup_step("categories", warm_categories(config)),
+                run_warmup_step("catalogs", warm_catalogs(config)),
+                run_warmup_step("epg_index", refresh_epg_index(config)),
+            ), WARMUP_TIMEOUT)
+        warmup_state["status"] = "done"
+    except asyncio.TimeoutError:
+        logger.warning(f"Warm-up did not finish within {WARMUP_TIMEOUT}s, serving traffic anyway")
+        warmup_state["status"] = "timed_out"
+    except Exception as e:
+        logger.error(f"Warm-up error: {str(e)}")
+        warmup_state["status"] = "failed"
+    finally:
+        warmup_state["finished_at"] = datetime.utcnow()
+        logger.info(f"Warm-up {warmup_state['status']}: {warmup_state['steps']}")
+
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the process is up and its event loop answers"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness probe: 503 until the warm-up finished and while MongoDB is unreachable"""
+    warming = WARMUP_ENABLED and warmup_state["status"] in ("pending", "running")
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), 2)
+        database = "ok"
+    except Exception as e:
+        database = f"error: {str(e) or type(e).__name__}"
+    
+    ready = not warming and database == "ok"
+    content = {"status": "ready" if ready else "not_ready", "database": database, "warmup": warmup_state}
+    return JSONResponse(status_code=200 if ready else 503, content=jsonable_encoder(content))
+
+# ==================== HOME SCREEN ====================
+
+HOME_CONTINUE_WATCHING_LIMIT = 20
+HOME_WATCHLIST_LIMIT = 50
+# Titles past this percentage count as finished and leave continue watching
+CONTINUE_WATCHING_MAX_PERCENTAGE = 95
+
+# Catalog fields kept on each continue watching entry
+CONTINUE_WATCHING_FIELDS = ("name", "stream_icon", "cover", "rating", "rating_5based", "category_id",
+                            "container_extension", "episode_run_time")
+
+def title_info_metadata(config: Dict[str, Any], kind: str, title_id: str) -> Optional[Dict[str, Any]]:
+    """Catalog-like fields from a title info already in the in-process cache, without calling upstream"""
+    info = title_info_cache.l1.peek((config["id"], kind, title_id))
+    if not isinstance(info, dict) or not isinstance(info.get("info"), dict):
+        return None
+    details = info["info"]
+    if kind == "vod":
+        movie_data = info.get("movie_data") or {}
+        return {
+            "name": details.get("name") or movie_data.get("name"),
+            "stream_icon": details.get("movie_image") or details.get("cover_big"),
+            "rating": details.get("rating"),
+            "container_extension": movie_data.get("container_extension")
+        }
+    return {"name": details.get("name"), "cover": details.get("cover"), "rating": details.get("rating")}
+
+async def join_catalog_metadata(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Attach title, poster and rating from the local catalog (or cached title info) to progress rows"""
+    config = await db.xtream_config.find_one({"is_active": True})
+    wanted: Dict[str, set] = {}
+    for item in items:
+        kind = STREAM_TYPE_KINDS.get(item.get("stream_type"))
+        if kind:
+            wanted.setdefault(kind, set()).add(str(item["stream_id"]))
+    
+    metadata = {}
+    if config and wanted:
+        projection = {"_id": 0, "kind": 1, "item_id": 1, **{f"data.{field}": 1 for field in CONTINUE_WATCHING_FIELDS}}
+        results = await asyncio.gather(*(
+            db.catalog_items.find(
+                {"account_id": config["id"], "kind": kind, "item_id": {"$in": list(ids)}, "removed": False},
+                projection
+            ).to_list(None)
+            for kind, ids in wanted.items()
+        ))
+        for docs in results:
+            for doc in docs:
+                metadata[(doc["kind"], doc["item_id"])] = doc.get("data", {})
+    
+    for item in items:
+        kind = STREAM_TYPE_KINDS.get(item.get("stream_type"))
+        title_id = str(item["stream_id"])
+        meta = metadata.get((kind, title_id))
+        if meta is None and config and kind:
+            meta = title_info_metadata(config, kind, title_id)
+        item["title"] = rewrite_image_fields(meta) if meta else None
+    return items
+
+async def get_continue_watching_items(user_code: str, profile_name: str, limit: int) -> List[Dict[str, Any]]:
+    """Titles started but not finished, most recent first, with their catalog metadata"""
+    items = await db.watch_progress.find(
+        {
+            "user_code": user_code,
+            "profile_name": profile_name,
+            "percentage": {"$gt": 0, "$lt": CONTINUE_WATCHING_MAX_PERCENTAGE}
+        },
+        {"_id": 0}
+    ).sort("last_watched", -1).limit(limit).to_list(None)
+    return await join_catalog_metadata(items)
+
+@api_router.get("/continue-watching/{user_code}/{profile_name}")
+async def get_continue_watching(user_code: str, profile_name: str, limit: int = HOME_CONTINUE_WATCHING_LIMIT):
+    """Get the continue watching rail: unfinished titles with name, poster and rating"""
+    return await get_continue_watching_items(user_code, profile_name, max(1, min(limit, 100)))
+
+async def get_home_categories(user_code: str, profile_name: str) -> Dict[str, Any]:
+    config = await get_xtream_config()
+    child, live, vod, series = await asyncio.gather(
+        is_child_profile(user_code, profile_name),
+        get_categories(config, "get_live_categories"),
+        get_categories(config, "get_vod_categories"),
+        get_categories(config, "get_series_categories"),
+    )
+    if child:
+        live, vod, series = (filter_child_categories(categories) for categories in (live, vod, series))
+    return {"live": live, "vod": vod, "series": series}
+
+@api_router.get("/home/{user_code}/{profile_name}")
+async def get_home(user_code: str, profile_name: str):
+    """Everything the home screen needs in one call.
+
+    Sections are fetched concurrently; a failing section is reported in
+    ``errors`` and returned as null instead of failing the whole screen.
+    """
+    sections = {
+        "user_code": db.user_codes.find_one({"code": user_code, "is_active": True}, {"_id": 0, "max_profiles": 1}),
+        "profiles": db.profiles.find({"user_code": user_code}, {"_id": 0}).to_list(100),
+        "notification": notification_hub.current(),
+        "continue_watching": get_continue_watching_items(user_code, profile_name, HOME_CONTINUE_WATCHING_LIMIT),
+        "watchlist": db.watchlist.find(
+            {"user_code": user_code, "profile_name": profile_name}, {"_id": 0}
+        ).sort("added_at", -1).limit(HOME_WATCHLIST_LIMIT).to_list(None),
+        "categories": get_home_categories(user_code, profile_name),
+    }
+    results = dict(zip(sections, await asyncio.gather(*sections.values(), return_exceptions=True)))
+    
+    user_code_doc = results.pop("user_code")
+    if isinstance(user_code_doc, Exception):
+        raise user_code_doc
+    if not user_code_doc:
+        raise HTTPException(status_code=404, detail="Invalid user code")
+    
+    home = {"code": user_code, "max_profiles": user_code_doc["max_profiles"], "profile": None, "errors": {}}
+    for name, value in results.items():
+        if isinstance(value, Exception):
+            logger.error(f"Home section {name} failed for {user_code}: {str(value)}")
+            home["errors"][name] = value.detail if isinstance(value, HTTPException) else str(value)
+            value = None
+        home[name] = value
+    
+    home["profile"] = next((profile for profile in home["profiles"] or [] if profile.get("name") == profile_name), None)
+    return home
+
+# ==================== PLAYLISTS ====================
+
+# Host written in playlist stream URLs instead of the account DNS (e.g. our relay)
+PLAYLIST_RELAY_URL = os.environ.get('PLAYLIST_RELAY_URL', '').rstrip('/')
+PLAYLIST_KINDS = ("live", "vod")
+PLAYLIST_OUTPUTS = ("ts", "m3u8")
+# Entries rendered per chunk of a streamed playlist
+PLAYLIST_CHUNK_ENTRIES = 1000
+# Playlist entries per account, filters and catalog version; stream URLs are written per request
+PLAYLIST_CACHE_BYTES = int(os.environ.get('PLAYLIST_CACHE_BYTES', str(128 * 1024 * 1024)))
+# Also bounds how long a playlist built straight from upstream (catalog not synced) is reused
+PLAYLIST_CACHE_TTL = int(os.environ.get('PLAYLIST_CACHE_TTL', '600'))
+playlist_cache = TieredCache(ByteLRUCache("playlist", PLAYLIST_CACHE_BYTES, PLAYLIST_CACHE_TTL))
+
+def playlist_credentials(user_code_doc: Dict[str, Any], config: Dict[str, Any]) -> tuple:
+    """(base URL, username, password) written in the stream URLs of a user code"""
+    if user_code_doc.get("dns_url") and user_code_doc.get("xtream_username"):
+        dns_url = user_code_doc["dns_url"]
+        username = user_code_doc["xtream_username"]
+        password = user_code_doc.get("xtream_password") or ""
+    else:
+        dns_url, username, password = config["dns_url"], config["username"], config["password"]
+    return PLAYLIST_RELAY_URL or dns_url.rstrip('/'), username, password
+
+def m3u_attribute(value: Any) -> str:
+    return str(value if value is not None else "").replace('"', "'").replace('\n', ' ')
+
+def playlist_snapshot(sources: Dict[str, Any], categories: Optional[set]) -> Dict[str, Any]:
+    """Filtered playlist entries of the loaded catalogs and a hash of them.
+
+    Rows are [tvg id, name, logo, group, kind, stream]: ``stream`` is a live
+    stream id or URL, or ``<id>.<extension>`` for movies, so the cached rows
+    serve every user code of the account.
+    """
+    rows = []
+    for channel in sources.get("live", ()):
+        group, name = channel.get("category_id") or "", channel.get("name") or ""
+        if categories is not None and group not in categories:
+            continue
+        stream_id = catalog_item_id("live", channel)
+        stream = stream_id if stream_id and stream_id.isdigit() else channel.get("stream_url")
+        if stream:
+            rows.append([channel.get("stream_id"), name, rewrite_image_fields(channel).get("stream_icon"), group,
+                         "live", stream])
+    
+    category_names = sources.get("vod_category_names", {})
+    for movie in sources.get("vod", ()):
+        group = category_names.get(str(movie.get("category_id")), "")
+        name = movie.get("name") or ""
+        if (categories is not None and group not in categories) or movie.get("stream_id") is None:
+            continue
+        extension = movie.get("container_extension") or "mp4"
+        rows.append([movie["stream_id"], name, rewrite_image_fields(movie).get("stream_icon"), group,
+                     "movie", f"{movie['stream_id']}.{extension}"])
+    
+    digest = hashlib.sha1(json.dumps(rows, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+    return {"hash": digest, "rows": rows}
+
+def render_playlist(rows: List[list], base_url: str, username: str, password: str, output: str):
+    """Yield the playlist PLAYLIST_CHUNK_ENTRIES entries at a time"""
+    chunk = ["#EXTM3U\n"]
+    for tvg_id, name, logo, group, kind, stream in rows:
+        if kind == "movie":
+            url = f"{base_url}/movie/{username}/{password}/{stream}"
+        elif stream.isdigit():
+            url = f"{base_url}/live/{username}/{password}/{stream}.{output}"
+        else:
+            url = stream
+        chunk.append(f'#EXTINF:-1 tvg-id="{m3u_attribute(tvg_id)}" tvg-name="{m3u_attribute(name)}" '
+                     f'tvg-logo="{m3u_attribute(logo)}" group-title="{m3u_attribute(group)}",{m3u_attribute(name)}\n'
+                     f'{url}\n')
+        if len(chunk) >= PLAYLIST_CHUNK_ENTRIES:
+            yield "".join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield "".join(chunk).encode('utf-8')
+
+async def load_playlist_sources(config: Dict[str, Any], kinds: List[str], is_child: bool) -> Dict[str, Any]:
+    """Catalogs a playlist is built from: the local store, or upstream when never synced"""
+    sources = {}
+    
+    if "live" in kinds:
+        channels = await load_catalog_from_store(config, "live", child_safe=is_child)
+        if channels is None:
+            channels = await fetch_live_channels(config)
+            if is_child:
+                channels = [channel for channel in channels if is_child_safe(channel, {})]
+        sources["live"] = channels
+    
+    if "vod" in kinds:
+        category_names = await get_category_names(config, "vod")
+        movies = await load_catalog_from_store(config, "vod", child_safe=is_child)
+        if movies is None:
+            movies = await fetch_player_api(config, "get_vod_streams", stale_fallback=True)
+            movies = [movie for movie in movies if isinstance(movie, dict)] if isinstance(movies, list) else []
+            if is_child:
+                movies = [movie for movie in movies if is_child_safe(movie, category_names)]
+        sources["vod"] = movies
+        sources["vod_category_names"] = category_names
+    
+    return sources
+
+async def get_playlist_snapshot(config: Dict[str, Any], kinds: List[str], categories: Optional[set],
+                                is_child: bool) -> Dict[str, Any]:
+    """Playlist rows through the playlist cache, keyed on the filters and the catalog version"""
+    state = await db.catalog_state.find_one({"account_id": config["id"]}, {"_id": 0, "version": 1, "synced_at": 1})
+    # A sync publishes a new version or synced_at; playlists built from upstream only expire with the TTL
+    catalog = f"{state['version']}@{state['synced_at'].timestamp()}" \
+        if state and state.get("version") and state.get("synced_at") else "upstream"
+    selection = hashlib.sha1(json.dumps(sorted(categories)).encode('utf-8')).hexdigest() \
+        if categories is not None else "all"
+    key = (config["id"], ",".join(kinds), selection, is_child, catalog, IMAGE_PROXY_BASE_URL)
+    
+    snapshot = await playlist_cache.get(key)
+    if snapshot is None:
+        sources = await load_playlist_sources(config, kinds, is_child)
+        snapshot = await asyncio.to_thread(playlist_snapshot, sources, categories)
+        await playlist_cache.set(key, snapshot)
+    return snapshot
+
+@api_router.get("/playlist/{user_code}/{profile_name}.m3u")
+async def get_profile_playlist(request: Request, user_code: str, profile_name: str, categories: Optional[str] = None,
+                               kinds: str = "live", output: str = "ts"):
+    """M3U playlist of a profile for third-party players.
+
+    ``categories`` is a comma separated list of group titles, ``kinds`` one or
+    both of live and vod. Child profiles get the child-safe catalog view.
+    """
+    requested_kinds = sorted({kind.strip() for kind in kinds.split(',') if kind.strip()})
+    if not requested_kinds or any(kind not in PLAYLIST_KINDS for kind in requested_kinds):
+        raise HTTPException(status_code=400, detail="Invalid kinds, use live and/or vod")
+    if output not in PLAYLIST_OUTPUTS:
+        raise HTTPException(status_code=400, detail="Invalid output, use ts or m3u8")
+    
+    user_code_doc, profile, config = await asyncio.gather(
+        db.user_codes.find_one({"code": user_code, "is_active": True}),
+        db.profiles.find_one({"user_code": user_code, "name": profile_name}),
+        get_xtream_config()
+    )
+    if not user_code_doc:
+        raise HTTPException(status_code=404, detail="Invalid user code")
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    selected_categories = {name.strip() for name in categories.split(',') if name.strip()} if categories else None
+    base_url, username, password = playlist_credentials(user_code_doc, config)
+    
+    try:
+        # Loaded before the response starts, so an upstream error is still a 500 and not a truncated playlist
+        snapshot = await get_playlist_snapshot(config, requested_kinds, selected_categories, bool(profile.get("is_child")))
+    except Exception as e:
+        logger.error(f"Error building playlist for {user_code}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error connecting to IPTV service: {str(e)}")
+    
+    signature = json.dumps([snapshot["hash"], base_url, username, password, output])
+    headers = {
+        "ETag": f'"{hashlib.sha1(signature.encode("utf-8")).hexdigest()}"',
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f'inline; filename="{user_code}.m3u"'
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    # A plain generator: Starlette iterates it in its thread pool, off the event loop
+    return StreamingResponse(render_playlist(snapshot["rows"], base_url, username, password, output),
+                             media_type="audio/x-mpegurl", headers=headers)
 
 # ==================== MAIN APP CONFIGURATION ====================
 
@@ -1080,6 +4669,9 @@ async def root():
 
 app.include_router(api_router)
 
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1088,6 +4680,109 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Raised by create_index when an index with the same keys exists with other options
+INDEX_OPTIONS_CONFLICT = 85
+
+async def ensure_index(collection, keys: Any, **options) -> None:
+    """Create one index; a TTL index whose expiry changed is updated in place with collMod"""
+    try:
+        await collection.create_index(keys, **options)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT or "expireAfterSeconds" not in options:
+            raise
+        key_pattern = {keys: 1} if isinstance(keys, str) else dict(keys)
+        await db.command("collMod", collection.name,
+                         index={"keyPattern": key_pattern, "expireAfterSeconds": options["expireAfterSeconds"]})
+        logger.info(f"TTL of index {key_pattern} on {collection.name} set to {options['expireAfterSeconds']}s")
+
+async def ensure_indexes():
+    """Create the indexes the background jobs and local catalog rely on.
+
+    Each index is created on its own, so one that fails is logged without
+    skipping the others.
+    """
+    indexes = [
+        (db.catalog_items, [("account_id", 1), ("kind", 1), ("item_id", 1)], {"unique": True}),
+        (db.catalog_items, [("account_id", 1), ("kind", 1), ("removed", 1), ("category_id", 1), ("position", 1)], {}),
+        (db.catalog_items, [("account_id", 1), ("kind", 1), ("removed", 1), ("child_safe", 1), ("category_id", 1),
+                            ("position", 1)], {}),
+        (db.catalog_items, [("account_id", 1), ("version", 1)], {}),
+        (db.catalog_state, "account_id", {"unique": True}),
+        (db.cache_entries, "expires_at", {"expireAfterSeconds": 0}),
+        (db.user_codes, [("dns_url", 1), ("xtream_username", 1)], {}),
+        (db.user_codes, "xtream_config_id", {}),
+        (db.user_codes, "account_health.status", {}),
+        (db.admin_jobs, "id", {"unique": True}),
+        (db.admin_jobs, [("type", 1), ("created_at", -1)], {}),
+        (db.dns_migration_results, [("job_id", 1), ("code", 1)], {"unique": True}),
+        (db.dns_migration_results, [("job_id", 1), ("status", 1)], {}),
+        (db.profiles, "user_code", {}),
+        (db.watchlist, [("user_code", 1), ("profile_name", 1), ("added_at", -1)], {}),
+        (db.watch_progress, [("user_code", 1), ("profile_name", 1), ("last_watched", -1)], {}),
+        (db.watch_progress, "last_watched", {}),
+        (db.watch_progress_archive, "archived_at", {"expireAfterSeconds": WATCH_PROGRESS_ARCHIVE_TTL_DAYS * 86400}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await ensure_index(collection, keys, **options)
+        except Exception as e:
+            logger.error(f"Error creating index {keys} on {collection.name}: {str(e)}")
+    try:
+        await ensure_progress_archive_index()
+    except Exception as e:
+        logger.error(f"Error creating the unique index on archived watch progress: {str(e)}")
+
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_background_jobs():
+    # On its own: a failure creating another index must not leave code generation without it
+    try:
+        await ensure_user_code_index()
+    except Exception as e:
+        logger.error(f"Error creating the unique index on user codes: {str(e)}")
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Error creating indexes: {str(e)}")
+    try:
+        await mark_interrupted_admin_jobs()
+    except Exception as e:
+        logger.error(f"Error recovering admin jobs: {str(e)}")
+    try:
+        await load_image_proxy_secret()
+    except Exception as e:
+        logger.error(f"Error loading the image proxy key, image URLs will not be proxied: {str(e)}")
+    
+    # Every worker runs every loop: those writing shared data claim each run through a lease,
+    # the others (loop monitor, title prefetch, EPG index, notifications) keep per-worker state
+    if LOOP_LAG_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(loop_monitor.run()))
+    if CATALOG_SYNC_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(catalog_sync_loop()))
+    if TITLE_PREFETCH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(title_prefetch_loop()))
+    if ACCOUNT_SCAN_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(account_scan_loop()))
+    if EPG_INDEX_REFRESH > 0:
+        background_tasks.append(asyncio.create_task(epg_index_loop()))
+    if NOTIFICATION_REFRESH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(notification_refresh_loop()))
+    if WATCH_PROGRESS_COMPACTION_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(watch_progress_compaction_loop()))
+    # Started last so the scheduler claims a due catalog sync before the warm-up looks at the store
+    if WARMUP_ENABLED:
+        background_tasks.append(asyncio.create_task(warm_up()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks + list(admin_job_tasks.values()):
+        task.cancel()
+    if upstream_client:
+        await upstream_client.aclose()
+    scraper_executor.shutdown(wait=False, cancel_futures=True)
+    if cpu_executor:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+    for pool in scraper_pools.values():
+        pool.close()
     client.close()
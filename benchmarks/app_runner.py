@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Run the backend under uvicorn for benchmarks.
+
+With ``--mongo mock`` the Motor client is replaced by mongomock-motor, an
+in-memory stand-in, so no MongoDB server is needed. Any other value is used
+as the MongoDB URL.
+
+    python -m benchmarks.app_runner --port 9200 --mongo mock
+"""
+
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the IPTV backend for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--mongo", default="mock", help="'mock' or a MongoDB URL")
+    parser.add_argument("--db-name", default="iptv_bench")
+    args = parser.parse_args()
+
+    os.environ["MONGO_URL"] = "mongodb://127.0.0.1:27017" if args.mongo == "mock" else args.mongo
+    os.environ["DB_NAME"] = args.db_name
+    # Background jobs would add traffic the load test does not control
+    os.environ.setdefault("CATALOG_SYNC_INTERVAL", "0")
+    os.environ.setdefault("TITLE_PREFETCH_INTERVAL", "0")
+    os.environ.setdefault("EPG_INDEX_REFRESH", "0")
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    # One log line per upstream request would dominate the benchmark
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.mongo == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[args.db_name]
+
+    import uvicorn
+    uvicorn.run(server.app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the in-memory catalog representations of the backend.
+
+Compares the list of dicts returned by ``response.json()`` with
+``CompactCatalog`` built row by row (as ``load_catalog_from_store`` does) on
+deterministic VOD, series and live catalogs. Each case runs in its own
+subprocess and reports the RSS and traced memory retained by the catalog, the
+build time and the JSON encoding time of a full response.
+
+    python -m benchmarks.catalog_memory_bench
+    python -m benchmarks.catalog_memory_bench --cases vod_100k --repeats 3
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict
+
+from benchmarks import fixtures
+from benchmarks.parser_bench import BACKEND_DIR, BENCH_DIR, read_status, reset_peak_rss
+
+# (name, kind, entries)
+CASES = [
+    ("vod_10k", "vod", 10_000),
+    ("vod_100k", "vod", 100_000),
+    ("series_50k", "series", 50_000),
+    ("live_50k", "live", 50_000),
+]
+REPRESENTATIONS = ("dicts", "compact")
+
+def make_catalog(kind: str, entries: int, seed: int) -> list:
+    rng = random.Random(seed)
+    categories = fixtures.make_categories(rng, kind.upper(), 80)
+    if kind == "vod":
+        return fixtures.make_vod_streams(rng, entries, categories, "http://panel.example")
+    if kind == "series":
+        return fixtures.make_series(rng, entries, categories, "http://panel.example")
+    return fixtures.make_live_channels(rng, entries, categories, "http://panel.example")
+
+def run_case(kind: str, entries: int, representation: str, seed: int, repeats: int) -> Dict[str, Any]:
+    """Load one catalog in one representation, inside the current process"""
+    os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+    os.environ.setdefault("DB_NAME", "iptv_bench")
+    os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="iptv-bench-images-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    items = make_catalog(kind, entries, seed)
+    # What upstream (or the catalog store) hands over: one JSON document, or one document per row
+    payload = json.dumps(items).encode("utf-8")
+    rows = [json.dumps(item).encode("utf-8") for item in items]
+    del items
+
+    def load():
+        if representation == "dicts":
+            return json.loads(payload)
+        catalog = server.CompactCatalog()
+        for row in rows:
+            catalog.append(json.loads(row))
+        catalog.freeze()
+        return catalog
+
+    gc.collect()
+    rss_supported = reset_peak_rss()
+    rss_before = read_status("VmRSS:")
+    tracemalloc.start()
+    catalog = load()
+    gc.collect()
+    traced_retained, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_retained_kb = read_status("VmRSS:") - rss_before
+    peak_rss_kb = read_status("VmHWM:") - rss_before if rss_supported else None
+
+    # Timings without tracemalloc, which slows allocations down
+    build_timings = []
+    encode_timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        load()
+        build_timings.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        if representation == "dicts":
+            json.dumps(catalog, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        else:
+            catalog.to_json()
+        encode_timings.append(time.perf_counter() - start)
+
+    rng = random.Random(seed)
+    positions = [rng.randrange(len(catalog)) for _ in range(10_000)]
+    start = time.perf_counter()
+    for position in positions:
+        catalog[position]
+    row_access_us = (time.perf_counter() - start) / len(positions) * 1e6
+
+    return {
+        "entries": len(catalog),
+        "json_mb": round(len(payload) / 1024 / 1024, 2),
+        "retained_mb": round(traced_retained / 1024 / 1024, 2),
+        "alloc_peak_mb": round(traced_peak / 1024 / 1024, 2),
+        "rss_retained_mb": round(rss_retained_kb / 1024, 2),
+        "peak_rss_growth_mb": round(peak_rss_kb / 1024, 2) if peak_rss_kb is not None else None,
+        "build_s": round(statistics.median(build_timings), 3),
+        "encode_s": round(statistics.median(encode_timings), 4),
+        "row_access_us": round(row_access_us, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory catalog representation benchmark")
+    parser.add_argument("--cases", help="Comma separated case names (default: all)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the results as JSON")
+    # Internal: run a single case in this process and print its JSON result
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--representation", choices=REPRESENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    cases = {name: (kind, entries) for name, kind, entries in CASES}
+
+    if args.run_case:
+        kind, entries = cases[args.run_case]
+        print(json.dumps(run_case(kind, entries, args.representation, args.seed, args.repeats)))
+        return
+
+    selected = args.cases.split(",") if args.cases else [name for name, *_ in CASES]
+    unknown = [name for name in selected if name not in cases]
+    if unknown:
+        parser.error(f"Unknown case(s): {', '.join(unknown)}")
+
+    results = {"python": sys.version.split()[0], "seed": args.seed, "cases": {}}
+    print(f"{'case':<12} {'repr':<8} {'json MB':>8} {'kept MB':>8} {'rss MB':>8} {'peak MB':>8} "
+          f"{'build s':>8} {'encode s':>9} {'row us':>7}")
+    for name in selected:
+        results["cases"][name] = {}
+        for representation in REPRESENTATIONS:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.catalog_memory_bench", "--run-case", name,
+                 "--representation", representation, "--repeats", str(args.repeats), "--seed", str(args.seed)],
+                cwd=BENCH_DIR.parent, capture_output=True, text=True, check=True
+            )
+            case = json.loads(output.stdout.strip().splitlines()[-1])
+            results["cases"][name][representation] = case
+            print(f"{name:<12} {representation:<8} {case['json_mb']:>8} {case['retained_mb']:>8} "
+                  f"{case['rss_retained_mb']:>8} {case['peak_rss_growth_mb']:>8} {case['build_s']:>8} "
+                  f"{case['encode_s']:>9} {case['row_access_us']:>7}")
+
+        dicts, compact = results["cases"][name]["dicts"], results["cases"][name]["compact"]
+        if compact["retained_mb"]:
+            print(f"{name:<12} compact keeps {dicts['retained_mb'] / compact['retained_mb']:.1f}x less memory")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Local fake Xtream Codes panel for benchmarks.
+
+Serves player_api.php, get.php (M3U) and xmltv.php from deterministic
+synthetic catalogs, with configurable latency and error injection.
+
+    python -m benchmarks.fake_xtream --port 9100 --vod 20000 --latency-ms 50
+"""
+
+import argparse
+import asyncio
+import random
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+from benchmarks import fixtures
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+@dataclass
+class FakePanelConfig:
+    base_url: str = "http://127.0.0.1:9100"
+    live_count: int = 2000
+    vod_count: int = 20000
+    series_count: int = 5000
+    categories: int = 40
+    epg_days: int = 2
+    # Added to every response, plus a uniform random jitter
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    # Fraction of requests answered with a 500, and of requests stalled for stall_ms
+    error_rate: float = 0
+    stall_rate: float = 0
+    stall_ms: float = 5000
+    seed: int = 42
+
+def create_fake_panel(config: FakePanelConfig) -> FastAPI:
+    rng = random.Random(config.seed)
+    live_categories = fixtures.make_categories(rng, "LIVE", config.categories)
+    vod_categories = fixtures.make_categories(rng, "VOD", config.categories)
+    series_categories = fixtures.make_categories(rng, "SERIES", config.categories)
+    live = fixtures.make_live_channels(rng, config.live_count, live_categories, config.base_url)
+    vod = fixtures.make_vod_streams(rng, config.vod_count, vod_categories, config.base_url)
+    series = fixtures.make_series(rng, config.series_count, series_categories, config.base_url)
+    vod_by_id = {str(stream["stream_id"]): stream for stream in vod}
+    series_by_id = {str(item["series_id"]): item for item in series}
+
+    # Built on first request, the XMLTV guide is slow to render for large sizes
+    rendered = {}
+    requests = Counter()
+    fault_rng = random.Random(config.seed + 1)
+
+    app = FastAPI()
+
+    async def inject_faults(endpoint: str):
+        requests[endpoint] += 1
+        delay = config.latency_ms + fault_rng.uniform(0, config.jitter_ms)
+        if config.stall_rate and fault_rng.random() < config.stall_rate:
+            delay += config.stall_ms
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if config.error_rate and fault_rng.random() < config.error_rate:
+            requests[f"{endpoint}:error"] += 1
+            raise HTTPException(status_code=500, detail="Injected error")
+
+    def check_credentials(request: Request):
+        if request.query_params.get("username") != USERNAME or request.query_params.get("password") != PASSWORD:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    @app.get("/player_api.php")
+    async def player_api(request: Request):
+        action = request.query_params.get("action", "")
+        await inject_faults(f"player_api:{action or 'account_info'}")
+        check_credentials(request)
+        category_id = request.query_params.get("category_id")
+
+        if not action:
+            return {
+                "user_info": {
+                    "username": USERNAME,
+                    "status": "Active",
+                    "exp_date": str(int((datetime.utcnow() + timedelta(days=365)).timestamp())),
+                    "max_connections": "2",
+                    "active_cons": "0",
+                    "auth": 1
+                },
+                "server_info": {"url": config.base_url, "timezone": "UTC"}
+            }
+        if action == "get_live_categories":
+            return live_categories
+        if action == "get_vod_categories":
+            return vod_categories
+        if action == "get_series_categories":
+            return series_categories
+        if action == "get_vod_streams":
+            return [stream for stream in vod if not category_id or stream["category_id"] == category_id]
+        if action == "get_series":
+            return [item for item in series if not category_id or item["category_id"] == category_id]
+        if action == "get_vod_info":
+            stream = vod_by_id.get(request.query_params.get("vod_id", ""))
+            return fixtures.make_vod_info(stream) if stream else []
+        if action == "get_series_info":
+            item = series_by_id.get(request.query_params.get("series_id", ""))
+            return fixtures.make_series_info(random.Random(item["series_id"]), item) if item else []
+        if action == "get_short_epg":
+            return {"epg_listings": []}
+        return JSONResponse([], status_code=200)
+
+    @app.get("/get.php")
+    async def get_m3u(request: Request):
+        await inject_faults("m3u")
+        check_credentials(request)
+        if "m3u" not in rendered:
+            rendered["m3u"] = fixtures.render_m3u(live, config.base_url, USERNAME, PASSWORD)
+        return PlainTextResponse(rendered["m3u"], media_type="audio/x-mpegurl")
+
+    @app.get("/xmltv.php")
+    async def get_xmltv(request: Request):
+        await inject_faults("xmltv")
+        check_credentials(request)
+        if "xmltv" not in rendered:
+            start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=6)
+            xml = fixtures.render_xmltv(random.Random(config.seed + 2), live, start, config.epg_days)
+            rendered["xmltv"] = xml.encode("utf-8")
+        return Response(rendered["xmltv"], media_type="application/xml")
+
+    @app.get("/__stats")
+    async def stats():
+        """Requests served per endpoint, to check how much traffic reaches upstream"""
+        return dict(requests)
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Xtream Codes panel")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--live", type=int, default=FakePanelConfig.live_count)
+    parser.add_argument("--vod", type=int, default=FakePanelConfig.vod_count)
+    parser.add_argument("--series", type=int, default=FakePanelConfig.series_count)
+    parser.add_argument("--categories", type=int, default=FakePanelConfig.categories)
+    parser.add_argument("--epg-days", type=int, default=FakePanelConfig.epg_days)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--stall-rate", type=float, default=0)
+    parser.add_argument("--stall-ms", type=float, default=FakePanelConfig.stall_ms)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    config = FakePanelConfig(
+        base_url=f"http://{args.host}:{args.port}",
+        live_count=args.live,
+        vod_count=args.vod,
+        series_count=args.series,
+        categories=args.categories,
+        epg_days=args.epg_days,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        stall_rate=args.stall_rate,
+        stall_ms=args.stall_ms,
+        seed=args.seed
+    )
+
+    import uvicorn
+    uvicorn.run(create_fake_panel(config), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Deterministic synthetic Xtream catalogs, M3U playlists and XMLTV guides.
+
+Every generator takes a ``random.Random`` so the same seed always produces
+the same data, which keeps benchmark runs comparable.
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+GENRES = ["Action", "Comédie", "Drame", "Documentaire", "Animation", "Thriller", "Science-Fiction", "Horreur"]
+COUNTRIES = ["FR", "BE", "CH", "CA", "UK", "US", "ES", "IT", "DE", "AR"]
+# Channel names seen on real panels mix scripts, emoji and quality tags
+UNICODE_NAMES = ["Télé Été", "الجزيرة", "ТВ Центр", "中央电视台", "Ελληνική", "⚽ Sport", "Ñandú TV", "日本 ニュース", "Ümit", "★ Cinéma"]
+WORDS = ["Nuit", "Soleil", "Retour", "Mission", "Histoire", "Secret", "Dernier", "Voyage",
+         "Ombre", "Cité", "Empire", "Légende", "Horizon", "Fleuve", "Tempête", "Mémoire"]
+
+def make_title(rng: random.Random, index: int) -> str:
+    return f"{rng.choice(WORDS)} {rng.choice(WORDS)} {index}"
+
+def make_categories(rng: random.Random, prefix: str, count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "category_id": str(index + 1),
+            "category_name": f"{prefix} | {rng.choice(COUNTRIES)} {rng.choice(GENRES)} {index + 1}",
+            "parent_id": 0
+        }
+        for index in range(count)
+    ]
+
+def make_vod_streams(rng: random.Random, count: int, categories: List[Dict[str, Any]], base_url: str) -> List[Dict[str, Any]]:
+    start = int(datetime(2020, 1, 1).timestamp())
+    streams = []
+    for index in range(count):
+        stream_id = 100000 + index
+        rating = round(rng.uniform(1, 10), 1)
+        streams.append({
+            "num": index + 1,
+            "name": make_title(rng, index),
+            "stream_type": "movie",
+            "stream_id": stream_id,
+            "stream_icon": f"{base_url}/images/vod/{stream_id}.jpg",
+            "rating": str(rating),
+            "rating_5based": round(rating / 2, 1),
+            "added": str(start + rng.randrange(0, 5 * 365 * 86400)),
+            "category_id": rng.choice(categories)["category_id"],
+            "container_extension": rng.choice(["mp4", "mkv"]),
+            "custom_sid": "",
+            "direct_source": ""
+        })
+    return streams
+
+def make_series(rng: random.Random, count: int, categories: List[Dict[str, Any]], base_url: str) -> List[Dict[str, Any]]:
+    series = []
+    for index in range(count):
+        series_id = 200000 + index
+        rating = round(rng.uniform(1, 10), 1)
+        series.append({
+            "num": index + 1,
+            "name": make_title(rng, index),
+            "series_id": series_id,
+            "cover": f"{base_url}/images/series/{series_id}.jpg",
+            "plot": " ".join(rng.choice(WORDS).lower() for _ in range(30)),
+            "cast": ", ".join(make_title(rng, n) for n in range(3)),
+            "director": make_title(rng, index),
+            "genre": rng.choice(GENRES),
+            "releaseDate": f"{rng.randrange(1990, 2025)}-01-01",
+            "last_modified": str(1600000000 + index),
+            "rating": str(rating),
+            "rating_5based": round(rating / 2, 1),
+            "backdrop_path": [f"{base_url}/images/series/{series_id}-backdrop.jpg"],
+            "youtube_trailer": "",
+            "episode_run_time": str(rng.choice([22, 45, 52])),
+            "category_id": rng.choice(categories)["category_id"]
+        })
+    return series
+
+def make_live_channels(rng: random.Random, count: int, categories: List[Dict[str, Any]], base_url: str) -> List[Dict[str, Any]]:
+    channels = []
+    for index in range(count):
+        stream_id = 300000 + index
+        channels.append({
+            "stream_id": stream_id,
+            "name": f"{rng.choice(COUNTRIES)} | {make_title(rng, index)} {rng.choice(['HD', 'FHD', '4K', 'SD'])}",
+            "epg_channel_id": f"ch{stream_id}.{rng.choice(COUNTRIES).lower()}",
+            "stream_icon": f"{base_url}/images/live/{stream_id}.png",
+            "category_name": rng.choice(categories)["category_name"]
+        })
+    return channels
+
+def make_vod_info(stream: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "info": {
+            "name": stream["name"],
+            "movie_image": stream["stream_icon"],
+            "cover_big": stream["stream_icon"],
+            "plot": f"Synopsis de {stream['name']}",
+            "genre": "Drame",
+            "duration_secs": 6000,
+            "rating": stream["rating"]
+        },
+        "movie_data": {
+            "stream_id": stream["stream_id"],
+            "name": stream["name"],
+            "category_id": stream["category_id"],
+            "container_extension": stream["container_extension"]
+        }
+    }
+
+def make_series_info(rng: random.Random, series: Dict[str, Any], seasons: int = 3, episodes: int = 10) -> Dict[str, Any]:
+    return {
+        "seasons": [{"season_number": season + 1, "name": f"Saison {season + 1}"} for season in range(seasons)],
+        "info": {key: series[key] for key in ("name", "cover", "plot", "cast", "genre", "rating", "backdrop_path")},
+        "episodes": {
+            str(season + 1): [
+                {
+                    "id": str(series["series_id"] * 1000 + season * 100 + episode),
+                    "episode_num": episode + 1,
+                    "title": f"{series['name']} - S{season + 1:02d}E{episode + 1:02d}",
+                    "container_extension": "mkv",
+                    "info": {"duration_secs": rng.choice([1320, 2700, 3120])}
+                }
+                for episode in range(episodes)
+            ]
+            for season in range(seasons)
+        }
+    }
+
+def render_m3u(channels: List[Dict[str, Any]], base_url: str, username: str, password: str,
+               rng: Optional[random.Random] = None, noise: float = 0.0) -> str:
+    """Render an m3u_plus playlist.
+
+    With ``noise`` > 0, that fraction of entries gets the irregularities real
+    panels produce: missing or empty attributes, extra attributes, unicode
+    names, #EXTVLCOPT lines, blank lines and Windows line endings.
+    """
+    lines = ["#EXTM3U x-tvg-url=\"\""]
+    for channel in channels:
+        name = channel["name"]
+        attributes = [
+            ("tvg-id", channel["epg_channel_id"]),
+            ("tvg-name", name),
+            ("tvg-logo", channel["stream_icon"]),
+            ("group-title", channel["category_name"]),
+        ]
+        extra_lines = []
+        if rng and noise and rng.random() < noise:
+            quirk = rng.randrange(6)
+            if quirk == 0:
+                attributes = [attr for attr in attributes if attr[0] != "tvg-id"]
+            elif quirk == 1:
+                attributes = [(key, "" if key == "tvg-logo" else value) for key, value in attributes]
+            elif quirk == 2:
+                name = f"{rng.choice(UNICODE_NAMES)} {name}"
+                attributes = [(key, name if key == "tvg-name" else value) for key, value in attributes]
+            elif quirk == 3:
+                attributes.insert(1, ("tvg-chno", str(rng.randrange(1, 999))))
+                attributes.append(("catchup", "default"))
+                attributes.append(("catchup-days", str(rng.randrange(1, 8))))
+            elif quirk == 4:
+                extra_lines.append("#EXTVLCOPT:http-user-agent=Mozilla/5.0")
+            else:
+                extra_lines.append("")
+
+        rendered = " ".join(f'{key}="{value}"' for key, value in attributes)
+        lines.append(f"#EXTINF:-1 {rendered},{name}")
+        lines.extend(extra_lines)
+        lines.append(f"{base_url}/{username}/{password}/{channel['stream_id']}")
+
+    newline = "\r\n" if rng and noise and rng.random() < 0.5 else "\n"
+    return newline.join(lines) + newline
+
+def render_xmltv(rng: random.Random, channels: List[Dict[str, Any]], start: datetime, days: int,
+                 programme_minutes: tuple = (30, 60, 90), noise: float = 0.0) -> str:
+    """Render an XMLTV guide covering ``days`` days from ``start`` for every channel.
+
+    With ``noise`` > 0, programmes get optional elements (lang attributes,
+    sub-titles, categories, episode numbers, credits) and unicode titles.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<tv generator-info-name="fake-xtream">']
+    for channel in channels:
+        parts.append(
+            f'<channel id={quoteattr(channel["epg_channel_id"])}>'
+            f'<display-name>{escape(channel["name"])}</display-name>'
+            f'<icon src={quoteattr(channel["stream_icon"])}/></channel>'
+        )
+
+    end = start + timedelta(days=days)
+    for channel in channels:
+        current = start
+        while current < end:
+            stop = current + timedelta(minutes=rng.choice(programme_minutes))
+            title = make_title(rng, 0)
+            extra = ""
+            if noise and rng.random() < noise:
+                title = f"{rng.choice(UNICODE_NAMES)} : {title}"
+                extra = (
+                    f'<sub-title lang="fr">{escape(make_title(rng, 1))}</sub-title>'
+                    f'<category lang="fr">{escape(rng.choice(GENRES))}</category>'
+                    f'<episode-num system="xmltv_ns">{rng.randrange(5)}.{rng.randrange(20)}.</episode-num>'
+                    f'<credits><actor>{escape(make_title(rng, 2))}</actor></credits>'
+                )
+            parts.append(
+                f'<programme start="{current:%Y%m%d%H%M%S} +0000" stop="{stop:%Y%m%d%H%M%S} +0000" '
+                f'channel={quoteattr(channel["epg_channel_id"])}>'
+                f'<title lang="fr">{escape(title)}</title>'
+                f'<desc lang="fr">{escape(" ".join(rng.choice(WORDS) for _ in range(12)))}</desc>{extra}</programme>'
+            )
+            current = stop
+
+    parts.append("</tv>")
+    return "\n".join(parts)
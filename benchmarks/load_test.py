@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Reproducible load test of the backend against a local fake Xtream panel.
+
+Starts the fake panel and the backend (on MongoDB or an in-memory stand-in)
+as subprocesses, seeds users and profiles through the API, then drives a
+weighted traffic mix (app launch, browse, detail open, playback heartbeats)
+at increasing concurrency. Reports throughput, p50/p95/p99 latency and the
+backend's memory for each level, and optionally saves or compares against a
+baseline.
+
+    python -m benchmarks.load_test --concurrency 1,8,32 --duration 15
+    python -m benchmarks.load_test --save-baseline
+    python -m benchmarks.load_test --compare
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "load_test.json"
+
+# Scenario weights of the traffic mix
+TRAFFIC_MIX = {
+    "app_launch": 0.1,
+    "browse": 0.3,
+    "detail_open": 0.3,
+    "playback_heartbeat": 0.3,
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def read_process_status(pid: int) -> Dict[str, Optional[int]]:
+    """Current and peak RSS in kB of one process (Linux only)"""
+    memory = {"rss_kb": None, "peak_rss_kb": None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    memory["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_kb"] = int(line.split()[1])
+    except OSError:
+        pass
+    return memory
+
+def descendant_pids(pid: int) -> List[int]:
+    """Children of a process, recursively (the backend's CPU pool workers)"""
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # The command name in parentheses may contain spaces, the fields after it do not
+            fields = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry.name))
+    pids, pending = [], [pid]
+    while pending:
+        children = parents.get(pending.pop(), [])
+        pids.extend(children)
+        pending.extend(children)
+    return pids
+
+def reset_peak_rss(pid: int) -> None:
+    """Reset VmHWM of the backend and its children, so each level reports its own peak (Linux >= 4.0)"""
+    for target in [pid] + descendant_pids(pid):
+        try:
+            Path(f"/proc/{target}/clear_refs").write_text("5")
+        except OSError:
+            pass
+
+def process_memory(pid: int) -> Dict[str, Optional[int]]:
+    """RSS and peak RSS in kB of the backend worker, and RSS of the worker with its children"""
+    memory = read_process_status(pid)
+    children = [read_process_status(child)["rss_kb"] or 0 for child in descendant_pids(pid)]
+    memory["children"] = len(children)
+    memory["total_rss_kb"] = (memory["rss_kb"] or 0) + sum(children) if memory["rss_kb"] is not None else None
+    return memory
+
+async def wait_for(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url, timeout=2)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, seed: int):
+        self.client = client
+        self.seed = seed
+        self.users: List[Dict[str, str]] = []
+        self.vod_category_ids: List[str] = []
+        self.series_category_ids: List[str] = []
+        self.vod_ids: List[str] = []
+        self.series_ids: List[str] = []
+        self.records: List[tuple] = []
+
+    async def request(self, scenario: str, endpoint: str, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response = None
+            status = 0
+        self.records.append((scenario, endpoint, status, time.perf_counter() - start))
+        return response
+
+    async def seed_data(self, panel_url: str, users: int):
+        response = await self.client.post("/api/admin/xtream-config", json={
+            "username": "bench", "password": "bench", "dns_url": panel_url
+        })
+        response.raise_for_status()
+        await self.client.post("/api/admin/notification", json={"message": "Benchmark"})
+
+        for index in range(users):
+            response = await self.client.post("/api/admin/user-codes", json={
+                "max_profiles": 5,
+                "user_note": f"bench {index}",
+                "dns_url": panel_url,
+                "xtream_username": "bench",
+                "xtream_password": "bench"
+            })
+            response.raise_for_status()
+            code = response.json()["code"]
+            response = await self.client.post(f"/api/profiles/{code}", json={"name": "Profil"})
+            response.raise_for_status()
+            self.users.append({"code": code, "profile": "Profil", "profile_id": response.json()["id"]})
+
+        vod_categories = (await self.client.get("/api/xtream/vod-categories", timeout=120)).json()
+        series_categories = (await self.client.get("/api/xtream/series-categories", timeout=120)).json()
+        self.vod_category_ids = [category["category_id"] for category in vod_categories]
+        self.series_category_ids = [category["category_id"] for category in series_categories]
+
+        vod = (await self.client.get("/api/xtream/vod-streams", timeout=120)).json()
+        series = (await self.client.get("/api/xtream/series-streams", timeout=120)).json()
+        self.vod_ids = [str(stream["stream_id"]) for stream in vod]
+        self.series_ids = [str(item["series_id"]) for item in series]
+
+    # ---------- scenarios ----------
+
+    async def app_launch(self, rng: random.Random, user: Dict[str, str]):
+        code, profile = user["code"], user["profile"]
+        await self.request("app_launch", "verify-code", "POST", "/api/auth/verify-code", params={"code": code})
+        await self.request("app_launch", "profiles", "GET", f"/api/profiles/{code}")
+        await self.request("app_launch", "notification", "GET", "/api/notification")
+        await self.request("app_launch", "watchlist", "GET", f"/api/watchlist/{code}/{profile}")
+        await self.request("app_launch", "progress", "GET", f"/api/progress/{code}/{profile}")
+        await self.request("app_launch", "live-categories", "GET", "/api/xtream/live-categories")
+        await self.request("app_launch", "vod-categories", "GET", "/api/xtream/vod-categories")
+        await self.request("app_launch", "series-categories", "GET", "/api/xtream/series-categories")
+
+    async def browse(self, rng: random.Random, user: Dict[str, str]):
+        choice = rng.random()
+        if choice < 0.45:
+            await self.request("browse", "vod-streams", "GET", "/api/xtream/vod-streams",
+                               params={"category_id": rng.choice(self.vod_category_ids)})
+        elif choice < 0.9:
+            await self.request("browse", "series-streams", "GET", "/api/xtream/series-streams",
+                               params={"category_id": rng.choice(self.series_category_ids)})
+        else:
+            await self.request("browse", "live-streams", "GET", "/api/xtream/live-streams")
+
+    async def detail_open(self, rng: random.Random, user: Dict[str, str]):
+        code, profile = user["code"], user["profile"]
+        # Popularity follows a long tail: most opens hit the first titles
+        if rng.random() < 0.6:
+            vod_id = self.vod_ids[min(len(self.vod_ids) - 1, int(rng.paretovariate(1.2)) - 1)]
+            await self.request("detail_open", "vod-info", "GET", f"/api/xtream/vod-info/{vod_id}")
+            await self.request("detail_open", "watchlist-check", "GET", f"/api/watchlist/check/{code}/{profile}/{vod_id}")
+            await self.request("detail_open", "progress-item", "GET", f"/api/progress/{code}/{profile}/{vod_id}")
+        else:
+            series_id = self.series_ids[min(len(self.series_ids) - 1, int(rng.paretovariate(1.2)) - 1)]
+            await self.request("detail_open", "series-info", "GET", f"/api/xtream/series-info/{series_id}")
+            await self.request("detail_open", "watchlist-check", "GET", f"/api/watchlist/check/{code}/{profile}/{series_id}")
+
+    async def playback_heartbeat(self, rng: random.Random, user: Dict[str, str]):
+        await self.request("playback_heartbeat", "progress-update", "POST", "/api/progress/update", json={
+            "user_code": user["code"],
+            "profile_name": user["profile"],
+            "stream_id": rng.choice(self.vod_ids[:500]),
+            "stream_type": "movie",
+            "current_time": rng.uniform(0, 7200),
+            "duration": 7200
+        })
+
+    async def virtual_user(self, index: int, deadline: float):
+        rng = random.Random(self.seed * 1000 + index)
+        user = self.users[index % len(self.users)]
+        scenarios = list(TRAFFIC_MIX)
+        weights = [TRAFFIC_MIX[name] for name in scenarios]
+        while time.monotonic() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            await getattr(self, scenario)(rng, user)
+
+    async def run_level(self, concurrency: int, duration: float) -> Dict[str, Any]:
+        self.records = []
+        start = time.monotonic()
+        await asyncio.gather(*(self.virtual_user(index, start + duration) for index in range(concurrency)))
+        elapsed = time.monotonic() - start
+        return summarize(self.records, elapsed)
+
+def summarize(records: List[tuple], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(record[3] for record in records)
+    errors = sum(1 for record in records if record[2] == 0 or record[2] >= 500)
+    by_endpoint = defaultdict(list)
+    for _, endpoint, _, latency in records:
+        by_endpoint[endpoint].append(latency)
+
+    def stats(values: List[float]) -> Dict[str, Any]:
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.5) * 1000, 2) if values else None,
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2) if values else None,
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+        }
+
+    return {
+        "requests": len(records),
+        "errors": errors,
+        "throughput_rps": round(len(records) / elapsed, 2) if elapsed else 0,
+        **stats(latencies),
+        "endpoints": {endpoint: stats(values) for endpoint, values in sorted(by_endpoint.items())}
+    }
+
+def machine_info() -> Dict[str, Any]:
+    """Where the numbers were measured, baselines only compare on the same machine"""
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(), "python": sys.version.split()[0]}
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for level, current in results["levels"].items():
+        previous = baseline.get("levels", {}).get(level)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"concurrency {level}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"concurrency {level}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+def print_report(results: Dict[str, Any]):
+    print(f"{'conc':>5} {'reqs':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'rss MB':>8} {'peak MB':>8} {'total MB':>9}")
+    for level, summary in results["levels"].items():
+        rss = summary["memory"]["rss_kb"]
+        peak = summary["memory"]["peak_rss_kb"]
+        total = summary["memory"].get("total_rss_kb")
+        print(f"{level:>5} {summary['requests']:>8} {summary['errors']:>7} {summary['throughput_rps']:>9} "
+              f"{summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9} "
+              f"{(rss or 0) / 1024:>8.1f} {(peak or 0) / 1024:>8.1f} {(total or 0) / 1024:>9.1f}")
+
+def start_mongo(mode: str, workdir: Path) -> tuple:
+    """Resolve the Mongo target: a URL, an ephemeral mongod, or the in-memory stand-in"""
+    if mode == "auto":
+        mode = "mongod" if shutil.which("mongod") else "mock"
+    if mode == "mongod":
+        port = free_port()
+        dbpath = workdir / "mongo"
+        dbpath.mkdir()
+        process = subprocess.Popen(
+            ["mongod", "--dbpath", str(dbpath), "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        return f"mongodb://127.0.0.1:{port}", process
+    return mode, None
+
+async def run(args) -> int:
+    workdir = Path(tempfile.mkdtemp(prefix="iptv-bench-"))
+    processes = []
+    try:
+        mongo, mongo_process = start_mongo(args.mongo, workdir)
+        if mongo_process:
+            processes.append(mongo_process)
+
+        panel_port = free_port()
+        panel_url = f"http://127.0.0.1:{panel_port}"
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "benchmarks.fake_xtream", "--port", str(panel_port),
+            "--live", str(args.live), "--vod", str(args.vod), "--series", str(args.series),
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--error-rate", str(args.error_rate), "--seed", str(args.seed)
+        ], cwd=REPO_DIR))
+
+        app_port = free_port()
+        env = {**os.environ, "IMAGE_CACHE_DIR": str(workdir / "images")}
+        app_process = subprocess.Popen([
+            sys.executable, "-m", "benchmarks.app_runner", "--port", str(app_port), "--mongo", mongo
+        ], cwd=REPO_DIR, env=env)
+        processes.append(app_process)
+
+        await wait_for(f"{panel_url}/__stats")
+        await wait_for(f"http://127.0.0.1:{app_port}/api/")
+
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", timeout=120, limits=limits) as client:
+            test = LoadTest(client, args.seed)
+            await test.seed_data(panel_url, args.users)
+
+            # Warm-up round, not reported
+            await test.run_level(min(args.concurrency), args.warmup)
+
+            results = {
+                "config": {key: value for key, value in vars(args).items()
+                           if key not in ("save_baseline", "compare", "baseline", "output")},
+                "mongo": "mongod" if mongo_process else mongo,
+                "machine": machine_info(),
+                "levels": {}
+            }
+            for concurrency in args.concurrency:
+                reset_peak_rss(app_process.pid)
+                summary = await test.run_level(concurrency, args.duration)
+                summary["memory"] = process_memory(app_process.pid)
+                results["levels"][str(concurrency)] = summary
+
+            async with httpx.AsyncClient() as panel:
+                results["upstream_requests"] = (await panel.get(f"{panel_url}/__stats")).json()
+
+        print_report(results)
+
+        if args.output:
+            Path(args.output).write_text(json.dumps(results, indent=2))
+        if args.save_baseline:
+            args.baseline.parent.mkdir(parents=True, exist_ok=True)
+            args.baseline.write_text(json.dumps(results, indent=2))
+            print(f"Baseline saved to {args.baseline}")
+        if args.compare:
+            baseline = json.loads(args.baseline.read_text())
+            regressions = compare_with_baseline(results, baseline, args.tolerance)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            if regressions:
+                return 1
+            print("No regression against baseline")
+        return 0
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend against a fake Xtream panel")
+    parser.add_argument("--concurrency", default="1,8,32,64",
+                        type=lambda value: [int(level) for level in value.split(",")])
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per concurrency level")
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--live", type=int, default=2000)
+    parser.add_argument("--vod", type=int, default=20000)
+    parser.add_argument("--series", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--mongo", default="auto", help="auto, mongod, mock or a MongoDB URL")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the full results as JSON")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="Exit 1 when p95 or throughput regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the M3U and XMLTV parsers of the backend.
+
+``xmltv_*`` cases time the one-off now / next lookup (``find_epg_now_next``),
+``epg_index_*`` cases the build of the in-memory guide (``build_epg_index``)
+on the same fixtures.
+
+Each case runs in its own subprocess on a deterministic fixture (cached in
+benchmarks/.fixtures) and reports the median parse time, the memory
+allocated while parsing (tracemalloc peak and block count) and the peak RSS
+growth of the process during the parse. Runs offline; use --compare to gate
+parser changes against a saved baseline.
+
+    python -m benchmarks.parser_bench
+    python -m benchmarks.parser_bench --quick --save-baseline
+    python -m benchmarks.parser_bench --compare
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks import fixtures
+
+BENCH_DIR = Path(__file__).resolve().parent
+FIXTURES_DIR = BENCH_DIR / ".fixtures"
+DEFAULT_BASELINE = BENCH_DIR / "baselines" / "parser_bench.json"
+BACKEND_DIR = BENCH_DIR.parent / "backend"
+
+# Fixed guide start and lookup time so every run parses the same window
+EPG_START = datetime(2024, 3, 1)
+EPG_NOW = datetime(2024, 3, 2, 20, 15)
+# Same horizon as the backend default (EPG_INDEX_HORIZON_HOURS)
+EPG_HORIZON = timedelta(hours=24)
+
+# (name, kind, channels, epg days)
+CASES = [
+    ("m3u_10k", "m3u", 10_000, 0),
+    ("m3u_50k", "m3u", 50_000, 0),
+    ("m3u_200k", "m3u", 200_000, 0),
+    ("xmltv_1k_3d", "xmltv", 1_000, 3),
+    ("xmltv_3k_7d", "xmltv", 3_000, 7),
+    ("epg_index_1k_3d", "epg_index", 1_000, 3),
+    ("epg_index_3k_7d", "epg_index", 3_000, 7),
+]
+QUICK_CASES = ["m3u_10k", "xmltv_1k_3d"]
+
+def fixture_path(kind: str, channels: int, days: int, seed: int) -> Path:
+    """Generate the fixture once and keep it on disk"""
+    # The EPG index cases parse the XMLTV fixtures
+    kind = "m3u" if kind == "m3u" else "xmltv"
+    suffix = "m3u" if kind == "m3u" else "xml"
+    path = FIXTURES_DIR / f"{kind}_{channels}_{days}d_seed{seed}.{suffix}"
+    if path.exists():
+        return path
+
+    rng = random.Random(seed)
+    categories = fixtures.make_categories(rng, "LIVE", 60)
+    live = fixtures.make_live_channels(rng, channels, categories, "http://panel.example")
+    if kind == "m3u":
+        content = fixtures.render_m3u(live, "http://panel.example", "user", "pass", rng=rng, noise=0.2)
+    else:
+        content = fixtures.render_xmltv(rng, live, EPG_START, days, noise=0.2)
+
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(content, encoding="utf-8")
+    tmp_path.replace(path)
+    return path
+
+def read_status(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+def reset_peak_rss() -> bool:
+    """Reset VmHWM to the current RSS (Linux >= 4.0)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def run_case(kind: str, path: Path, channels: int, repeats: int) -> Dict[str, Any]:
+    """Measure one parser on one fixture, inside the current process"""
+    sys.path.insert(0, str(BACKEND_DIR))
+    # The parsers' own module, without the app
+    import cpu_tasks
+
+    if kind == "m3u":
+        payload = path.read_text(encoding="utf-8")
+
+        def parse():
+            return cpu_tasks.parse_m3u_playlist(payload)
+    elif kind == "epg_index":
+        payload = path.read_bytes()
+
+        def parse():
+            return cpu_tasks.build_epg_index(payload, EPG_START, EPG_HORIZON)
+    else:
+        payload = path.read_bytes()
+        # A channel in the middle of the guide, so the lookup scans half of it
+        stream_id = f"ch{300000 + channels // 2}"
+
+        def parse():
+            return cpu_tasks.find_epg_now_next(payload, stream_id, EPG_NOW)
+
+    # Peak RSS growth of a single cold parse
+    rss_supported = reset_peak_rss()
+    rss_before = read_status("VmRSS:")
+    result = parse()
+    peak_rss_kb = read_status("VmHWM:") - rss_before if rss_supported else None
+    del result
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    result = parse()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    new_blocks = sum(stat.count_diff for stat in snapshot_after.compare_to(snapshot_before, "filename") if stat.count_diff > 0)
+
+    return {
+        "input_bytes": path.stat().st_size,
+        "median_s": round(statistics.median(timings), 4),
+        "min_s": round(min(timings), 4),
+        "alloc_peak_mb": round(traced_peak / 1024 / 1024, 2),
+        "retained_blocks": new_blocks,
+        "peak_rss_growth_mb": round(peak_rss_kb / 1024, 2) if peak_rss_kb is not None else None,
+        "items": count_items(result)
+    }
+
+def count_items(result: Any) -> Any:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict) and "programmes" in result:
+        return sum(len(programmes) for programmes in result["programmes"].values())
+    return None
+
+def machine_info() -> Dict[str, Any]:
+    """Where the numbers were measured, baselines only compare on the same machine"""
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count()}
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any], time_tolerance: float,
+                          memory_tolerance: float) -> List[str]:
+    regressions = []
+    for name, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if not previous:
+            continue
+        if current["median_s"] > previous["median_s"] * (1 + time_tolerance):
+            regressions.append(f"{name}: median {previous['median_s']}s -> {current['median_s']}s")
+        if current["alloc_peak_mb"] > previous["alloc_peak_mb"] * (1 + memory_tolerance):
+            regressions.append(f"{name}: allocation peak {previous['alloc_peak_mb']}MB -> {current['alloc_peak_mb']}MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="M3U / XMLTV parser micro-benchmarks")
+    parser.add_argument("--cases", help="Comma separated case names (default: all)")
+    parser.add_argument("--quick", action="store_true", help=f"Only run {', '.join(QUICK_CASES)}")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="Exit 1 when a case regressed")
+    parser.add_argument("--time-tolerance", type=float, default=0.15)
+    parser.add_argument("--memory-tolerance", type=float, default=0.2)
+    # Internal: run a single case in this process and print its JSON result
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    cases = {name: (kind, channels, days) for name, kind, channels, days in CASES}
+
+    if args.run_case:
+        kind, channels, days = cases[args.run_case]
+        path = fixture_path(kind, channels, days, args.seed)
+        print(json.dumps(run_case(kind, path, channels, args.repeats)))
+        return
+
+    selected = QUICK_CASES if args.quick else (args.cases.split(",") if args.cases else [name for name, *_ in CASES])
+    unknown = [name for name in selected if name not in cases]
+    if unknown:
+        parser.error(f"Unknown case(s): {', '.join(unknown)}")
+
+    results = {"python": sys.version.split()[0], "machine": machine_info(), "seed": args.seed,
+               "repeats": args.repeats, "cases": {}}
+    print(f"{'case':<14} {'input MB':>9} {'median s':>9} {'min s':>8} {'alloc MB':>9} {'blocks':>9} {'rss +MB':>8}")
+    for name in selected:
+        kind, channels, days = cases[name]
+        # Generate outside the measured process so fixture building does not count
+        fixture_path(kind, channels, days, args.seed)
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.parser_bench", "--run-case", name,
+             "--repeats", str(args.repeats), "--seed", str(args.seed)],
+            cwd=BENCH_DIR.parent, capture_output=True, text=True, check=True
+        )
+        case = json.loads(output.stdout.strip().splitlines()[-1])
+        results["cases"][name] = case
+        print(f"{name:<14} {case['input_bytes'] / 1024 / 1024:>9.1f} {case['median_s']:>9} {case['min_s']:>8} "
+              f"{case['alloc_peak_mb']:>9} {case['retained_blocks']:>9} {case['peak_rss_growth_mb']:>8}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+    if args.compare:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare_with_baseline(results, baseline, args.time_tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regression against baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark of user code provisioning: one bulk request versus per-code calls.
+
+    python -m benchmarks.provision_bench --count 10000 --single 200
+"""
+
+import argparse
+import asyncio
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.load_test import REPO_DIR, free_port, start_mongo, wait_for
+
+CREDENTIALS = {
+    "max_profiles": 5,
+    "user_note": "bench",
+    "dns_url": "http://panel.example",
+    "xtream_username": "bench",
+    "xtream_password": "bench"
+}
+
+async def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="iptv-bench-"))
+    processes = []
+    try:
+        mongo, mongo_process = start_mongo(args.mongo, workdir)
+        if mongo_process:
+            processes.append(mongo_process)
+
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.app_runner", "--port", str(port), "--mongo", mongo], cwd=REPO_DIR
+        ))
+        await wait_for(f"http://127.0.0.1:{port}/api/")
+
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=600) as client:
+            start = time.perf_counter()
+            for _ in range(args.single):
+                response = await client.post("/api/admin/user-codes", json=CREDENTIALS)
+                response.raise_for_status()
+            single_elapsed = time.perf_counter() - start
+
+            for output_format in ("json", "csv"):
+                start = time.perf_counter()
+                response = await client.post(
+                    "/api/admin/user-codes/bulk",
+                    params={"format": output_format},
+                    json={**CREDENTIALS, "count": args.count}
+                )
+                response.raise_for_status()
+                elapsed = time.perf_counter() - start
+                size = len(response.content)
+                print(f"bulk {output_format:<4} {args.count:>6} codes  {elapsed:8.3f}s  "
+                      f"{args.count / elapsed:10.0f} codes/s  {size / 1024:8.1f} kB")
+
+        if args.single:
+            print(f"single      {args.single:>6} codes  {single_elapsed:8.3f}s  "
+                  f"{args.single / single_elapsed:10.0f} codes/s")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="User code provisioning benchmark")
+    parser.add_argument("--count", type=int, default=10000, help="Codes per bulk request")
+    parser.add_argument("--single", type=int, default=200, help="Codes created one request at a time")
+    parser.add_argument("--mongo", default="auto", help="auto, mongod, mock or a MongoDB URL")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Shared setup of the backend tests: environment, import path of the backend
+and an in-memory MongoDB (mongomock-motor) swapped in for ``server.db``.
+
+    pip install -r tests/requirements.txt
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("DB_NAME", "iptv_test")
+os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="iptv-test-images-"))
+# CPU-bound helpers run inline, the tests never start worker processes
+os.environ.setdefault("CPU_POOL_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient()["iptv_test"]
+    monkeypatch.setattr(server, "db", database)
+    # L1 only, so cache lookups never reach the shared cache collection
+    monkeypatch.setattr(server, "SHARED_CACHE_ENABLED", False)
+    return database
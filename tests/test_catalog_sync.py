@@ -0,0 +1,250 @@
+"""
+Versioned catalog sync: two syncs against fixture catalogs must report what
+was added, updated, moved and removed, keep tombstones for deltas and only
+publish a version once every kind is written. The changes endpoint serves
+deltas between published versions, or a full snapshot.
+
+    python -m pytest tests/test_catalog_sync.py
+"""
+
+import json
+
+import httpx
+import pytest
+
+import cpu_tasks
+import server
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = {"id": "account-1", "dns_url": "http://panel.invalid", "username": "user", "password": "pass"}
+
+def channel(stream_id: int, name: str, group: str = "FR | Info", tvg_id: str = "") -> dict:
+    return {"stream_id": stream_id, "name": name, "group": group, "tvg_id": tvg_id}
+
+def movie(stream_id: int, name: str, category_id: str = "1", **extra) -> dict:
+    return {"stream_id": stream_id, "name": name, "category_id": category_id, **extra}
+
+def m3u(channels: list) -> str:
+    lines = ["#EXTM3U"]
+    for entry in channels:
+        lines.append(f'#EXTINF:-1 tvg-id="{entry["tvg_id"]}" tvg-name="{entry["name"]}" '
+                     f'group-title="{entry["group"]}",{entry["name"]}')
+        lines.append(f'http://panel.invalid/live/user/pass/{entry["stream_id"]}.ts')
+    return "\n".join(lines) + "\n"
+
+class Upstream:
+    """Catalogs the fake panel answers with, changed between two syncs"""
+
+    def __init__(self):
+        self.live = [channel(101, "Info"), channel(102, "Sport")]
+        self.vod = [movie(1, "Alpha"), movie(2, "Beta"), movie(3, "Gamma")]
+        self.series = [{"series_id": 7, "name": "Show", "category_id": "5"}]
+
+    async def fetch_catalog(self, config, kind):
+        if kind == "live":
+            return m3u(self.live)
+        return json.dumps(getattr(self, kind)).encode("utf-8")
+
+@pytest.fixture
+def upstream(db, monkeypatch):
+    fake = Upstream()
+
+    async def get_category_names(config, kind):
+        return {} if kind == "live" else {"1": "Films", "5": "Series", "9": "Adulte"}
+
+    async def get_xtream_config():
+        return CONFIG
+
+    monkeypatch.setattr(server, "fetch_catalog", fake.fetch_catalog)
+    monkeypatch.setattr(server, "get_category_names", get_category_names)
+    monkeypatch.setattr(server, "get_xtream_config", get_xtream_config)
+    return fake
+
+@pytest.fixture
+async def client(db):
+    await db.profiles.insert_many([
+        {"user_code": "C1", "name": "kid", "is_child": True},
+        {"user_code": "C1", "name": "dad", "is_child": False},
+    ])
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        yield client
+
+async def get_changes(client, **params) -> dict:
+    response = await client.get("/api/xtream/catalog/changes", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+async def stored(kind: str) -> dict:
+    docs = await server.db.catalog_items.find({"account_id": CONFIG["id"], "kind": kind}).to_list(None)
+    return {doc["item_id"]: doc for doc in docs}
+
+async def published_state() -> dict:
+    return await server.db.catalog_state.find_one({"account_id": CONFIG["id"]})
+
+def test_content_hash_ignores_key_order():
+    assert cpu_tasks.catalog_content_hash({"a": 1, "b": [1, 2]}) == cpu_tasks.catalog_content_hash({"b": [1, 2], "a": 1})
+    assert cpu_tasks.catalog_content_hash({"a": 1}) != cpu_tasks.catalog_content_hash({"a": 2})
+
+def test_live_id_comes_from_stream_url():
+    # tvg-id is shared between variants, the stream URL is not
+    hd = {"stream_id": "tf1.fr", "stream_url": "http://panel/live/u/p/101.ts"}
+    fhd = {"stream_id": "tf1.fr", "stream_url": "http://panel/live/u/p/102.m3u8"}
+    assert cpu_tasks.catalog_item_id("live", hd) == "101"
+    assert cpu_tasks.catalog_item_id("live", fhd) == "102"
+    assert cpu_tasks.catalog_item_id("live", {"stream_url": "http://panel/hls/tf1"}) == "http://panel/hls/tf1"
+    assert cpu_tasks.catalog_item_id("vod", {"stream_id": ""}) is None
+
+async def test_first_sync_adds_everything_and_publishes_version(upstream):
+    summary = await server.sync_account_catalog(CONFIG)
+
+    assert summary["version"] == 1
+    assert summary["kinds"]["vod"]["added"] == 3
+    assert summary["kinds"]["live"]["added"] == 2
+    state = await published_state()
+    assert state["version"] == 1 and state["reserved_version"] == 1
+    assert state["kinds"]["series"]["count"] == 1
+    vod = await stored("vod")
+    assert {doc["added_version"] for doc in vod.values()} == {1}
+
+async def test_second_sync_reports_changes_and_keeps_tombstones(upstream):
+    await server.sync_account_catalog(CONFIG)
+
+    upstream.vod = [movie(3, "Gamma"), movie(1, "Alpha (2024)"), movie(4, "Delta")]
+    # Same channel behind the same URL: a new tvg-id is an update, not a new entry
+    upstream.live = [channel(101, "Info", tvg_id="info.fr"), channel(102, "Sport")]
+    summary = await server.sync_account_catalog(CONFIG)
+
+    assert summary["version"] == 2
+    vod_summary = summary["kinds"]["vod"]
+    assert (vod_summary["count"], vod_summary["added"], vod_summary["updated"], vod_summary["removed"]) == (3, 1, 1, 1)
+    assert vod_summary["moved"] == 1
+    assert summary["kinds"]["live"]["added"] == 0 and summary["kinds"]["live"]["updated"] == 1
+    assert summary["kinds"]["series"]["added"] == 0 and summary["kinds"]["series"]["updated"] == 0
+
+    vod = await stored("vod")
+    assert vod["2"]["removed"] and vod["2"]["version"] == 2 and "data" not in vod["2"]
+    assert vod["4"]["added_version"] == 2
+    assert vod["1"]["data"]["name"] == "Alpha (2024)" and vod["1"]["added_version"] == 1
+    # Reordered without a content change: new position and version, same hash
+    assert vod["3"]["position"] == 0 and vod["3"]["version"] == 2
+    series = await stored("series")
+    assert series["7"]["version"] == 1
+    assert (await published_state())["version"] == 2
+
+async def test_unchanged_catalog_keeps_version(upstream):
+    await server.sync_account_catalog(CONFIG)
+    # Same content, keys in another order
+    upstream.vod = [dict(reversed(list(item.items()))) for item in upstream.vod]
+
+    summary = await server.sync_account_catalog(CONFIG)
+
+    assert summary["version"] == 1
+    assert summary["kinds"]["vod"]["updated"] == 0
+    assert (await published_state())["reserved_version"] == 1
+
+async def test_empty_upstream_catalog_keeps_previous_snapshot(upstream):
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = []
+
+    summary = await server.sync_account_catalog(CONFIG)
+
+    assert summary["kinds"]["vod"] == {"error": "empty catalog returned by upstream"}
+    assert summary["version"] == 1
+    assert not any(doc["removed"] for doc in (await stored("vod")).values())
+    assert (await published_state())["kinds"]["vod"]["error"] == "empty catalog returned by upstream"
+
+async def test_version_is_published_after_every_kind_is_written(upstream, monkeypatch):
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod.append(movie(4, "Delta"))
+    upstream.series.append({"series_id": 8, "name": "Other", "category_id": "5"})
+    apply_catalog_diff = server.apply_catalog_diff
+
+    async def failing_apply(account_id, kind, diff, version, category_names):
+        if kind == "series":
+            raise RuntimeError("connection lost")
+        await apply_catalog_diff(account_id, kind, diff, version, category_names)
+
+    monkeypatch.setattr(server, "apply_catalog_diff", failing_apply)
+    with pytest.raises(RuntimeError):
+        await server.sync_account_catalog(CONFIG)
+
+    # VOD entries of version 2 are written but clients still see version 1
+    state = await published_state()
+    assert state["version"] == 1 and state["reserved_version"] == 2
+    assert (await stored("vod"))["4"]["version"] == 2
+
+    monkeypatch.setattr(server, "apply_catalog_diff", apply_catalog_diff)
+    summary = await server.sync_account_catalog(CONFIG)
+    assert summary["version"] == 3
+    assert (await published_state())["version"] == 3
+
+async def test_old_tombstones_are_pruned_past_min_version(upstream, monkeypatch):
+    monkeypatch.setattr(server, "CATALOG_TOMBSTONE_VERSIONS", 1)
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = [movie(2, "Beta"), movie(3, "Gamma")]
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = [movie(3, "Gamma")]
+
+    summary = await server.sync_account_catalog(CONFIG)
+
+    assert summary["version"] == 3
+    state = await published_state()
+    assert state["min_version"] == 2
+    vod = await stored("vod")
+    # Removed at version 2, no longer needed by clients at min_version or later
+    assert "1" not in vod
+    assert vod["2"]["removed"] and vod["2"]["version"] == 3
+
+async def test_changes_since_before_min_version_is_a_full_snapshot(upstream, client, monkeypatch):
+    monkeypatch.setattr(server, "CATALOG_TOMBSTONE_VERSIONS", 1)
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = [movie(2, "Beta"), movie(3, "Gamma")]
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = [movie(3, "Gamma")]
+    await server.sync_account_catalog(CONFIG)
+
+    # The removal of entry 1 at version 2 is gone, a client at version 1 must reload everything
+    changes = await get_changes(client, since=1, kinds="vod")
+
+    assert changes["full"] is True and changes["version"] == 3
+    assert [item["stream_id"] for item in changes["kinds"]["vod"]["items"]] == [3]
+
+    delta = await get_changes(client, since=2, kinds="vod")
+    assert delta["full"] is False
+    assert delta["kinds"]["vod"]["removed"] == ["2"]
+
+async def test_changes_since_current_version_is_empty(upstream, client):
+    await server.sync_account_catalog(CONFIG)
+
+    changes = await get_changes(client, since=1)
+
+    assert changes["full"] is False and changes["version"] == 1
+    assert all(changes["kinds"][kind] == {"added": [], "updated": [], "removed": [], "positions": {}}
+               for kind in server.CATALOG_KINDS)
+
+async def test_changes_report_added_updated_and_positions(upstream, client):
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod = [movie(3, "Gamma"), movie(1, "Alpha (2024)"), movie(4, "Delta")]
+    await server.sync_account_catalog(CONFIG)
+
+    vod = (await get_changes(client, since=1, kinds="vod"))["kinds"]["vod"]
+
+    assert [item["stream_id"] for item in vod["added"]] == [4]
+    assert [item["name"] for item in vod["updated"]] == ["Gamma", "Alpha (2024)"]
+    assert vod["removed"] == ["2"]
+    assert vod["positions"] == {"3": 0, "1": 1, "4": 2}
+
+async def test_child_view_reports_unsafe_entries_as_removed(upstream, client):
+    await server.sync_account_catalog(CONFIG)
+    upstream.vod += [movie(5, "Night film", category_id="9"), movie(6, "Cartoon", age_rating="18+")]
+    await server.sync_account_catalog(CONFIG)
+
+    adult = (await get_changes(client, since=1, kinds="vod", user_code="C1", profile_name="dad"))["kinds"]["vod"]
+    child = (await get_changes(client, since=1, kinds="vod", user_code="C1", profile_name="kid"))["kinds"]["vod"]
+
+    assert [item["stream_id"] for item in adult["added"]] == [5, 6]
+    assert child["added"] == [] and sorted(child["removed"]) == ["5", "6"]
+
+    snapshot = await get_changes(client, since=0, kinds="vod", user_code="C1", profile_name="kid")
+    assert [item["stream_id"] for item in snapshot["kinds"]["vod"]["items"]] == [1, 2, 3]
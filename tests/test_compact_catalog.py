@@ -0,0 +1,99 @@
+"""
+CompactCatalog round trips: rows come back with their original keys, key
+order, values and types whatever the mix of types in a column, and catalogs
+read from the store by category are the same rows as the list they replace.
+
+    python -m pytest tests/test_compact_catalog.py
+"""
+
+import json
+from datetime import datetime
+
+import pytest
+
+import server
+
+ROWS = [
+    {"num": 1, "name": "Alpha", "stream_id": 101, "rating": 7.5, "added": "1700000000", "category_id": "1"},
+    # Same keys in another order, a float column getting an int, an int column getting a string
+    {"category_id": "2", "added": "1700000001", "rating": 8, "stream_id": "102", "name": "Beta", "num": 2},
+    # Missing keys, an extra key and values that cannot stay in typed arrays
+    {"num": 3, "name": None, "stream_id": 2 ** 70, "category_id": "01", "tmdb": {"id": 5, "genres": ["a"]}},
+    {"num": True, "name": "Ünïcode \"quoted\"", "added": "042", "rating": None, "category_id": "+3"},
+    {},
+    {"num": 6, "name": "Alpha", "stream_id": -7, "rating": float("inf"), "added": "", "category_id": "1"},
+]
+
+def assert_same_rows(actual, expected):
+    assert len(actual) == len(expected)
+    for row, original in zip(actual, expected):
+        assert row == original
+        assert list(row) == list(original)
+        assert [type(value) for value in row.values()] == [type(value) for value in original.values()]
+
+def test_round_trip_keeps_keys_order_and_types():
+    catalog = server.CompactCatalog(ROWS)
+
+    assert_same_rows(list(catalog), ROWS)
+    assert_same_rows([catalog[index] for index in range(len(ROWS))], ROWS)
+    assert catalog.nbytes > 0
+
+def test_columns_fall_back_to_objects_only_when_needed():
+    catalog = server.CompactCatalog(ROWS)
+    kinds = dict(zip(catalog.keys, catalog.kinds))
+
+    assert kinds["added"] == "object"  # "042" and "" are not canonical integers
+    assert kinds["stream_id"] == "object"  # "102" and 2 ** 70
+    assert kinds["rating"] == "object"
+    assert kinds["num"] == "object"  # True is not an int here
+
+    typed = server.CompactCatalog([{"id": index, "ts": str(1700000000 + index), "score": index / 2}
+                                   for index in range(100)])
+    assert dict(zip(typed.keys, typed.kinds)) == {"id": "int", "ts": "intstr", "score": "float"}
+    assert typed[42] == {"id": 42, "ts": "1700000042", "score": 21.0}
+
+def test_built_in_batches_like_the_store_loader():
+    catalog = server.CompactCatalog()
+    catalog.extend(ROWS[:2])
+    catalog.extend(ROWS[2:])
+    catalog.freeze()
+
+    assert_same_rows(list(catalog), ROWS)
+
+def test_slices_and_negative_indexes():
+    catalog = server.CompactCatalog(ROWS)
+
+    assert_same_rows(catalog[1:4], ROWS[1:4])
+    assert_same_rows(catalog[::-2], ROWS[::-2])
+    assert catalog[-1] == ROWS[-1]
+    with pytest.raises(IndexError):
+        catalog[len(ROWS)]
+
+def test_json_matches_the_list_encoding():
+    rows = [row for row in ROWS if row.get("rating") != float("inf")]
+    catalog = server.CompactCatalog(rows)
+    rewrite = lambda row: {**row, "seen": True}
+
+    assert json.loads(catalog.to_json()) == rows
+    assert catalog.to_json() == json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    assert json.loads(catalog.to_json(rewrite)) == [rewrite(row) for row in rows]
+
+@pytest.mark.anyio
+async def test_store_catalog_sliced_by_category(db):
+    config = {"id": "account-1"}
+    # BSON has no integers above 8 bytes
+    rows = [{**row, "stream_id": str(row["stream_id"])} if row.get("stream_id") == 2 ** 70 else row for row in ROWS]
+    await db.catalog_state.insert_one({"account_id": "account-1", "version": 1,
+                                       "kinds": {"vod": {"synced_at": datetime.utcnow()}}})
+    await db.catalog_items.insert_many([
+        {"account_id": "account-1", "kind": "vod", "item_id": str(position), "removed": False,
+         "category_id": row.get("category_id", ""), "position": position, "data": row}
+        for position, row in enumerate(rows)
+    ])
+
+    films = await server.load_catalog_from_store(config, "vod", category_id="1")
+    everything = await server.load_catalog_from_store(config, "vod")
+
+    assert isinstance(films, server.CompactCatalog)
+    assert_same_rows(list(films), [rows[0], rows[5]])
+    assert_same_rows(list(everything), rows)
@@ -0,0 +1,86 @@
+"""
+EPG routes of the backend: the short EPG and the now / next lookup must both
+be reachable, and the in-memory guide must only answer while it is fresh.
+
+    python -m pytest tests/test_epg.py
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("DB_NAME", "iptv_test")
+os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="iptv-test-images-"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+CONFIG = {"id": "account-1", "dns_url": "http://panel.invalid", "username": "user", "password": "pass"}
+
+def xmltv(now: datetime) -> bytes:
+    def programme(start: datetime, stop: datetime, title: str) -> str:
+        return (f'<programme start="{start:%Y%m%d%H%M%S} +0000" stop="{stop:%Y%m%d%H%M%S} +0000" '
+                f'channel="ch101.fr"><title>{title}</title><desc>{title} desc</desc></programme>')
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    return ("<tv><channel id=\"ch101.fr\"/>"
+            + programme(hour, hour + timedelta(hours=1), "Journal")
+            + programme(hour + timedelta(hours=1), hour + timedelta(hours=2), "Film")
+            + "</tv>").encode("utf-8")
+
+@pytest.fixture
+def client(monkeypatch):
+    async def get_xtream_config():
+        return CONFIG
+
+    monkeypatch.setattr(server, "get_xtream_config", get_xtream_config)
+    monkeypatch.setattr(server, "epg_index", server.EpgIndex())
+    # L1 only, so cache lookups never reach MongoDB
+    monkeypatch.setattr(server, "SHARED_CACHE_ENABLED", False)
+    # Not entered as a context manager: no startup tasks, no database
+    return TestClient(server.app)
+
+def test_epg_routes_are_distinct():
+    paths = [route.path for route in server.app.routes if "/xtream/epg" in getattr(route, "path", "")]
+    assert len(paths) == len(set(paths))
+    assert "/api/xtream/epg-now/{stream_id}" in paths
+
+def test_now_next_served_from_index(client):
+    now = datetime.utcnow()
+    server.epg_index.load(CONFIG["id"], server.build_epg_index(xmltv(now), now, timedelta(hours=24)))
+
+    response = client.get("/api/xtream/epg-now/101")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["current"]["title"] == "Journal"
+    assert body["next"]["title"] == "Film"
+
+def test_short_epg_route_still_served(client, monkeypatch):
+    async def fetch_player_api(config, action, **params):
+        return {"epg_listings": [{"action": action, "stream_id": params["stream_id"]}]}
+
+    monkeypatch.setattr(server, "fetch_player_api", fetch_player_api)
+
+    response = client.get("/api/xtream/epg/101")
+
+    assert response.status_code == 200
+    assert response.json() == {"epg_listings": [{"action": "get_short_epg", "stream_id": "101"}]}
+
+def test_index_stops_covering_past_horizon_or_refresh_age(monkeypatch):
+    monkeypatch.setattr(server, "EPG_INDEX_REFRESH", 3600)
+    now = datetime.utcnow()
+    index = server.EpgIndex()
+    index.load(CONFIG["id"], server.build_epg_index(xmltv(now), now, timedelta(hours=2)))
+
+    assert index.covers(CONFIG["id"], now)
+    assert not index.covers("other-account", now)
+    assert not index.covers(CONFIG["id"], now + timedelta(hours=3))
+
+    index.built_at = now - timedelta(hours=2, seconds=1)
+    assert not index.covers(CONFIG["id"], now)
@@ -0,0 +1,78 @@
+"""
+Image proxy: revalidation through If-None-Match, and an image evicted from
+the disk cache between lookup and serving downloaded again instead of failing.
+
+    python -m pytest tests/test_images.py
+"""
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+URL = "http://panel.invalid/images/poster.png"
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+@pytest.fixture
+def downloads(monkeypatch, tmp_path):
+    calls = []
+
+    async def download_image(url):
+        calls.append(url)
+        return PNG
+
+    monkeypatch.setattr(server, "IMAGE_PROXY_SECRET", "test-secret")
+    monkeypatch.setattr(server, "image_cache", server.ImageDiskCache(tmp_path, 1024 * 1024))
+    monkeypatch.setattr(server, "download_image", download_image)
+    return calls
+
+@pytest.fixture
+async def client(downloads):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        yield client
+
+async def get_image(client, **headers):
+    return await client.get("/api/images", params={"url": URL, "sig": server.image_url_signature(URL)},
+                            headers=headers)
+
+async def test_image_is_downloaded_once_and_revalidated(client, downloads):
+    first = await get_image(client)
+
+    assert first.status_code == 200
+    assert first.content == PNG
+    assert first.headers["content-type"] == "image/png"
+    assert first.headers["content-length"] == str(len(PNG))
+    etag = first.headers["etag"]
+
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        assert (await get_image(client, **{"If-None-Match": header})).status_code == 304
+    assert (await get_image(client, **{"If-None-Match": '"other"'})).status_code == 200
+    assert downloads == [URL]
+
+async def test_image_evicted_before_serving_is_downloaded_again(client, downloads, monkeypatch):
+    await get_image(client)
+    open_image = server.image_cache.open_image
+    evicted = []
+
+    def evict_then_open(digest, variant):
+        # Another request filled the cache between the lookup and the open
+        if not evicted:
+            server.image_cache.blob_path(digest).unlink()
+            evicted.append(digest)
+        return open_image(digest, variant)
+
+    monkeypatch.setattr(server.image_cache, "open_image", evict_then_open)
+
+    response = await get_image(client)
+
+    assert response.status_code == 200
+    assert response.content == PNG
+    assert downloads == [URL, URL]
+
+async def test_unsigned_url_is_refused(client, downloads):
+    response = await client.get("/api/images", params={"url": URL, "sig": "forged"})
+
+    assert response.status_code == 403
+    assert downloads == []
@@ -0,0 +1,42 @@
+"""
+HTTP metrics: the notification stream is counted as a request but kept out
+of the latency and response size histograms, which its connection lifetime
+would otherwise skew.
+
+    python -m pytest tests/test_metrics.py
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+async def call(path: str) -> None:
+    async def app(scope, receive, send):
+        scope["route"] = SimpleNamespace(path=path)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"data: {}\n\n"})
+
+    async def send(message):
+        pass
+
+    await server.MetricsMiddleware(app)({"type": "http", "method": "GET", "path": path}, None, send)
+
+def observations(histogram, route: str) -> int:
+    series = {key: values for key, values in histogram._values.items() if route in key}
+    return sum(values[-1] for values in series.values())
+
+@pytest.mark.parametrize("path, timed", [("/api/notification/stream", False), ("/api/notifications", True)])
+async def test_streams_are_counted_but_not_timed(path, timed):
+    requests = server.HTTP_REQUESTS._values.get(("GET", path, 200), 0)
+    durations = observations(server.HTTP_REQUEST_DURATION, path)
+    sizes = observations(server.HTTP_RESPONSE_SIZE, path)
+
+    await call(path)
+
+    assert server.HTTP_REQUESTS._values[("GET", path, 200)] == requests + 1
+    assert observations(server.HTTP_REQUEST_DURATION, path) == durations + timed
+    assert observations(server.HTTP_RESPONSE_SIZE, path) == sizes + timed
@@ -0,0 +1,136 @@
+"""
+Profile playlists: If-None-Match parsing, and playlists built once per
+account, filters and catalog version then reused, also when the catalog was
+never synced and entries come straight from upstream.
+
+    python -m pytest tests/test_playlist.py
+"""
+
+from datetime import datetime
+
+import httpx
+import pytest
+
+import server
+
+CONFIG = {"id": "account-1", "dns_url": "http://panel.invalid", "username": "user", "password": "pass"}
+CHANNELS = [
+    {"stream_id": "info.fr", "name": "Info", "category_id": "FR | Info",
+     "stream_url": "http://panel.invalid/live/user/pass/101.ts"},
+    {"stream_id": "sport.fr", "name": "Sport", "category_id": "FR | Sport",
+     "stream_url": "http://panel.invalid/live/user/pass/102.ts"},
+    {"stream_id": "adult", "name": "XXX", "category_id": "Adulte",
+     "stream_url": "http://panel.invalid/live/user/pass/103.ts"},
+]
+
+@pytest.mark.parametrize("header, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"other", "abc"', True),
+    ('"other",W/"abc" ', True),
+    ('*', True),
+    ('"other"', False),
+    ('"ab"', False),
+    ('"abcd"', False),
+    ('abc', False),
+    ('', False),
+])
+def test_etag_matches(header, expected):
+    assert server.etag_matches(header, '"abc"') is expected
+
+def test_weak_etag_matches_strong_tag():
+    assert server.etag_matches('"abc"', 'W/"abc"')
+
+@pytest.fixture
+def upstream(db, monkeypatch):
+    calls = []
+
+    async def get_xtream_config():
+        return CONFIG
+
+    async def fetch_live_channels(config):
+        calls.append(config["id"])
+        return [dict(channel) for channel in CHANNELS]
+
+    monkeypatch.setattr(server, "get_xtream_config", get_xtream_config)
+    monkeypatch.setattr(server, "fetch_live_channels", fetch_live_channels)
+    monkeypatch.setattr(server, "playlist_cache",
+                        server.TieredCache(server.ByteLRUCache("playlist", 1024 * 1024, 600)))
+    return calls
+
+@pytest.fixture
+async def client(db, upstream):
+    await db.user_codes.insert_many([
+        {"code": "C1", "is_active": True},
+        {"code": "C2", "is_active": True, "dns_url": "http://other.invalid", "xtream_username": "u2",
+         "xtream_password": "p2"},
+    ])
+    await db.profiles.insert_many([
+        {"user_code": "C1", "name": "dad"}, {"user_code": "C1", "name": "kid", "is_child": True},
+        {"user_code": "C2", "name": "dad"},
+    ])
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        yield client
+
+@pytest.mark.anyio
+async def test_unsynced_playlist_is_built_once_and_has_an_etag(client, upstream):
+    first = await client.get("/api/playlist/C1/dad.m3u")
+
+    assert first.status_code == 200
+    assert first.headers["content-type"].startswith("audio/x-mpegurl")
+    assert first.text.startswith("#EXTM3U\n")
+    assert "http://panel.invalid/live/user/pass/101.ts" in first.text and first.text.count("#EXTINF") == 3
+    etag = first.headers["etag"]
+
+    again = await client.get("/api/playlist/C1/dad.m3u", headers={"If-None-Match": f'"stale", W/{etag}'})
+    assert again.status_code == 304 and again.headers["etag"] == etag
+    assert (await client.get("/api/playlist/C1/dad.m3u")).text == first.text
+    assert upstream == ["account-1"]
+
+@pytest.mark.anyio
+async def test_cached_rows_serve_every_user_code_with_their_own_urls(client, upstream):
+    own = await client.get("/api/playlist/C1/dad.m3u", params={"output": "m3u8"})
+    other = await client.get("/api/playlist/C2/dad.m3u", params={"output": "m3u8"})
+
+    assert "http://panel.invalid/live/user/pass/102.m3u8" in own.text
+    assert "http://other.invalid/live/u2/p2/102.m3u8" in other.text
+    assert own.headers["etag"] != other.headers["etag"]
+    assert upstream == ["account-1"]
+
+@pytest.mark.anyio
+async def test_filters_and_child_view_get_their_own_playlist(client, upstream):
+    sport = await client.get("/api/playlist/C1/dad.m3u", params={"categories": "FR | Sport"})
+    kid = await client.get("/api/playlist/C1/kid.m3u")
+
+    assert sport.text.count("#EXTINF") == 1 and 'group-title="FR | Sport"' in sport.text
+    assert kid.text.count("#EXTINF") == 2 and "XXX" not in kid.text
+    assert len(upstream) == 2
+
+@pytest.mark.anyio
+async def test_new_catalog_version_rebuilds_the_playlist(client, upstream, db, monkeypatch):
+    await client.get("/api/playlist/C1/dad.m3u")
+    stored = []
+
+    async def load_catalog_from_store(config, kind, category_id=None, child_safe=False):
+        stored.append(kind)
+        return [dict(channel, name=f"{channel['name']} HD") for channel in CHANNELS]
+
+    monkeypatch.setattr(server, "load_catalog_from_store", load_catalog_from_store)
+    await db.catalog_state.insert_one({"account_id": "account-1", "version": 4, "synced_at": datetime.utcnow()})
+
+    synced = await client.get("/api/playlist/C1/dad.m3u")
+    assert "Info HD" in synced.text
+    assert stored == ["live"]
+    await client.get("/api/playlist/C1/dad.m3u")
+    assert stored == ["live"] and upstream == ["account-1"]
+
+@pytest.mark.anyio
+async def test_upstream_error_is_a_500_before_any_output(client, monkeypatch):
+    async def fetch_live_channels(config):
+        raise ConnectionError("panel down")
+
+    monkeypatch.setattr(server, "fetch_live_channels", fetch_live_channels)
+
+    response = await client.get("/api/playlist/C1/dad.m3u")
+
+    assert response.status_code == 500
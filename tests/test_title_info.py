@@ -0,0 +1,63 @@
+"""
+Title info: only ids upstream knows count as detail opens for the
+prefetcher, and the stale fallback counts a single miss in the cache stats.
+
+    python -m pytest tests/test_title_info.py
+"""
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = {"id": "account-1", "dns_url": "http://panel.invalid", "username": "user", "password": "pass"}
+INFO = {"info": {"name": "Alpha"}, "movie_data": {"stream_id": 101, "name": "Alpha"}}
+
+@pytest.fixture
+def upstream(db, monkeypatch):
+    calls = []
+
+    async def get_xtream_config():
+        return CONFIG
+
+    async def fetch_player_api(config, action, **params):
+        calls.append(params["vod_id"])
+        if params["vod_id"] == "down":
+            raise httpx.ConnectError("panel down")
+        # Unknown ids come back as an empty list
+        return dict(INFO) if params["vod_id"] == "101" else []
+
+    monkeypatch.setattr(server, "get_xtream_config", get_xtream_config)
+    monkeypatch.setattr(server, "fetch_player_api", fetch_player_api)
+    monkeypatch.setattr(server, "title_info_cache",
+                        server.TieredCache(server.ByteLRUCache("title_info", 1024 * 1024, 600)))
+    monkeypatch.setattr(server, "title_opens", server.Counter())
+    return calls
+
+@pytest.fixture
+async def client(upstream):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        yield client
+
+async def test_only_known_titles_count_as_opens(client, upstream):
+    assert (await client.get("/api/xtream/vod-info/101")).status_code == 200
+    await client.get("/api/xtream/vod-info/101")
+    for title_id in ("404", "made-up", "down"):
+        await client.get(f"/api/xtream/vod-info/{title_id}")
+
+    assert server.title_opens == {("vod", "101"): 2}
+    assert await server.popular_titles(10) == [("vod", "101")]
+
+async def test_stale_fallback_counts_one_miss(upstream):
+    cache = server.title_info_cache
+    key = (CONFIG["id"], "vod", "down")
+    cache.l1.set(key, INFO, ttl=-1)
+
+    assert await server.get_title_info(CONFIG, "vod", "down") == INFO
+    assert (cache.l1.hits, cache.l1.misses) == (0, 1)
+
+    with pytest.raises(httpx.ConnectError):
+        await server.get_title_info({**CONFIG, "id": "account-2"}, "vod", "down")
+    assert (cache.l1.hits, cache.l1.misses) == (0, 2)
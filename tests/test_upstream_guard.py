@@ -0,0 +1,144 @@
+"""
+Upstream guard: the circuit breaker state machine on a fake clock, probe
+slots given back by cancelled requests, and background guards sharing the
+host's breaker while keeping their own rate and concurrency budget.
+
+    python -m pytest tests/test_upstream_guard.py
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+class FakeClock:
+    """Stands in for the time module in server, only monotonic() is driven by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server, "time", fake)
+    return fake
+
+@pytest.fixture
+def guards(monkeypatch):
+    monkeypatch.setattr(server, "upstream_guards", {})
+    monkeypatch.setattr(server, "UPSTREAM_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(server, "UPSTREAM_RESET_TIMEOUT", 30.0)
+    return server.upstream_guards
+
+async def fail(guard: server.UpstreamGuard) -> None:
+    with pytest.raises(ConnectionError):
+        async with guard.slot():
+            raise ConnectionError("upstream down")
+
+async def test_breaker_opens_then_half_opens_after_reset_timeout(clock):
+    breaker = server.CircuitBreaker(failure_threshold=3, reset_timeout=30, half_open_probes=1)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN and breaker.open_count == 1
+    clock.advance(29)
+    assert not breaker.allow()
+
+    clock.advance(2)
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    # A single probe at a time
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+async def test_failed_probe_reopens_breaker(clock):
+    breaker = server.CircuitBreaker(failure_threshold=3, reset_timeout=30, half_open_probes=1)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(31)
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == breaker.OPEN and breaker.open_count == 2
+    # The reset timeout starts over from the failed probe
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(2)
+    assert breaker.allow() and breaker.state == breaker.HALF_OPEN
+
+async def test_cancelled_probe_releases_its_slot(clock, guards):
+    guard = server.upstream_guard("http://panel.invalid")
+    for _ in range(3):
+        await fail(guard)
+    assert guard.breaker.state == guard.breaker.OPEN
+    clock.advance(31)
+
+    entered = asyncio.Event()
+
+    async def probe():
+        async with guard.slot():
+            entered.set()
+            await asyncio.Event().wait()
+
+    task = asyncio.create_task(probe())
+    await entered.wait()
+    assert not guard.breaker.allow()
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    # Neither a success nor a failure: still half-open, with the probe slot free again
+    assert guard.breaker.state == guard.breaker.HALF_OPEN
+    assert guard.breaker.failures == 3 and guard.failures == 3
+    assert guard.in_flight == 0
+    async with guard.slot():
+        pass
+    assert guard.breaker.state == guard.breaker.CLOSED
+
+async def test_background_guard_shares_breaker_but_not_budget(clock, guards, monkeypatch):
+    monkeypatch.setattr(server, "UPSTREAM_BACKGROUND_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(server, "UPSTREAM_BACKGROUND_QUEUE_TIMEOUT", 0.05)
+    user = server.upstream_guard("http://panel.invalid/player_api.php")
+    background = server.upstream_guard("http://panel.invalid/get.php", background=True)
+
+    assert background is not user
+    assert background.breaker is user.breaker
+    assert background.bucket.rate == server.UPSTREAM_BACKGROUND_RATE
+    assert server.upstream_guard("http://panel.invalid", background=True) is background
+
+    # A busy background budget leaves user requests alone
+    async with background.slot():
+        with pytest.raises(server.UpstreamUnavailable):
+            async with background.slot():
+                pass
+        async with user.slot():
+            pass
+    assert background.rejected == 1 and user.rejected == 0
+
+    # Failures seen by background traffic open the circuit for user requests too
+    for _ in range(3):
+        await fail(background)
+    with pytest.raises(server.UpstreamUnavailable):
+        async with user.slot():
+            pass
+    assert user.rejected == 1
@@ -0,0 +1,77 @@
+"""
+Bulk user code generation: codes colliding with existing ones, or with each
+other, are regenerated until exactly ``count`` distinct codes are inserted,
+with and without the unique index on ``user_codes.code``.
+
+    python -m pytest tests/test_user_codes.py
+"""
+
+import itertools
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+EXISTING = ["00000001", "00000002"]
+
+@pytest.fixture
+def existing_codes(db, monkeypatch):
+    monkeypatch.setattr(server, "user_code_index_ready", False)
+    return db
+
+def scripted_codes(monkeypatch, codes):
+    """Make generate_user_code return ``codes`` in order, then fresh ones"""
+    fresh = (f"9{number:07d}" for number in itertools.count())
+    sequence = itertools.chain(codes, fresh)
+    monkeypatch.setattr(server, "generate_user_code", lambda length=8: next(sequence))
+
+async def insert_existing(db):
+    await db.user_codes.insert_many([{"code": code, "is_active": True} for code in EXISTING])
+
+async def assert_inserted(db, inserted, count):
+    codes = [doc["code"] for doc in inserted]
+    assert len(codes) == count == len(set(codes))
+    assert not set(codes) & set(EXISTING)
+    assert all("_id" not in doc and doc["template"] == "bulk" for doc in inserted)
+    stored = [doc["code"] async for doc in db.user_codes.find({}, {"code": 1})]
+    assert len(stored) == len(set(stored)) == count + len(EXISTING)
+
+async def test_collisions_are_regenerated_with_unique_index(existing_codes, monkeypatch):
+    db = existing_codes
+    await server.ensure_user_code_index()
+    await insert_existing(db)
+    # Two codes already taken, one drawn twice in the batch, then a retry colliding again
+    scripted_codes(monkeypatch, ["00000001", "00000003", "00000003", "00000004", "00000002", "00000005",
+                                 "00000001", "00000006"])
+
+    inserted = await server.insert_unique_user_codes({"template": "bulk"}, 5)
+
+    await assert_inserted(db, inserted, 5)
+    assert {doc["code"] for doc in inserted} == {"00000003", "00000004", "00000005", "00000006", "90000000"}
+
+async def test_codes_are_checked_against_collection_without_index(existing_codes, monkeypatch):
+    db = existing_codes
+    await insert_existing(db)
+    assert not await server.has_user_code_index()
+    scripted_codes(monkeypatch, ["00000001", "00000003", "00000003", "00000002", "00000004",
+                                 "00000002", "00000005"])
+
+    inserted = await server.insert_unique_user_codes({"template": "bulk"}, 4)
+
+    await assert_inserted(db, inserted, 4)
+    assert {doc["code"] for doc in inserted} == {"00000003", "00000004", "00000005", "90000000"}
+
+async def test_gives_up_when_every_code_collides(existing_codes, monkeypatch):
+    db = existing_codes
+    await server.ensure_user_code_index()
+    await insert_existing(db)
+    monkeypatch.setattr(server, "generate_user_code", lambda length=8: "00000001")
+
+    with pytest.raises(HTTPException) as error:
+        await server.insert_unique_user_codes({"template": "bulk"}, 1)
+
+    assert error.value.status_code == 500
+    assert await db.user_codes.count_documents({}) == len(EXISTING)
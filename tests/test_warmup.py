@@ -0,0 +1,91 @@
+"""
+Startup: indexes are created one by one (a TTL change goes through collMod),
+and the warm-up only syncs catalogs when it claims the scheduled run, without
+its timeout cancelling that sync.
+
+    python -m pytest tests/test_warmup.py
+"""
+
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = {"id": "account-1", "dns_url": "http://panel.invalid", "username": "user", "password": "pass"}
+
+async def test_a_failing_index_does_not_skip_the_others(db):
+    # Left by an older deployment: same keys, not unique
+    await db.catalog_state.create_index("account_id")
+
+    await server.ensure_indexes()
+
+    archive = await db.watch_progress_archive.index_information()
+    assert any(index.get("expireAfterSeconds") for index in archive.values())
+    assert any(index.get("unique") for index in archive.values())
+    assert "id_1" in await db.admin_jobs.index_information()
+
+async def test_changed_ttl_is_applied_with_coll_mod(db, monkeypatch):
+    commands = []
+
+    class Collection:
+        name = "watch_progress_archive"
+
+        async def create_index(self, keys, **options):
+            raise OperationFailure("Index already exists with different options", code=server.INDEX_OPTIONS_CONFLICT)
+
+    async def command(name, value, **options):
+        commands.append((name, value, options))
+
+    monkeypatch.setattr(db, "command", command, raising=False)
+
+    await server.ensure_index(Collection(), "archived_at", expireAfterSeconds=3600)
+
+    assert commands == [("collMod", "watch_progress_archive",
+                         {"index": {"keyPattern": {"archived_at": 1}, "expireAfterSeconds": 3600}})]
+    with pytest.raises(OperationFailure):
+        await server.ensure_index(Collection(), "archived_at")
+
+@pytest.fixture
+def syncs(db, monkeypatch):
+    calls = []
+
+    async def sync_all_catalogs():
+        calls.append("started")
+        await asyncio.sleep(0.2)
+        calls.append("finished")
+        return []
+
+    async def load_catalog_from_store(config, kind, category_id=None, child_safe=False):
+        return None
+
+    monkeypatch.setattr(server, "sync_all_catalogs", sync_all_catalogs)
+    monkeypatch.setattr(server, "load_catalog_from_store", load_catalog_from_store)
+    monkeypatch.setattr(server, "CATALOG_SYNC_INTERVAL", 3600)
+    return calls
+
+async def test_warm_up_syncs_a_never_synced_catalog_once(syncs):
+    await server.warm_catalogs(CONFIG)
+    # Another worker starting in the same interval finds the run claimed
+    await server.warm_catalogs(CONFIG)
+
+    assert syncs == ["started", "finished"]
+
+async def test_warm_up_does_not_sync_with_scheduler_disabled(syncs, monkeypatch):
+    monkeypatch.setattr(server, "CATALOG_SYNC_INTERVAL", 0)
+
+    await server.warm_catalogs(CONFIG)
+
+    assert syncs == []
+
+async def test_warm_up_timeout_does_not_cancel_the_sync(syncs):
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(server.warm_catalogs(CONFIG), 0.05)
+    assert syncs == ["started"]
+
+    await asyncio.sleep(0.3)
+
+    assert syncs == ["started", "finished"]
@@ -0,0 +1,68 @@
+"""
+Watch progress retention: archived titles resume where the user stopped,
+and a title archived again keeps a single, most recent archived position.
+
+    python -m pytest tests/test_watch_progress.py
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+KEY = {"user_code": "C1", "profile_name": "dad", "stream_id": "42"}
+
+async def write_progress(current_time: float):
+    await server.update_watch_progress(server.WatchProgressUpdate(
+        **KEY, stream_type="movie", current_time=current_time, duration=100
+    ))
+
+async def archive_all():
+    # Everything is older than the stale horizon once last_watched is moved back
+    await server.db.watch_progress.update_many(
+        {}, {"$set": {"last_watched": datetime.utcnow() - timedelta(days=server.WATCH_PROGRESS_STALE_DAYS + 1)}}
+    )
+    return await server.archive_watch_progress({}, "stale")
+
+async def test_resume_then_archive_again_keeps_latest_position(db):
+    await server.ensure_progress_archive_index()
+    await write_progress(10)
+    assert await archive_all() == 1
+    assert (await server.get_watch_progress(**KEY))["current_time"] == 10
+    
+    # Resuming the archived title drops its archived copy
+    await write_progress(60)
+    assert await db.watch_progress_archive.count_documents(KEY) == 0
+    assert (await server.get_watch_progress(**KEY))["current_time"] == 60
+    
+    assert await archive_all() == 1
+    assert await db.watch_progress_archive.count_documents(KEY) == 1
+    progress = await server.get_watch_progress(**KEY)
+    assert progress["has_progress"] and progress["current_time"] == 60
+
+async def test_archiving_twice_replaces_the_archived_copy(db):
+    await write_progress(10)
+    await archive_all()
+    # A hot entry written without going through the progress route (e.g. restored from a backup)
+    await db.watch_progress.insert_one({**KEY, "current_time": 80, "duration": 100, "percentage": 80})
+    
+    assert await archive_all() == 1
+    archived = await db.watch_progress_archive.find(KEY).to_list(None)
+    assert [doc["current_time"] for doc in archived] == [80]
+
+async def test_unique_index_replaces_duplicates_of_older_deployments(db):
+    now = datetime.utcnow()
+    await db.watch_progress_archive.create_index([("user_code", 1), ("profile_name", 1), ("stream_id", 1)])
+    await db.watch_progress_archive.insert_many([
+        {**KEY, "current_time": 10, "last_watched": now - timedelta(days=2)},
+        {**KEY, "current_time": 60, "last_watched": now - timedelta(days=1)},
+    ])
+    
+    await server.ensure_progress_archive_index()
+    
+    assert [doc["current_time"] for doc in await db.watch_progress_archive.find(KEY).to_list(None)] == [60]
+    indexes = await db.watch_progress_archive.index_information()
+    assert any(index.get("unique") for index in indexes.values() if "stream_id" in dict(index["key"]))